@@ -12,25 +12,184 @@
 # GNU General Public License for more details.
 import discord
 from discord.ext import commands
+from discord.utils import MISSING
+import asyncio
 import datetime
+import functools
 import os
+import time
 
+import config as config_loader
 from config import config
+config_loader.load()
+from lib.startup import timeline
+from lib.metrics import metrics_server
+from lib.loop_monitor import loop_monitor
+from lib.executors import executor_pool
+from lib.message_pipeline import message_pipeline, listener_seconds
+from lib.cluster import cluster_link, cluster_shards
 
-class ModuleBot(commands.Bot):
+# runs the shards in config['shard_ids'], or every shard when that is None. With a cluster_id it is one
+# worker of a cluster and self.everywhere() runs coordination commands in every worker
+class ModuleBot(commands.AutoShardedBot):
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, cluster_id = None, **kwargs):
         super().__init__(*args, **kwargs)
         self.config = config
         self.launch_time = datetime.datetime.now()
+        self.plugin_load_times = { }
+        self.connecting = None
+        self._timed_listeners = { }     # { (listener, event): timed wrapper }
+        self.metrics_server = None
+        self.loop_monitor = loop_monitor(config['slow_callback_ms'] / 1000)
+        self.executors = executor_pool(config['io_threads'], config['cpu_processes'])
+        self.messages = message_pipeline()
+        self.config_store = config_loader.store
+        self.config_store.run_blocking = self.run_blocking
+        self.cluster_id = cluster_id
+        self.cluster = None
+        self._cluster_tasks = set()
+        # { key: config_store } whose list changes are shared with the rest of the cluster
+        self.shared_stores = { }
+        self.share_store('config', self.config_store)
+        # commands another worker can run here, each takes picklable arguments
+        self.cluster_commands = { 'config': self._apply_config,
+                                  'leave_guild': self.leave_guild,
+                                  'reload_plugin': self.reload_cog,
+                                  'supervisor_lost': self._supervisor_lost }
 
+    # plugins load concurrently in waves, a plugin waits for the wave holding everything in its
+    # config['plugin_dependencies'] entry, e.g. { "markov_cog": [ "devtools_cog" ] }
     async def setup_hook(self):
-        for plugin in os.listdir(f'./{self.config["plugin_directory"]}'):
+        self.loop_monitor.start()
+        self.config_store.start()
+        if self.cluster_id is not None:
+            self.cluster = cluster_link(self.cluster_id)
+            self.cluster.start(self._cluster_message)
+        if self.config['metrics_port']:
+            # cluster workers serve on consecutive ports
+            self.metrics_server = metrics_server(self.config['metrics_host'], self.config['metrics_port'] + (self.cluster_id or 0))
+            await self.metrics_server.start()
+
+        plugins = [ ]
+        for plugin in sorted(os.listdir(f'./{self.config["plugin_directory"]}')):
             if plugin.endswith('.py'):
                 if self.config['plugin_whitelist_only'] and plugin[:-3] not in self.config['plugin_whitelist']:
                         continue
-                await super().load_extension(f'{self.config["plugin_directory"]}.{plugin[:-3]}')
-                print(f'Loaded plugin {plugin}')
+                plugins.append(plugin[:-3])
+
+        loading = timeline.begin('load plugins')
+        start = time.perf_counter()
+        failed = set()
+        for wave in plugin_load_waves(plugins, self.config['plugin_dependencies']):
+            for plugin in [ p for p in wave if failed.intersection(self.config['plugin_dependencies'].get(p, [ ])) ]:
+                print(f'Skipped plugin {plugin}.py, a dependency failed to load.')
+                failed.add(plugin)
+            wave = [ p for p in wave if p not in failed ]
+            results = await asyncio.gather(*[ self._load_plugin(p) for p in wave ], return_exceptions = True)
+            for plugin, result in zip(wave, results):
+                if isinstance(result, BaseException):
+                    print(f'Failed to load plugin {plugin}.py: {result}')
+                    failed.add(plugin)
+        print(f'Loaded {len(plugins) - len(failed)} plugins in {(time.perf_counter() - start) * 1000:.0f} ms')
+        timeline.end(loading)
+        self.connecting = timeline.begin('connect to discord')
+
+    async def _load_plugin(self, plugin):
+        start = time.perf_counter()
+        await super().load_extension(f'{self.config["plugin_directory"]}.{plugin}')
+        self.plugin_load_times[plugin] = time.perf_counter() - start
+        timeline.record(f'plugin {plugin}', self.plugin_load_times[plugin])
+        print(f'Loaded plugin {plugin}.py in {self.plugin_load_times[plugin] * 1000:.0f} ms')
+
+    async def close(self):
+        self.loop_monitor.stop()
+        self.config_store.stop()
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+        await super().close()
+        await self.config_store.flush()
+        if self.cluster is not None:
+            self.cluster.stop()
+            self.cluster = None
+        self.executors.shutdown()
+
+    # blocking file or sqlite3 work, e.g. await self.bot.run_blocking(json.dump, chain, file)
+    async def run_blocking(self, func, *args, **kwargs):
+        return await self.executors.run_blocking(func, *args, **kwargs)
+
+    # CPU heavy work in a worker process, func and arguments must be picklable
+    async def run_cpu(self, func, *args, **kwargs):
+        return await self.executors.run_cpu(func, *args, **kwargs)
+
+    # every listener, cog or not, is timed under its event and owner
+    def add_listener(self, func, name = MISSING):
+        name = func.__name__ if name is MISSING else name
+        owner = type(func.__self__).__name__ if hasattr(func, '__self__') else func.__module__
+
+        @functools.wraps(func)
+        async def timed(*args, **kwargs):
+            with listener_seconds.time(event = name, cog = owner):
+                return await func(*args, **kwargs)
+
+        self._timed_listeners[(func, name)] = timed
+        super().add_listener(timed, name)
+
+    def remove_listener(self, func, name = MISSING):
+        name = func.__name__ if name is MISSING else name
+        super().remove_listener(self._timed_listeners.pop((func, name), func), name)
+
+    # cogs subscribe to self.messages rather than listening for on_message, commands are processed here
+    async def on_message(self, msg: discord.Message):
+        self.messages.dispatch(msg)
+        await self.process_commands(msg)
+
+    async def on_message_edit(self, before: discord.Message, after: discord.Message):
+        self.messages.dispatch_edit(before, after)
+
+    # runs a coordination command here and in every other worker of the cluster
+    async def everywhere(self, command, *args):
+        if self.cluster is not None:
+            self.cluster.broadcast(command, *args)
+        await self.cluster_commands[command](*args)
+
+    def _cluster_message(self, command, args):
+        if (handler := self.cluster_commands.get(command)) is None:
+            print(f'Unknown cluster command {command}.')
+            return
+        task = asyncio.create_task(self._run_cluster_command(command, handler, args))
+        self._cluster_tasks.add(task)
+        task.add_done_callback(self._cluster_tasks.discard)
+
+    async def _run_cluster_command(self, command, handler, args):
+        try:
+            await handler(*args)
+        except Exception as e:
+            print(f'Cluster command {command} failed: {e}')
+
+    def share_store(self, key, store):
+        self.shared_stores[key] = store
+        store.on_change.append(functools.partial(self._share_change, key))
+
+    def _share_change(self, key, name, action, ids):
+        if self.cluster is not None:
+            self.cluster.broadcast('config', key, name, action, list(ids))
+
+    def unshare_store(self, key):
+        self.shared_stores.pop(key, None)
+
+    async def _apply_config(self, key, name, action, ids):
+        if (store := self.shared_stores.get(key)) is not None:
+            store.apply(name, action, ids)
+
+    async def _supervisor_lost(self):
+        print('Lost the cluster supervisor, shutting down.')
+        await self.close()
+
+    async def leave_guild(self, guild_id):
+        if (g := self.get_guild(guild_id)) is not None:
+            await g.leave()
+            print(f'Left guild {g.name} ({g.member_count}) id: {g.id}.')
 
     async def reload_cog(self, name):
          if self.config['plugin_whitelist_only'] and name not in self.config['plugin_whitelist']:
@@ -43,15 +202,33 @@ class ModuleBot(commands.Bot):
               guildoptions.append(discord.SelectOption(label = g.name, value = str(g.id)))
         return guildoptions
     
-    async def on_guild_join(self, ctx, guild):
-         if (config['guild_whitelist_only'] and guild.id not in config['guild_whitelist'] 
-         or guild.id in config['guild_banlist']):
+    async def on_guild_join(self, guild):
+         if (config['whitelist_servers_only'] and not self.config_store.contains('guild_whitelist', guild.id)
+         or self.config_store.contains('guild_banlist', guild.id)):
             await guild.leave()
             print(f'Left guild {guild.name} ({guild.member_count}) id: {guild.id} on join due to banlist.')
 
+# groups plugins into lists that can load at the same time, each after every list before it
+# dependencies that are not being loaded are ignored, plugins in a cycle load last together
+def plugin_load_waves(plugins, dependencies):
+    remaining = { p: set(dependencies.get(p, [ ])).intersection(plugins) - { p } for p in plugins }
+    waves = [ ]
+    while remaining:
+        if not (wave := [ p for p, deps in remaining.items() if not deps ]):
+            print(f'Plugin dependency cycle between {", ".join(remaining)}, loading them together.')
+            wave = list(remaining)
+        waves.append(wave)
+        for p in wave:
+            del remaining[p]
+        for deps in remaining.values():
+            deps.difference_update(wave)
+    return waves
+
 intents = discord.Intents.default()
 intents.message_content = True
-bot = ModuleBot(command_prefix = config['command_prefix'], intents = intents, owner_ids = config['owner_ids'])
+shard_ids = cluster_shards(config['shard_count'], config['cluster_count'], config['cluster_id']) if config['cluster_id'] is not None else None
+bot = ModuleBot(command_prefix = config['command_prefix'], intents = intents, owner_ids = config['owner_ids'],
+                shard_count = config['shard_count'] or None, shard_ids = shard_ids, cluster_id = config['cluster_id'])
 
 STARTUP_BANNER = r"""
  ▄· ▄▌ ▄▄▄·  ▄▄▄· ▄▄▄·▄▄▄ .▄▄▄  
@@ -62,13 +239,20 @@ STARTUP_BANNER = r"""
 
 @bot.event
 async def on_ready():
+    if timeline.ready is None:
+        if bot.connecting is not None:
+            timeline.end(bot.connecting)
+        timeline.finish()
     print(STARTUP_BANNER)
     msg = f'Initialized {config["bot_name"]} as {bot.user} with options:\n'\
           f'\t- command prefix "{config["command_prefix"]}"\n'\
           f'\t- plugin whitelist {"enabled" if config["plugin_whitelist_only"] else "disabled"}\n'\
           f'\t- logfile "{config["log_file_name"]}"\n'\
+          f'\t- shards {bot.shard_ids or list(range(bot.shard_count or 1))} of {bot.shard_count}'\
+          f'{f" in cluster worker {bot.cluster_id}" if bot.cluster_id is not None else ""}\n'\
           f'in {len(bot.guilds)} guilds:\n'
     for s in bot.guilds:
         msg += f'\t- {s.name} ({s.member_count}) id: {s.id}\n'
+    msg += timeline.report()
     print(msg, end='')
     pass
@@ -14,39 +14,76 @@
 from configparser import ConfigParser
 import json
 
-import argparse
-parser = argparse.ArgumentParser(prog='Discord bot skeleton',
-                                 description='Module based python bot.')
-parser.add_argument('configfilename', nargs = '?', default = 'config.ini', help = 'Specify an optional config file.')
-args = parser.parse_args()
+from lib.config_store import config_store
 
+# config and configfile are filled in place by load(), so modules can import them before the command
+# line is parsed. main.py calls load() first thing, importing bot loads with sys.argv if it hasn't.
+# The id lists are sets owned by store, change them with store.add() / store.remove() so they are saved.
+# store reloads the file when it changes, settings read at startup (prefix, owners, plugins) need a restart.
 config = { }
 configfile = ConfigParser()
-configfile.read(args.configfilename)
-
-config['filename'] = args.configfilename
-# constants
-config['command_prefix'] = configfile['constants']['command_prefix']
-config['bot_name'] = configfile['constants']['bot_name']
-config['log_file_name'] = configfile['constants']['log_file']
-
-# privileged command access
-config['owner_ids'] = json.loads(configfile['settings']['owner_ids'])
-config['mod_ids'] = json.loads(configfile['settings']['mod_ids'])
-
-# plugin loading settings
-config['plugin_directory'] = configfile['plugins']['plugin_directory']
-config['plugin_whitelist_only'] = configfile.getboolean('plugins', 'whitelist_only')
-config['plugin_whitelist'] = json.loads(configfile['plugins']['plugin_whitelist'])
-
-# whitelists
-config['guild_whitelist'] = json.loads(configfile['whitelists']['guild_ids'])
-config['user_whitelist'] = json.loads(configfile['whitelists']['user_ids'])
-
-# blacklists
-config['guild_blacklist'] = json.loads(configfile['blacklists']['guild_ids'])
-config['user_blacklist'] = json.loads(configfile['blacklists']['user_ids'])
-
-# bans
-config['guild_banlist'] = json.loads(configfile['banlists']['guild_ids'])
-config['user_banlist'] = json.loads(configfile['banlists']['user_ids'])
\ No newline at end of file
+
+CONFIG_LISTS = {
+    'guild_whitelist': ('whitelists', 'guild_ids'),
+    'user_whitelist': ('whitelists', 'user_ids'),
+    'guild_blacklist': ('blacklists', 'guild_ids'),
+    'user_blacklist': ('blacklists', 'user_ids'),
+    'guild_banlist': ('banlists', 'guild_ids'),
+    'user_banlist': ('banlists', 'user_ids'),
+}
+
+def load(argv = None):
+    if config:
+        return config
+
+    import argparse
+    parser = argparse.ArgumentParser(prog='Discord bot skeleton',
+                                     description='Module based python bot.')
+    parser.add_argument('configfilename', nargs = '?', default = 'config.ini', help = 'Specify an optional config file.')
+    parser.add_argument('--profile-startup', action = 'store_true', help = 'Write a cProfile of startup to startup.prof once the bot is ready.')
+    # set by the cluster supervisor for its workers
+    parser.add_argument('--cluster', type = int, default = None, help = argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    config['filename'] = args.configfilename
+    config['profile_startup'] = args.profile_startup
+    config['cluster_id'] = args.cluster
+    store.filename = args.configfilename
+    store.load()
+    return config
+
+def _parse(configfile, config):
+    # constants
+    config['command_prefix'] = configfile['constants']['command_prefix']
+    config['bot_name'] = configfile['constants']['bot_name']
+    config['log_file_name'] = configfile['constants']['log_file']
+
+    # privileged command access
+    config['owner_ids'] = json.loads(configfile['settings']['owner_ids'])
+    config['mod_ids'] = json.loads(configfile['settings']['mod_ids'])
+
+    # plugin loading settings
+    config['plugin_directory'] = configfile['plugins']['plugin_directory']
+    config['plugin_whitelist_only'] = configfile.getboolean('plugins', 'whitelist_only')
+    config['plugin_whitelist'] = json.loads(configfile['plugins']['plugin_whitelist'])
+    config['plugin_dependencies'] = json.loads(configfile.get('plugins', 'plugin_dependencies', fallback = '{}'))
+
+    # whitelists, blacklists and bans are CONFIG_LISTS
+    config['whitelist_servers_only'] = configfile.getboolean('whitelists', 'whitelist_only', fallback = False)
+
+    # metrics endpoint, port 0 disables it
+    config['metrics_host'] = configfile.get('metrics', 'host', fallback = '127.0.0.1')
+    config['metrics_port'] = configfile.getint('metrics', 'port', fallback = 0)
+    # event loop stalls longer than this are logged with the code that caused them
+    config['slow_callback_ms'] = configfile.getint('metrics', 'slow_callback_ms', fallback = 250)
+
+    # workers for blocking file I/O and CPU heavy transforms, 0 processes runs CPU work on the threads
+    config['io_threads'] = configfile.getint('executors', 'io_threads', fallback = 4)
+    config['cpu_processes'] = configfile.getint('executors', 'cpu_processes', fallback = 2)
+
+    # gateway shards, 0 lets discord recommend a count, more than 1 process splits the shards between
+    # worker processes started by a cluster supervisor
+    config['shard_count'] = configfile.getint('sharding', 'shard_count', fallback = 0)
+    config['cluster_count'] = configfile.getint('sharding', 'processes', fallback = 1)
+
+store = config_store(None, _parse, CONFIG_LISTS, values = config, parser = configfile)
\ No newline at end of file
@@ -0,0 +1,205 @@
+# Multi-process gateway sharding, a supervisor and the link between its workers
+# Copyright (C) 2024 adversarial
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# With processes > 1 under [sharding], main.py runs a cluster_supervisor instead of the bot. It starts one
+# worker per process, each is `python main.py <config> --cluster <id>` and serves its share of the shards.
+# Discord routes a guild to shard (guild id >> 22) % shard_count, so with the same settings a guild always
+# lands on the same worker and the worker can keep its own files (see cluster_filename). When the settings change
+# a worker can find files left by the previous layout with cluster_files.
+# Workers reach the supervisor over a local authenticated socket, the address and key are passed in CLUSTER_ENV.
+# Anything a worker broadcasts is relayed to every other worker, ModuleBot uses it for config changes,
+# bans and owner commands. Workers that crash are restarted with a growing delay, a clean exit is left alone.
+# A worker that loses the supervisor is told with a 'supervisor_lost' message, so it can shut down
+# rather than keep its shards connected next to a replacement.
+#   - shard_ranges(shard_count, processes) / cluster_shards(shard_count, processes, cluster_id)
+#   - cluster_supervisor(processes, command).run()
+#   - cluster_link(cluster_id).start(handle) / .broadcast(command, *args) / .stop()
+
+import asyncio
+import glob
+import multiprocessing.connection
+import os
+import secrets
+import signal
+import subprocess
+import threading
+import time
+
+CLUSTER_ENV = 'MODULEBOT_CLUSTER'
+
+# contiguous shard ids for each process
+def shard_ranges(shard_count, processes) -> list:
+    return [ list(range(i * shard_count // processes, (i + 1) * shard_count // processes)) for i in range(processes) ]
+
+# the shards one worker runs, raises ValueError when the settings can't give it any
+def cluster_shards(shard_count, processes, cluster_id) -> list:
+    if cluster_id not in range(processes):
+        raise ValueError(f'Cluster id {cluster_id} is out of range, with processes = {processes} under [sharding] it must be 0 to {processes - 1}.')
+    if shard_count < processes:
+        raise ValueError(f'shard_count ({shard_count}) must be at least processes ({processes}) under [sharding].')
+    return shard_ranges(shard_count, processes)[cluster_id]
+
+# per-process copy of a file, e.g. markov.db -> markov.cluster2.db, unchanged when not clustered
+def cluster_filename(filename, cluster_id) -> str:
+    if cluster_id is None:
+        return filename
+    root, ext = os.path.splitext(filename)
+    return f'{root}.cluster{cluster_id}{ext}'
+
+# the file and every per-process copy of it that exists, e.g. [ markov.db, markov.cluster0.db, markov.cluster1.db ]
+def cluster_files(filename) -> list:
+    root, ext = os.path.splitext(filename)
+    copies = glob.glob(f'{glob.escape(root)}.cluster*{glob.escape(ext)}')
+    return [ f for f in [ filename ] if os.path.exists(f) ] + sorted(copies)
+
+class cluster_supervisor:
+    RESTART_DELAY = 5.0
+    MAX_RESTART_DELAY = 300.0
+    STABLE_SECONDS = 600.0      # a worker that ran this long restarts with the shortest delay again
+    STOP_TIMEOUT = 30.0
+
+    # command is the worker's argv without --cluster
+    def __init__(self, processes, command: list):
+        self.processes = processes
+        self.command = command
+        self.authkey = secrets.token_bytes(32)
+        self.listener = multiprocessing.connection.Listener(('127.0.0.1', 0), authkey = self.authkey)
+        self.workers = { }      # { cluster id: (Popen, start time) }
+        self.links = { }        # { cluster id: Connection }
+        self.restarts = { }     # { cluster id: (delay, restart at) }
+        self.links_lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def _spawn(self, cluster_id):
+        host, port = self.listener.address
+        env = dict(os.environ, **{ CLUSTER_ENV: f'{host}:{port}:{self.authkey.hex()}' })
+        self.workers[cluster_id] = (subprocess.Popen(self.command + [ '--cluster', str(cluster_id) ], env = env), time.monotonic())
+        print(f'Started cluster worker {cluster_id}.')
+
+    # each worker says hello with its id when it connects
+    def _accept(self):
+        while True:
+            try:
+                connection = self.listener.accept()
+                _, cluster_id = connection.recv()
+            except (OSError, EOFError, multiprocessing.AuthenticationError):
+                if self._stopping.is_set():
+                    return
+                continue
+            with self.links_lock:
+                if (old := self.links.get(cluster_id)) is not None:
+                    old.close()
+                self.links[cluster_id] = connection
+
+    def _relay(self, sender, message):
+        with self.links_lock:
+            links = [ (i, c) for i, c in self.links.items() if i != sender ]
+        for cluster_id, connection in links:
+            try:
+                connection.send(message)
+            except OSError:
+                print(f'Lost the link to cluster worker {cluster_id}.')
+
+    def _check_workers(self):
+        now = time.monotonic()
+        for cluster_id, (process, started) in list(self.workers.items()):
+            if (code := process.poll()) is None:
+                continue
+            del self.workers[cluster_id]
+            if code == 0:
+                print(f'Cluster worker {cluster_id} exited.')
+                self.restarts.pop(cluster_id, None)
+                continue
+            delay, _ = self.restarts.get(cluster_id, (0, 0))
+            delay = cluster_supervisor.RESTART_DELAY if now - started > cluster_supervisor.STABLE_SECONDS \
+                    else min(max(delay * 2, cluster_supervisor.RESTART_DELAY), cluster_supervisor.MAX_RESTART_DELAY)
+            self.restarts[cluster_id] = (delay, now + delay)
+            print(f'Cluster worker {cluster_id} exited with code {code}, restarting in {delay:g} s.')
+        for cluster_id, (delay, restart_at) in list(self.restarts.items()):
+            if cluster_id not in self.workers and now >= restart_at:
+                self._spawn(cluster_id)
+
+    def run(self):
+        threading.Thread(target = self._accept, name = 'cluster-accept', daemon = True).start()
+        for cluster_id in range(self.processes):
+            self._spawn(cluster_id)
+        try:
+            while self.workers or any(cluster_id not in self.workers for cluster_id in self.restarts):
+                with self.links_lock:
+                    links = dict(self.links)
+                for connection in multiprocessing.connection.wait(list(links.values()), timeout = 0.5):
+                    sender = next(i for i, c in links.items() if c is connection)
+                    try:
+                        message = connection.recv()
+                    except (EOFError, OSError):
+                        with self.links_lock:
+                            if self.links.get(sender) is connection:
+                                del self.links[sender]
+                        continue
+                    self._relay(sender, message)
+                self._check_workers()
+        except KeyboardInterrupt:
+            print('Stopping cluster workers.')
+        finally:
+            self.stop()
+
+    # workers get the same interrupt as Ctrl+C so they close cleanly and flush their config
+    def stop(self):
+        self._stopping.set()
+        for process, _ in self.workers.values():
+            if process.poll() is None:
+                process.send_signal(signal.SIGINT if os.name == 'posix' else signal.SIGTERM)
+        for process, _ in self.workers.values():
+            try:
+                process.wait(cluster_supervisor.STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.workers.clear()
+        self.listener.close()
+
+class cluster_link:
+    def __init__(self, cluster_id):
+        host, port, authkey = os.environ[CLUSTER_ENV].rsplit(':', 2)
+        self.cluster_id = cluster_id
+        self.connection = multiprocessing.connection.Client((host, int(port)), authkey = bytes.fromhex(authkey))
+        self.connection.send(('hello', cluster_id))
+        self._thread = None
+        self._stopping = False
+
+    # handle(command, args) is called on the running loop for each message from another worker
+    def start(self, handle):
+        loop = asyncio.get_running_loop()
+
+        def receive():
+            while True:
+                try:
+                    command, args = self.connection.recv()
+                except (EOFError, OSError):
+                    if not self._stopping:
+                        loop.call_soon_threadsafe(handle, 'supervisor_lost', ())
+                    return
+                loop.call_soon_threadsafe(handle, command, args)
+
+        self._thread = threading.Thread(target = receive, name = 'cluster-link', daemon = True)
+        self._thread.start()
+
+    # arguments must be picklable
+    def broadcast(self, command, *args):
+        try:
+            self.connection.send((command, args))
+        except OSError as e:
+            print(f'Unable to reach the cluster supervisor: {e}')
+
+    def stop(self):
+        self._stopping = True
+        self.connection.close()
@@ -0,0 +1,279 @@
+# Ini file backed settings with set-backed id lists, atomic saves and hot reload
+# Copyright (C) 2024 adversarial
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# A config_store owns an ini file, the ConfigParser it was read into and a dict of parsed values.
+#   parse(parser, values) fills values with the plain settings
+#   lists is { name: (section, option) } of JSON id lists, kept in values[name] as sets
+#   store = config_store('markov.ini', parse, { 'guild_blacklist': ('blacklists', 'guild_ids') })
+#   store.load()
+#   if store.contains('guild_blacklist', guild.id): ...      # a set lookup
+#   store.add('guild_blacklist', guild.id)                   # updates the set and the parser, then saves
+# Saves are debounced, the first change schedules a write SAVE_DELAY seconds later and every change made
+# until then goes out with it, so a burst of admin commands is one write. The write copies the parser's
+# values on the loop, then on a worker thread puts them into the text of the file and writes a temp file
+# that is renamed over the original, so a crash never leaves half a file. Comments, blank lines and the
+# order of the file are kept, only options whose value changed are rewritten (see _render).
+# flush() writes pending changes now, call it before shutting down.
+# The watcher task reloads the file when it changes on disk, values are replaced in place so modules
+# holding the dict see the new settings, then on_reload callbacks run.
+# A file that fails to parse is reported and the previous settings are kept, and while changes are waiting
+# to be written the file on disk is not reloaded over them.
+# on_change callbacks get (name, 'add' or 'remove', ids) for every list change made here, ModuleBot relays
+# them to the other processes of a cluster which apply() them without saving again.
+#   - .load() / .reload()
+#   - .contains() / .add() / .remove() / .apply() / .save() / .flush()
+#   - .start() / .stop()
+
+import asyncio
+import configparser
+import contextlib
+import json
+import os
+import re
+import tempfile
+
+from lib.metrics import registry
+
+config_changes = registry.counter('config_changes_total', 'Config changes made, by file.')
+config_writes = registry.counter('config_writes_total', 'Config files written, by file.')
+
+def _write_atomic(filename, text):
+    directory, name = os.path.split(os.path.abspath(filename))
+    descriptor, temp = tempfile.mkstemp(dir = directory, prefix = f'.{name}.', suffix = '.tmp')
+    try:
+        with os.fdopen(descriptor, 'w') as file:
+            file.write(text)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp, filename)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(temp)
+        raise
+
+SECTION_PATTERN = re.compile(r'\[(?P<name>[^\]]+)\]')
+OPTION_PATTERN = re.compile(r'(?P<option>[^\s#;=:][^=:]*?)\s*[=:]\s*(?P<value>.*)$')
+
+def _format_option(option, value):
+    return f'{option} = {value}'.replace('\n', '\n\t')
+
+# text with the values of sections ({ section: { option: value } }) put in place so comments, blank lines and
+# the order of the file survive. Unchanged options keep their lines as written and changed ones are rewritten,
+# options and sections that are gone are dropped, new ones go after the last option of their section or at the end.
+def _render(text, sections: dict, optionxform = str.lower) -> str:
+    lines = text.splitlines()
+    output = [ ]
+    written = { }           # { section: options already in output }
+    ends = { }              # { section: index in output after its last option }
+    section = None
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        i += 1
+        if (match := SECTION_PATTERN.match(line)):
+            section = match.group('name')
+            if section in sections:
+                output.append(line)
+                written[section] = set()
+                ends[section] = len(output)
+            continue
+        if section is not None and section not in sections:
+            continue
+        if section is None or not (match := OPTION_PATTERN.match(line)):
+            output.append(line)
+            continue
+        # indented lines after an option continue its value
+        block = [ line ]
+        while i < len(lines) and lines[i][:1].isspace() and lines[i].strip():
+            block.append(lines[i])
+            i += 1
+        name = match.group('option')
+        option = optionxform(name)
+        if option not in sections[section] or option in written[section]:
+            continue
+        value = '\n'.join([ match.group('value').strip() ] + [ l.strip() for l in block[1:] ])
+        if value == sections[section][option]:
+            output.extend(block)
+        else:
+            output.append(_format_option(name, sections[section][option]))
+        written[section].add(option)
+        ends[section] = len(output)
+    for section in sorted(ends, key = ends.get, reverse = True):
+        output[ends[section]:ends[section]] = [ _format_option(o, v) for o, v in sections[section].items() if o not in written[section] ]
+    for section, options in sections.items():
+        if section in ends:
+            continue
+        if output and output[-1].strip():
+            output.append('')
+        output.append(f'[{section}]')
+        output.extend(_format_option(o, v) for o, v in options.items())
+        output.append('')
+    return '\n'.join(output) + '\n'
+
+def _update_file(filename, sections: dict, optionxform):
+    try:
+        with open(filename, 'r') as file:
+            text = file.read()
+    except FileNotFoundError:
+        text = ''
+    _write_atomic(filename, _render(text, sections, optionxform))
+
+# { section: { option: value } } as the parser holds them, defaults only under their own section
+def _sections(parser: configparser.ConfigParser) -> dict:
+    defaults = parser.defaults()
+    sections = { parser.default_section: dict(defaults) } if defaults else { }
+    for section in parser.sections():
+        values = { option: parser.get(section, option, raw = True) for option in parser.options(section) }
+        sections[section] = { option: value for option, value in values.items() if option not in defaults or value != defaults[option] }
+    return sections
+
+def _modified(filename):
+    try:
+        return os.stat(filename).st_mtime_ns
+    except OSError:
+        return None
+
+class config_store:
+    WATCH_INTERVAL = 5.0
+    SAVE_DELAY = 1.0
+
+    def __init__(self, filename, parse, lists: dict = None, values: dict = None, parser: configparser.ConfigParser = None, run_blocking = asyncio.to_thread):
+        self.filename = filename
+        self.parse = parse
+        self.lists = lists or { }
+        self.values = values if values is not None else { }
+        self.parser = parser if parser is not None else configparser.ConfigParser()
+        self.run_blocking = run_blocking        # pass bot.run_blocking to write on the bot's pool
+        self.on_reload = [ ]                    # callbacks run after a hot reload or an apply()
+        self.on_change = [ ]                    # callbacks run after add() and remove()
+        self.modified = None
+        self._dirty = False
+        self._pending = None        # task waiting SAVE_DELAY to write
+        self._write_lock = asyncio.Lock()
+        self._watcher = None
+
+    # reads the file into a fresh parser and values, raises if it doesn't parse
+    def _read(self):
+        parser = configparser.ConfigParser()
+        if not parser.read(self.filename):
+            raise FileNotFoundError(f'Unable to read {self.filename}.')
+        values = { }
+        self.parse(parser, values)
+        for name, (section, option) in self.lists.items():
+            values[name] = set(json.loads(parser.get(section, option, fallback = '[]')))
+        return parser, values
+
+    def load(self):
+        modified = _modified(self.filename)
+        parser, values = self._read()
+        self.parser.clear()
+        self.parser.read_dict(parser)
+        self.values.update(values)
+        self.modified = modified
+
+    # true if the file changed on disk and was loaded
+    def reload(self) -> bool:
+        if (modified := _modified(self.filename)) == self.modified or self._dirty:
+            return False
+        try:
+            self.load()
+        except Exception as e:
+            self.modified = modified    # don't retry until it changes again
+            print(f'Failed to reload {self.filename}, keeping the previous settings: {e}')
+            return False
+        print(f'Reloaded {self.filename}')
+        for callback in self.on_reload:
+            callback()
+        return True
+
+    def contains(self, name, id) -> bool:
+        return id in self.values[name]
+
+    def add(self, name, *ids):
+        self.values[name].update(ids)
+        self._list_changed(name, 'add', ids)
+
+    def remove(self, name, *ids):
+        self.values[name].difference_update(ids)
+        self._list_changed(name, 'remove', ids)
+
+    def _list_changed(self, name, action, ids):
+        self._set_option(name)
+        self.save()
+        for callback in self.on_change:
+            callback(name, action, ids)
+
+    def _set_option(self, name):
+        section, option = self.lists[name]
+        if not self.parser.has_section(section):
+            self.parser.add_section(section)
+        self.parser[section][option] = json.dumps(sorted(self.values[name]))
+
+    # a change another process made and saved, kept in the parser so our own saves don't undo it
+    def apply(self, name, action, ids):
+        if action == 'add':
+            self.values[name].update(ids)
+        else:
+            self.values[name].difference_update(ids)
+        self._set_option(name)
+        for callback in self.on_reload:
+            callback()
+
+    # call after changing self.parser directly
+    def save(self):
+        config_changes.inc(file = self.filename)
+        self._dirty = True
+        if self._pending is None:
+            self._pending = asyncio.create_task(self._save_later())
+
+    async def _save_later(self):
+        await asyncio.sleep(config_store.SAVE_DELAY)
+        # changes from here on schedule another write
+        self._pending = None
+        try:
+            await self._write()
+        except Exception as e:
+            print(f'Failed to save {self.filename}, will retry with the next change: {e}')
+
+    async def flush(self):
+        if self._pending is not None:
+            self._pending.cancel()
+            self._pending = None
+        await self._write()
+
+    async def _write(self):
+        async with self._write_lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            try:
+                await self.run_blocking(_update_file, self.filename, _sections(self.parser), self.parser.optionxform)
+            except BaseException:
+                self._dirty = True
+                raise
+            self.modified = _modified(self.filename)
+            config_writes.inc(file = self.filename)
+
+    def start(self):
+        if self._watcher is None:
+            self._watcher = asyncio.create_task(self._watch())
+
+    def stop(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+            self._watcher = None
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(config_store.WATCH_INTERVAL)
+            self.reload()
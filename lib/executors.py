@@ -0,0 +1,74 @@
+# Thread and process pools for work that would block the event loop
+# Copyright (C) 2024 adversarial
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# ModuleBot owns one executor_pool, cogs reach it through bot.run_blocking() and bot.run_cpu():
+#   chain = await self.bot.run_blocking(json.load, file)      # file and other blocking I/O, thread pool
+#   text = await self.bot.run_cpu(transform, text)            # CPU heavy and picklable, process pool
+# With 0 processes run_cpu falls back to the thread pool.
+# Worker processes are started with forkserver (spawn where there is none) rather than forked from a process
+# that already runs threads, they import the job's module fresh and main.py only as __mp_main__.
+# Jobs waiting and running per pool are exported as the executor_queue_depth gauge, with wait and run times.
+
+import asyncio
+import concurrent.futures
+import multiprocessing
+import time
+
+from lib.metrics import registry
+
+executor_queue_depth = registry.gauge('executor_queue_depth', 'Jobs submitted and not yet finished, by pool.')
+executor_wait_seconds = registry.histogram('executor_wait_seconds', 'Time jobs waited for a free worker, by pool.')
+executor_run_seconds = registry.histogram('executor_run_seconds', 'Time jobs ran in a worker, by pool.')
+
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+# runs in the worker, returns when the job started so the wait can be measured
+def _timed_call(func, args, kwargs):
+    started = time.perf_counter()
+    return started, func(*args, **kwargs)
+
+class executor_pool:
+    def __init__(self, threads = 4, processes = 2):
+        self.threads = concurrent.futures.ThreadPoolExecutor(max_workers = threads, thread_name_prefix = 'blocking')
+        context = multiprocessing.get_context(START_METHOD)
+        self.processes = concurrent.futures.ProcessPoolExecutor(max_workers = processes, mp_context = context) if processes else None
+
+    async def _run(self, executor, pool, func, *args, **kwargs):
+        executor_queue_depth.inc(pool = pool)
+        submitted = time.perf_counter()
+        try:
+            started, result = await asyncio.get_running_loop().run_in_executor(executor, _timed_call, func, args, kwargs)
+            # perf_counter is process local, process pool jobs only report their total time
+            if pool == 'thread':
+                executor_wait_seconds.observe(started - submitted, pool = pool)
+                executor_run_seconds.observe(time.perf_counter() - started, pool = pool)
+            else:
+                executor_run_seconds.observe(time.perf_counter() - submitted, pool = pool)
+            return result
+        finally:
+            executor_queue_depth.dec(pool = pool)
+
+    # blocking I/O such as files or sqlite3, anything goes since it stays in this process
+    async def run_blocking(self, func, *args, **kwargs):
+        return await self._run(self.threads, 'thread', func, *args, **kwargs)
+
+    # CPU heavy work, func and arguments must be picklable (module level functions and plain data)
+    async def run_cpu(self, func, *args, **kwargs):
+        if self.processes is None:
+            return await self.run_blocking(func, *args, **kwargs)
+        return await self._run(self.processes, 'process', func, *args, **kwargs)
+
+    def shutdown(self):
+        self.threads.shutdown(wait = False, cancel_futures = True)
+        if self.processes is not None:
+            self.processes.shutdown(wait = False, cancel_futures = True)
@@ -0,0 +1,114 @@
+# Event loop lag monitor and slow callback detector
+# Copyright (C) 2024 adversarial
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# A task on the loop sleeps INTERVAL seconds at a time, how late it wakes up is the loop lag.
+# Each wake up is a heartbeat. A watchdog thread notices when the heartbeat is overdue by more than
+# the threshold and grabs the loop thread's stack with sys._current_frames() while it is still blocked,
+# so the report names the code that was running instead of whatever ran after it.
+# When the loop gets back to the monitor the stall is printed and kept for DevCog's status.
+#   - .start() / .stop()
+#   - .status()
+
+import asyncio
+import collections
+import datetime
+import os
+import sys
+import threading
+import time
+import traceback
+
+from lib.metrics import registry
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+loop_lag_seconds = registry.histogram('event_loop_lag_seconds', 'How late the event loop ran a timer.')
+loop_stalls = registry.counter('event_loop_stalls_total', 'Times the event loop was blocked past the slow callback threshold.')
+
+# innermost frame of this project, e.g. 'export_json (plugins/lib/markov_brain.py:455)'
+def culprit(stack: traceback.StackSummary) -> str:
+    for frame in reversed(stack):
+        path = os.path.abspath(frame.filename)
+        if path.startswith(PROJECT_ROOT) and path != os.path.abspath(__file__):
+            return f'{frame.name} ({os.path.relpath(path, PROJECT_ROOT)}:{frame.lineno})'
+    if stack:
+        return f'{stack[-1].name} ({stack[-1].filename}:{stack[-1].lineno})'
+    return 'unknown'
+
+class loop_monitor:
+    INTERVAL = 0.1
+    STACK_DEPTH = 8         # innermost frames kept with a stall
+    HISTORY = 20            # stalls kept for status
+
+    def __init__(self, threshold = 0.25):
+        self.threshold = threshold
+        self.heartbeat = time.monotonic()
+        self.lags = collections.deque(maxlen = int(60 / loop_monitor.INTERVAL))    # about the last minute
+        self.stalls = collections.deque(maxlen = loop_monitor.HISTORY)              # (datetime, seconds, culprit, stack)
+        self._captured = None       # (culprit, stack) grabbed by the watchdog during the current stall
+        self._loop_thread_id = None
+        self._task = None
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self._stopping.clear()
+        self._task = asyncio.create_task(self._run())
+        self._thread = threading.Thread(target = self._watch, name = 'loop-watchdog', daemon = True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            expected = time.monotonic() + loop_monitor.INTERVAL
+            await asyncio.sleep(loop_monitor.INTERVAL)
+            now = time.monotonic()
+            self.heartbeat = now
+            lag = max(0.0, now - expected)
+            self.lags.append(lag)
+            loop_lag_seconds.observe(lag)
+            captured, self._captured = self._captured, None
+            if lag >= self.threshold:
+                self._report(lag, captured)
+
+    # runs on its own thread, only reads the heartbeat and the loop thread's frames
+    def _watch(self):
+        while not self._stopping.wait(loop_monitor.INTERVAL / 2):
+            if self._captured is None and time.monotonic() - self.heartbeat > loop_monitor.INTERVAL + self.threshold:
+                if (frame := sys._current_frames().get(self._loop_thread_id)) is not None:
+                    stack = traceback.extract_stack(frame)
+                    self._captured = (culprit(stack), ''.join(traceback.format_list(stack[-loop_monitor.STACK_DEPTH:])))
+
+    def _report(self, lag, captured):
+        where, stack = captured or ('unknown, finished before the watchdog looked', '')
+        loop_stalls.inc()
+        self.stalls.append((datetime.datetime.now(), lag, where, stack))
+        print(f'Event loop blocked for {lag * 1000:.0f} ms in {where}')
+        if stack:
+            print(stack, end = '')
+
+    def status(self) -> str:
+        worst = max(self.lags, default = 0.0)
+        msg = f'Event loop lag: worst {worst * 1000:.0f} ms in the last minute, {len(self.stalls)} recent stalls over {self.threshold * 1000:.0f} ms\n'
+        for when, lag, where, _ in list(self.stalls)[-3:]:
+            msg += f'- {when:%H:%M:%S} blocked {lag * 1000:.0f} ms in {where}\n'
+        return msg
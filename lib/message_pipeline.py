@@ -0,0 +1,125 @@
+# Central message dispatcher with indexed subscriptions
+# Copyright (C) 2024 adversarial
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# ModuleBot owns one message_pipeline and feeds it every message, cogs subscribe instead of adding on_message listeners:
+#   self.messages = self.bot.messages.subscribe(self.process_message, name = 'MarkovCog')
+#   self.messages.add_guild(guild_id)                 # every message in the guild
+#   self.messages.add_channel(guild_id, channel_id)   # every message in the channel
+#   self.messages.add_user(guild_id, user_id)         # every message by the member
+#   self.bot.messages.unsubscribe(self.messages)      # in cog_unload
+# Scopes live in dicts keyed the same way as the message, so a message costs three lookups (guild, channel
+# and author) plus a copy of the everywhere subscriptions and one call per subscription that matches,
+# however many plugins are loaded. Bot authors and direct messages are
+# never delivered. Subscriptions made with everywhere = True get every guild message, edits = True also
+# gets the new version of edited messages.
+
+import discord
+
+import asyncio
+
+from lib.metrics import registry
+
+# shared with ModuleBot's listener timing
+listener_seconds = registry.histogram('listener_seconds', 'Event listener run time, by event and cog.')
+messages_dispatched = registry.counter('messages_dispatched_total', 'Messages delivered to subscribers, by subscriber.')
+
+class message_subscription:
+    def __init__(self, pipeline, handler, name, everywhere, edits):
+        self.pipeline = pipeline
+        self.handler = handler
+        self.name = name
+        self.everywhere = everywhere
+        self.edits = edits
+        self.keys = set()       # index keys this subscription is filed under, to unsubscribe
+
+    def _add(self, key):
+        self.keys.add(key)
+        self.pipeline.index.setdefault(key, { })[self] = None
+
+    def _remove(self, key):
+        self.keys.discard(key)
+        if (subscribers := self.pipeline.index.get(key)) is not None:
+            subscribers.pop(self, None)
+            if not subscribers:
+                del self.pipeline.index[key]
+
+    def add_guild(self, guild_id: int):
+        self._add(('guild', guild_id))
+
+    def remove_guild(self, guild_id: int):
+        self._remove(('guild', guild_id))
+
+    def add_channel(self, guild_id: int, channel_id: int):
+        self._add(('channel', guild_id, channel_id))
+
+    def remove_channel(self, guild_id: int, channel_id: int):
+        self._remove(('channel', guild_id, channel_id))
+
+    def add_user(self, guild_id: int, user_id: int):
+        self._add(('user', guild_id, user_id))
+
+    def remove_user(self, guild_id: int, user_id: int):
+        self._remove(('user', guild_id, user_id))
+
+    def clear(self):
+        for key in list(self.keys):
+            self._remove(key)
+
+class message_pipeline:
+    def __init__(self):
+        # { index key: { subscription: None } }, dicts keep subscription order
+        self.index = { }
+        self.everywhere = { }
+        self._tasks = set()
+
+    # handler(msg) is awaited for each message in the subscription's scopes
+    def subscribe(self, handler, name = None, everywhere = False, edits = False) -> message_subscription:
+        owner = type(handler.__self__).__name__ if hasattr(handler, '__self__') else handler.__module__
+        subscription = message_subscription(self, handler, name or owner, everywhere, edits)
+        if everywhere:
+            self.everywhere[subscription] = None
+        return subscription
+
+    def unsubscribe(self, subscription: message_subscription):
+        subscription.clear()
+        self.everywhere.pop(subscription, None)
+
+    def subscribers(self, msg: discord.Message) -> list:
+        if msg.guild is None or msg.author.bot:
+            return [ ]
+        found = dict(self.everywhere)
+        for key in (('guild', msg.guild.id), ('channel', msg.guild.id, msg.channel.id), ('user', msg.guild.id, msg.author.id)):
+            if (subscribers := self.index.get(key)) is not None:
+                found.update(subscribers)
+        return list(found)
+
+    # each handler runs as its own task like a listener would, so a slow one doesn't hold up the rest
+    def dispatch(self, msg: discord.Message, event = 'on_message'):
+        for subscription in self.subscribers(msg):
+            if event == 'on_message_edit' and not subscription.edits:
+                continue
+            task = asyncio.create_task(self._run(subscription, msg, event))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def dispatch_edit(self, before: discord.Message, after: discord.Message):
+        if before.content != after.content:
+            self.dispatch(after, 'on_message_edit')
+
+    async def _run(self, subscription: message_subscription, msg: discord.Message, event):
+        messages_dispatched.inc(subscriber = subscription.name)
+        try:
+            with listener_seconds.time(event = event, cog = subscription.name):
+                await subscription.handler(msg)
+        except Exception as e:
+            print(f'Message handler {subscription.name} failed on message id: {msg.id} in guild id: {msg.guild.id}: {e}')
@@ -0,0 +1,206 @@
+# Counters, latency histograms and a Prometheus text endpoint
+# Copyright (C) 2024 adversarial
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Metrics live in one process-wide registry and are created on first use by name:
+#   sends = registry.counter('discord_sends_total', 'Messages sent.')
+#   sends.inc(kind = 'reply')
+#   with registry.histogram('markov_generate_seconds', 'Generation time.').time(kind = 'speak'):
+#       await ...
+# Labels are keyword arguments. registry.render() is the Prometheus text format served by metrics_server,
+# registry.summary() is a short table for chat, slowest total time first.
+
+import asyncio
+import bisect
+import contextlib
+import functools
+import time
+
+DEFAULT_BUCKETS = ( 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0 )
+
+def _format_labels(labels: tuple, extra: str = '') -> str:
+    pairs = [ f'{k}="{v}"' for k, v in labels ] + ([ extra ] if extra else [ ])
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class counter:
+    TYPE = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = { }       # { sorted label items: value }
+
+    def inc(self, amount = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        for labels, value in self.values.items():
+            yield f'{self.name}{_format_labels(labels)} {value}'
+
+    def summarize(self):
+        for labels, value in self.values.items():
+            yield (0, f'{self.name}{_format_labels(labels)}: {value}')
+
+# a value that goes up and down, e.g. a queue depth
+class gauge(counter):
+    TYPE = 'gauge'
+
+    def set(self, value, **labels):
+        self.values[tuple(sorted(labels.items()))] = value
+
+    def dec(self, amount = 1, **labels):
+        self.inc(-amount, **labels)
+
+class histogram:
+    TYPE = 'histogram'
+
+    def __init__(self, name, help, buckets = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.values = { }       # { sorted label items: [ per bucket counts + overflow, sum, count, max ] }
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        if (entry := self.values.get(key)) is None:
+            entry = self.values[key] = [ [ 0 ] * (len(self.buckets) + 1), 0.0, 0, 0.0 ]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+        entry[3] = max(entry[3], value)
+
+    # times the block in seconds
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    # times every call of an async function
+    def timed(self, **labels):
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.time(**labels):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    # upper bound of the bucket holding quantile q
+    def _quantile(self, counts, total, q):
+        seen = 0
+        for bound, n in zip(self.buckets + (float('inf'),), counts):
+            seen += n
+            if seen >= q * total:
+                return bound
+        return float('inf')
+
+    def render(self):
+        for labels, (counts, total, count, _) in self.values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = f'le="{bound}"'
+                yield f'{self.name}_bucket{_format_labels(labels, le)} {cumulative}'
+            le = 'le="+Inf"'
+            yield f'{self.name}_bucket{_format_labels(labels, le)} {count}'
+            yield f'{self.name}_sum{_format_labels(labels)} {total}'
+            yield f'{self.name}_count{_format_labels(labels)} {count}'
+
+    def summarize(self):
+        for labels, (counts, total, count, largest) in self.values.items():
+            p50, p99 = self._quantile(counts, count, 0.5), self._quantile(counts, count, 0.99)
+            yield (total, f'{self.name}{_format_labels(labels)}: {count} in {total:.2f} s, '
+                          f'p50 <{p50 * 1000:g} ms p99 <{p99 * 1000:g} ms max {largest * 1000:.1f} ms')
+
+class metrics_registry:
+    def __init__(self):
+        self.metrics = { }
+
+    def _get(self, kind, name, help, **kwargs):
+        if (metric := self.metrics.get(name)) is None:
+            metric = self.metrics[name] = kind(name, help, **kwargs)
+        elif type(metric) is not kind:
+            raise ValueError(f'Metric {name} is already a {metric.TYPE}.')
+        return metric
+
+    def counter(self, name, help = '') -> counter:
+        return self._get(counter, name, help)
+
+    def gauge(self, name, help = '') -> gauge:
+        return self._get(gauge, name, help)
+
+    def histogram(self, name, help = '', buckets = DEFAULT_BUCKETS) -> histogram:
+        return self._get(histogram, name, help, buckets = buckets)
+
+    def render(self) -> str:
+        lines = [ ]
+        for metric in self.metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.TYPE}')
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def summary(self, limit = 25) -> str:
+        rows = sorted((row for metric in self.metrics.values() for row in metric.summarize()), key = lambda r: r[0], reverse = True)
+        return '\n'.join(text for _, text in rows[:limit]) or 'No metrics recorded yet.'
+
+registry = metrics_registry()
+
+# shared by every cog that talks to discord or sqlite
+discord_calls = registry.histogram('discord_call_seconds', 'Discord API calls made by plugins, by call.')
+sqlite_queries = registry.histogram('sqlite_query_seconds', 'SQLite statements, by statement type.')
+
+# first keyword of a statement, e.g. 'select'
+def statement_type(statement: str) -> str:
+    return statement.lstrip().split(None, 1)[0].lower() if statement.strip() else 'unknown'
+
+# serves registry.render() on GET /metrics, anything else is a 404
+class metrics_server:
+    def __init__(self, host = '127.0.0.1', port = 9100):
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        print(f'Serving metrics on http://{self.host}:{self.port}/metrics')
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = (await asyncio.wait_for(reader.readline(), 5.0)).decode('latin-1').split()
+            # headers are not needed, read them so the client sees a clean close
+            while (await asyncio.wait_for(reader.readline(), 5.0)).strip():
+                pass
+            if len(request) >= 2 and request[0] == 'GET' and request[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', registry.render()
+            else:
+                status, body = '404 Not Found', 'Not found\n'
+            body = body.encode()
+            writer.write(f'HTTP/1.1 {status}\r\n'
+                         f'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         f'Content-Length: {len(body)}\r\n'
+                         f'Connection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,90 @@
+# Startup timeline and optional startup profiler
+# Copyright (C) 2024 adversarial
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Import this first so the clock starts with the process, then wrap each startup step:
+#   with timeline.phase('import bot'):
+#       from bot import bot
+# Phases can nest or overlap (plugins load concurrently), they are listed in the order they started.
+# Use timeline.phase_once() for work in on_ready, which fires again after every reconnect.
+# timeline.finish() marks the bot ready, and when started with --profile-startup dumps a cProfile
+# of everything up to that point to PROFILE_FILE (view with python -m pstats or snakeviz).
+
+import contextlib
+import cProfile
+import sys
+import time
+
+PROFILE_FLAG = '--profile-startup'
+PROFILE_FILE = 'startup.prof'
+
+class startup_timeline:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = [ ]       # [ (name, start offset, duration or None while running) ]
+        self.ready = None       # seconds from start to ready
+        self.profiler = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        index = self.begin(name)
+        try:
+            yield
+        finally:
+            self.end(index)
+
+    # startup work that runs again on every reconnect, e.g. in on_ready, is only timed the first time
+    @contextlib.contextmanager
+    def phase_once(self, name):
+        if any(phase_name == name for phase_name, _, _ in self.phases):
+            yield
+            return
+        with self.phase(name):
+            yield
+
+    def begin(self, name) -> int:
+        self.phases.append((name, time.perf_counter() - self.start, None))
+        return len(self.phases) - 1
+
+    def end(self, index):
+        name, offset, _ = self.phases[index]
+        self.phases[index] = (name, offset, time.perf_counter() - self.start - offset)
+
+    # a step that was timed elsewhere and ended just now
+    def record(self, name, duration):
+        self.phases.append((name, time.perf_counter() - self.start - duration, duration))
+
+    # called before the config is parsed so imports are profiled too
+    def start_profile(self):
+        if PROFILE_FLAG in sys.argv and self.profiler is None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    # only the first ready counts, reconnects fire on_ready again
+    def finish(self):
+        if self.ready is not None:
+            return
+        self.ready = time.perf_counter() - self.start
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(PROFILE_FILE)
+            print(f'Wrote startup profile to {PROFILE_FILE}')
+
+    def report(self) -> str:
+        total = self.ready if self.ready is not None else time.perf_counter() - self.start
+        msg = f'Startup timeline ({total:.2f} s to {"ready" if self.ready is not None else "now"}):\n'
+        for name, offset, duration in sorted(self.phases, key = lambda p: p[1]):
+            took = f'{duration * 1000:8.1f} ms' if duration is not None else ' running'
+            msg += f'\t- {name:<32} {took} at {offset:6.2f} s\n'
+        return msg
+
+timeline = startup_timeline()
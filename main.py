@@ -11,26 +11,52 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
 
-from bot import bot
-from bot import config
+from lib.startup import timeline
 
 import logging
 import logging.handlers
+import sys
+
+from lib.cluster import cluster_filename
 
 def init_log_file():
     logging.getLogger('discord').setLevel(logging.INFO)
     logging.getLogger('discord.http').setLevel(logging.INFO)
+    # cluster workers each rotate their own log
+    log_file_name = cluster_filename(config['log_file_name'], config['cluster_id'])
     handler = logging.handlers.RotatingFileHandler(
-        filename = config['log_file_name'],
+        filename = log_file_name,
         encoding ='utf-8',
         maxBytes = 0xFFFFF,
         backupCount = 1
     )
     handler.setFormatter(logging.Formatter('[{asctime}] [{levelname:<8}] {name}: {message}', '%Y-%m-%d %H:%M:%S', style='{'))
     logging.getLogger('discord').addHandler(handler)
-    return logging.FileHandler(filename = config['log_file_name'], encoding='utf-8', mode='a')
+    return logging.FileHandler(filename = log_file_name, encoding='utf-8', mode='a')
+
+def run_cluster():
+    from lib.cluster import cluster_supervisor
+    if config['shard_count'] < config['cluster_count']:
+        sys.exit(f'shard_count ({config["shard_count"]}) must be at least processes ({config["cluster_count"]}) under [sharding].')
+    print(f'Running {config["shard_count"]} shards in {config["cluster_count"]} processes.')
+    cluster_supervisor(config['cluster_count'], [ sys.executable ] + sys.argv).run()
 
+# process pool workers (lib/executors.py) start fresh and import this file again as __mp_main__,
+# so the config and the bot are only loaded here
 if __name__ == '__main__':
-    with open('.secret', 'r') as secrets:
-        secret = secrets.readline()
-    bot.run(secret, log_handler = init_log_file(), root_logger = True)
+    timeline.start_profile()
+    with timeline.phase('import discord'):
+        import discord
+    with timeline.phase('parse config'):
+        import config as config_loader
+        config = config_loader.load()
+
+    # with more than one process this one only supervises, the workers run main.py again with --cluster
+    if config['cluster_count'] > 1 and config['cluster_id'] is None:
+        run_cluster()
+    else:
+        with timeline.phase('import bot'):
+            from bot import bot
+        with open('.secret', 'r') as secrets:
+            secret = secrets.readline()
+        bot.run(secret, log_handler = init_log_file(), root_logger = True)
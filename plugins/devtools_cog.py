@@ -16,9 +16,10 @@ from discord import app_commands
 from discord.ext import commands
 
 import datetime
-import json
-from config import config, configfile
+from config import config, store
 from lib.FancyDiscordPrompt import make_OptionPrompt
+from lib.startup import timeline
+from lib.metrics import registry
 
 
 class DevCog(commands.Cog):
@@ -37,8 +38,12 @@ class DevCog(commands.Cog):
             return f'{td.days}d:{td.seconds // 3600}h:{(td.seconds // 60)%60}m:{(td.seconds % 60)}s'        
         uptime = format_time(datetime.datetime.now() - self.bot.launch_time)
         msg =  f'Initialized as {self.bot.user} for {uptime} in {len(self.bot.guilds)} guilds:\n'
+        if (cluster_id := getattr(self.bot, 'cluster_id', None)) is not None:
+            msg = f'Cluster worker {cluster_id} with shards {self.bot.shard_ids} of {self.bot.shard_count}. ' + msg
         for s in self.bot.guilds:
             msg += f'- {s.name} ({s.member_count}) id: {s.id}\n'
+        if (monitor := getattr(self.bot, 'loop_monitor', None)) is not None:
+            msg += monitor.status()
         return msg
     
     # status ( )
@@ -48,6 +53,20 @@ class DevCog(commands.Cog):
     async def status(self, ctx):
         await ctx.channel.send(await self._status_string())
 
+    # startup ( )
+    # print how long each step of startup took
+    @commands.command(name='startup', hidden = True)
+    @commands.is_owner()
+    async def startup(self, ctx):
+        await ctx.channel.send(f'```\n{timeline.report()}```')
+
+    # metrics ( )
+    # print the busiest listeners, queries and calls
+    @commands.command(name='metrics', hidden = True)
+    @commands.is_owner()
+    async def metrics(self, ctx):
+        await ctx.channel.send(f'```\n{registry.summary()[:1900]}\n```')
+
     # globalsync ( )
     # sync all slash commands (may take up to 24 hours to propogate)
     @commands.command(name='globalsync', hidden = True)
@@ -71,10 +90,9 @@ class DevCog(commands.Cog):
     async def leaveguild(self, ctx, guild_id):
         try:
             id = int(guild_id)
-            for s in self.bot.guilds:
-                if id == s.id:
-                    await s.leave()
-                    print(f'Left guild {s.name} ({s.member_count}) id: {id} requested by {ctx.author} in {ctx.guild.name} id: {ctx.guild.id}..')
+            print(f'Leaving guild id: {id} requested by {ctx.author} in {ctx.guild.name} id: {ctx.guild.id}.')
+            # the guild may be served by another cluster worker
+            await self.bot.everywhere('leave_guild', id)
         except ValueError:
              ctx.send(f'Invalid guild ID provided.', delete_after = 15.0)
 
@@ -83,7 +101,7 @@ class DevCog(commands.Cog):
     @commands.command(name='reload_plugin', hidden = True)
     @commands.is_owner()
     async def reload_plugin(self, ctx, plugin_cog):
-        await self.bot.reload_cog(plugin_cog)
+        await self.bot.everywhere('reload_plugin', plugin_cog)
 
     async def _handle_enable_server(self, interaction: discord.Interaction):
         if await self.bot.is_owner(interaction.user):
@@ -103,18 +121,12 @@ class DevCog(commands.Cog):
             return
         guild_id = int(guild.value)
 
-        if guild_id in config['guild_blacklist']:
-            config['guild_blacklist'].remove(guild_id)
-            configfile['blacklists']['guild_ids'] = json.dumps(config['guild_blacklist'])
-            with open(config['filename'], 'w') as cfgfile:
-                configfile.write(cfgfile)
-            await interaction.followup.send(f'Removed guild {guild.label} from chatbot blacklist.', ephemeral = True)
+        if store.contains('guild_blacklist', guild_id):
+            store.remove('guild_blacklist', guild_id)
+            await interaction.followup.send(f'Removed guild {guild.label} from blacklist.', ephemeral = True)
         if config['whitelist_servers_only'] is True:
-            config['guild_whitelist'].append(guild_id)
-            configfile['whitelists']['guild_ids'] = json.dumps(config['guild_whitelist'])
-            with open(config['filename'], 'w') as cfgfile:
-                configfile.write(cfgfile)
-            await interaction.followup.send(f'Added guild {guild.label} to chatbot whitelist.', ephemeral = True)
+            store.add('guild_whitelist', guild_id)
+            await interaction.followup.send(f'Added guild {guild.label} to whitelist.', ephemeral = True)
 
     async def _handle_disable_server(self, interaction: discord.Interaction):
         if await self.bot.is_owner(interaction.user):
@@ -135,34 +147,22 @@ class DevCog(commands.Cog):
         guild_id = int(guild.value)
         guild_name = guild.label
 
-        with open(config['filename'], 'w') as cfgfile:
-            if guild_id in config['guild_blacklist']:
-                config['guild_blacklist'].remove(guild_id)
-                configfile['blacklists']['guild_ids'] = json.dumps(config['guild_blacklist'])
-                await interaction.followup.send(f'Removed guild {guild_name} from chatbot blacklist.', ephemeral = True)
-            if config['whitelist_servers_only'] is True:
-                config['guild_whitelist'].append(guild_id)
-                configfile['whitelists']['guild_ids'] = json.dumps(config['guild_whitelist'])
-                await interaction.followup.send(f'Added guild {guild_name} to chatbot whitelist.', ephemeral = True)
-            configfile.write(cfgfile)
+        if store.contains('guild_whitelist', guild_id):
+            store.remove('guild_whitelist', guild_id)
+            await interaction.followup.send(f'Removed guild {guild_name} from whitelist.', ephemeral = True)
+        store.add('guild_blacklist', guild_id)
+        await interaction.followup.send(f'Added guild {guild_name} to blacklist.', ephemeral = True)
         return guild_id, guild_name
     
     async def _handle_ban_guild(self, interaction: discord.Interaction):
         guild = await self._handle_disable_server(interaction)
         if not guild:
             return
-        guild_name = guild.label
-        guild_id = int(guild.value)
-
-        with open(config['filename'], 'w') as cfgfile:
-            config['guild_banlist'].append(guild.value)
-            configfile['banlists']['guild_ids'] = json.dumps(config['guild_banlist'])
-            
-            configfile.write(cfgfile)
+        guild_id, guild_name = guild
 
-        if (g := next(filter(lambda g: g.id == guild_id, self.bot.guilds), None)):
-            g.leave()
-            await interaction.followup.send(f'Left guild {guild_name} ({g.member_count}) id: {guild_id}.', ephemeral = True)
+        store.add('guild_banlist', guild_id)
+        await self.bot.everywhere('leave_guild', guild_id)
+        await interaction.followup.send(f'Banned guild {guild_name} id: {guild_id}.', ephemeral = True)
 
     async def _handle_unban_guild(self, interaction: discord.Interaction):
         raise NotImplementedError
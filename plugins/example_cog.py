@@ -11,7 +11,7 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
 
-from discord import app_commands, Message
+from discord import app_commands
 from discord.ext import commands
 
 
@@ -29,9 +29,5 @@ class ExampleCog(commands.Cog):
     async def helloworld(self, ctx):
         await ctx.channel.send('Hello world.')
 
-    @commands.Cog.listener()
-    async def on_message(self, msg: Message):
-        pass
-
 async def setup(bot):
     await bot.add_cog(ExampleCog(bot = bot))
@@ -17,7 +17,8 @@ from discord import app_commands
 from discord.ext import commands, tasks
 
 from lib.FancyDiscordPrompt import make_OptionPromptNoSubmit
-from plugins.lib.ify import owoifier, sfwifier, vallifier
+from plugins.lib.ify import owoifier, sfwifier, vallifier, ify_text_offloaded
+from plugins.lib.auto_ify import auto_ify_manager
 import random
 
 ###############################################################################
@@ -33,45 +34,67 @@ ifiers = [
 class IfyCog(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
+        # built once, each compiles its substitution table
+        self.ifiers = { 'owoify': owoifier(), 'sfwify': sfwifier(), 'vallify': vallifier() }
+        self.auto_ify = auto_ify_manager(bot, self.ifiers)
         self.ify_ctx_menu = app_commands.ContextMenu(name='ify', callback=self.ify_ctx_callback)
         self.bot.tree.add_command(self.ify_ctx_menu)
 
     async def cog_load(self):
-        pass
+        await self.auto_ify.init()
 
     async def cog_unload(self):
+        await self.auto_ify.close()
         self.bot.tree.remove_command(self.ify_ctx_menu)
 
+    # long texts are transformed in the bot's process pool
+    async def _ify(self, name, text, nsfw_flag):
+        return await ify_text_offloaded(self.bot.run_cpu, self.ifiers, name, text, nsfw_flag)
+
     async def ify_ctx_callback(self, interaction: discord.Interaction, msg: discord.Message):
         option = await make_OptionPromptNoSubmit(interaction, title = 'Modify text', description = f"Select a modifier for {msg.author.display_name}'s comment", options = ifiers)
         if not option:
             return
-        
-        ifier = None
-        match option.label:
-            case 'owoify':
-                ifier = owoifier()
-            case 'sfwify':
-                ifier = sfwifier()
-            case 'vallify':
-                ifier = vallifier()
-
-        await msg.reply(ifier.ify_text(msg.content, nsfw_flag = msg.channel.is_nsfw()), mention_author = False)
+
+        await msg.reply(await self._ify(option.value, msg.content, msg.channel.is_nsfw()), mention_author = False)
         await interaction.delete_original_response()
 
     ify_group = app_commands.Group(name="ify", description="Modify text.")
 
     @ify_group.command(name = "owoify", description = "OwOify text.")
     async def owoify(self, interaction: discord.Interaction, text: str):
-        await interaction.response.send_message(owoifier().ify_text(text, nsfw_flag = interaction.channel.is_nsfw()))
+        await interaction.response.send_message(await self._ify('owoify', text, interaction.channel.is_nsfw()))
 
     @ify_group.command(name = "sfwify", description = "Make text safe for work.")
     async def sfwpost(self, interaction: discord.Interaction, text: str):
-        await interaction.response.send_message(sfwifier().ify_text(text))
+        await interaction.response.send_message(await self._ify('sfwify', text, False))
 
     @ify_group.command(name='valleypost', description="e.g. 'Umm like totally that's the text sis'")
     async def queenpost(self, interaction: discord.Interaction, text: str):
-        await interaction.response.send_message(vallifier().ify_text(text, nsfw_flag = interaction.channel.is_nsfw()))
+        await interaction.response.send_message(await self._ify('vallify', text, interaction.channel.is_nsfw()))
+
+    @ify_group.command(name = "auto", description = "Automatically modify every message in this channel or server.")
+    @app_commands.choices(modifier = [ app_commands.Choice(name = "owoify", value = "owoify"),
+                                       app_commands.Choice(name = "sfwify", value = "sfwify"),
+                                       app_commands.Choice(name = "vallify", value = "vallify"),
+                                       app_commands.Choice(name = "off", value = "off") ],
+                          scope = [ app_commands.Choice(name = "channel", value = "channel"),
+                                    app_commands.Choice(name = "server", value = "server") ])
+    async def auto(self, interaction: discord.Interaction, modifier: app_commands.Choice[str], scope: app_commands.Choice[str]):
+        if interaction.guild is None:
+            await interaction.response.send_message(f'This command can only be used in a server.', ephemeral = True)
+            return
+        if not interaction.permissions.manage_channels:
+            await interaction.response.send_message(f'You need "manage channels" permissions to use this function.', ephemeral = True)
+            return
+
+        channel_id = interaction.channel.id if scope.value == 'channel' else auto_ify_manager.GUILD_WIDE
+        await self.auto_ify.set_rule(interaction.guild.id, channel_id, None if modifier.value == 'off' else modifier.value)
+        place = f'#{interaction.channel.name}' if scope.value == 'channel' else interaction.guild.name
+        if modifier.value == 'off':
+            await interaction.response.send_message(f'Turned off automatic modifying in {place}.', ephemeral = True)
+        else:
+            await interaction.response.send_message(f'Messages in {place} will now be {modifier.value.removesuffix("ify")}ified.', ephemeral = True)
 
 async def setup(bot: commands.Bot):
     await bot.add_cog(IfyCog(bot = bot))
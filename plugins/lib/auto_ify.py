@@ -0,0 +1,154 @@
+# Automatic text modifier rules
+# Copyright (C) 2024 adversarial
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+#   SQLite database with columns guild id: int   \
+#                                 channel id: int -> PK, channel id GUILD_WIDE applies to every channel
+#                                 ifier: str (key of the ifiers dict, e.g. 'owoify')
+#  Rules are loaded into a dict once and each is filed as a guild or channel scope of the bot's message pipeline,
+#  so only messages in a channel with a rule are delivered.
+#  Matching messages go to a bounded queue drained by a few workers which reply with the transformed text,
+#  a bot can't edit another user's message so the original is left in place.
+#  When the queue is full messages are dropped instead of piling up. Long texts are transformed in the bot's process pool.
+#   - .set_rule(guild_id, channel_id, ifier_name)
+#   - .process_message(msg)
+
+import discord
+from discord.ext import commands
+
+import aiosqlite, asyncio
+
+from plugins.lib.ify import ify_text_offloaded
+from lib.metrics import discord_calls
+
+class auto_ify_manager:
+    DATABASE_FILE = 'ify.db'
+    TABLE_NAME    = 'auto_ify'
+    GUILD_WIDE    = 0
+    QUEUE_SIZE    = 100
+    WORKER_COUNT  = 2
+
+    def __init__(self, bot: commands.Bot, ifiers: dict):
+        self.bot = bot
+        self.ifiers = ifiers
+        # { (guild id, channel id): ifier name }
+        self.rules = { }
+        self.messages = bot.messages.subscribe(self.process_message, name = 'auto_ify')
+        self.queue = asyncio.Queue(maxsize = auto_ify_manager.QUEUE_SIZE)
+        self.workers = [ ]
+
+    async def init(self):
+        await self._create_table()
+        await self._load_rules()
+        self.workers = [ asyncio.create_task(self._worker()) for _ in range(auto_ify_manager.WORKER_COUNT) ]
+
+    async def close(self):
+        self.bot.messages.unsubscribe(self.messages)
+        for worker in self.workers:
+            worker.cancel()
+        self.workers.clear()
+
+    async def _create_table(self):
+
+        QUERY_CREATE_TABLE = (
+           f'CREATE TABLE IF NOT EXISTS "{auto_ify_manager.TABLE_NAME}" ('
+            'guild_id INTEGER NOT NULL, '
+            'channel_id INTEGER NOT NULL, '
+            'ifier TEXT NOT NULL, '
+            'PRIMARY KEY (guild_id, channel_id)'
+            ') WITHOUT ROWID;'
+        )
+
+        async with aiosqlite.connect(auto_ify_manager.DATABASE_FILE) as database:
+            async with database.execute(QUERY_CREATE_TABLE):
+                await database.commit()
+
+    async def _load_rules(self):
+
+        QUERY_GET_RULES = (
+            f'SELECT guild_id, channel_id, ifier FROM "{auto_ify_manager.TABLE_NAME}";'
+        )
+
+        async with aiosqlite.connect(auto_ify_manager.DATABASE_FILE) as database:
+            async with database.execute(QUERY_GET_RULES) as cursor:
+                rows = await cursor.fetchall()
+        # rules naming an ifier that no longer exists are ignored
+        self.rules = { (guild_id, channel_id): name for guild_id, channel_id, name in rows if name in self.ifiers }
+        self.messages.clear()
+        for guild_id, channel_id in self.rules:
+            self._file_rule(guild_id, channel_id)
+
+    def _file_rule(self, guild_id, channel_id):
+        if channel_id == auto_ify_manager.GUILD_WIDE:
+            self.messages.add_guild(guild_id)
+        else:
+            self.messages.add_channel(guild_id, channel_id)
+
+    # ifier_name None removes the rule
+    async def set_rule(self, guild_id: int, channel_id: int, ifier_name: str = None):
+
+        QUERY_SET_RULE = (
+            f'INSERT INTO "{auto_ify_manager.TABLE_NAME}" (guild_id, channel_id, ifier) VALUES (?, ?, ?) '
+             'ON CONFLICT(guild_id, channel_id) DO UPDATE SET ifier = excluded.ifier;'
+        ) # (guild id, channel id, ifier name)
+
+        QUERY_REMOVE_RULE = (
+            f'DELETE FROM "{auto_ify_manager.TABLE_NAME}" WHERE guild_id = ? AND channel_id = ?;'
+        ) # (guild id, channel id)
+
+        if ifier_name is not None and ifier_name not in self.ifiers:
+            raise ValueError(f'Unknown ifier {ifier_name}.')
+        async with aiosqlite.connect(auto_ify_manager.DATABASE_FILE) as database:
+            if ifier_name is None:
+                async with database.execute(QUERY_REMOVE_RULE, (guild_id, channel_id)):
+                    pass
+            else:
+                async with database.execute(QUERY_SET_RULE, (guild_id, channel_id, ifier_name)):
+                    pass
+            await database.commit()
+        if ifier_name is None:
+            self.rules.pop((guild_id, channel_id), None)
+            if channel_id == auto_ify_manager.GUILD_WIDE:
+                self.messages.remove_guild(guild_id)
+            else:
+                self.messages.remove_channel(guild_id, channel_id)
+        else:
+            self.rules[(guild_id, channel_id)] = ifier_name
+            self._file_rule(guild_id, channel_id)
+
+    # name of the ifier, a channel rule wins over the guild wide one
+    def get_ifier(self, guild_id: int, channel_id: int) -> str:
+        return self.rules.get((guild_id, channel_id)) or self.rules.get((guild_id, auto_ify_manager.GUILD_WIDE))
+
+    # only called for messages in a guild or channel with a rule
+    async def process_message(self, msg: discord.Message):
+        if not msg.content:
+            return
+        if (name := self.get_ifier(msg.guild.id, msg.channel.id)) is None:
+            return
+        try:
+            self.queue.put_nowait((name, msg))
+        except asyncio.QueueFull:
+            pass
+
+    async def _worker(self):
+        while True:
+            name, msg = await self.queue.get()
+            try:
+                text = await ify_text_offloaded(self.bot.run_cpu, self.ifiers, name, msg.content, msg.channel.is_nsfw())
+                if text and text != msg.content:
+                    with discord_calls.time(call = 'reply'):
+                        await msg.reply(text, mention_author = False)
+            except Exception as e:
+                print(f'Failed to auto ify message id: {msg.id} in guild id: {msg.guild.id}: {e}')
+            finally:
+                self.queue.task_done()
@@ -0,0 +1,85 @@
+# Rate limited queue of unprompted chatbot replies
+# Copyright (C) 2024 adversarial
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+#   Each guild gets a small bounded queue and one worker, so a busy guild can only ever have one
+#   generation running and QUEUE_SIZE waiting. Messages are dropped instead of queued when
+#     - the queue is full
+#     - their channel already has a reply waiting, or the same text is waiting
+#   The worker waits COOLDOWN seconds between replies in a guild and skips messages older than MAX_AGE.
+#   - .submit(msg)
+#   - .stop()
+
+import discord
+
+import asyncio
+import time
+import typing
+
+from lib.metrics import discord_calls
+
+class chatter_queue:
+    QUEUE_SIZE = 3
+    COOLDOWN = 15.0
+    MAX_AGE = 60.0
+
+    # generate(msg) returns the reply text or None
+    def __init__(self, generate: typing.Callable[[discord.Message], typing.Awaitable[str]]):
+        self.generate = generate
+        # { guild id: asyncio.Queue of (monotonic time, message) }
+        self.queues = { }
+        self.workers = { }
+        # { guild id: set of channel ids and texts waiting }
+        self.pending = { }
+
+    def submit(self, msg: discord.Message) -> bool:
+        guild_id = msg.guild.id
+        pending = self.pending.setdefault(guild_id, set())
+        text = msg.content.strip().lower()
+        if msg.channel.id in pending or text in pending:
+            return False
+        if (queue := self.queues.get(guild_id)) is None:
+            queue = self.queues[guild_id] = asyncio.Queue(maxsize = chatter_queue.QUEUE_SIZE)
+            self.workers[guild_id] = asyncio.create_task(self._worker(guild_id, queue, pending))
+        try:
+            queue.put_nowait((time.monotonic(), msg))
+        except asyncio.QueueFull:
+            return False
+        pending.update((msg.channel.id, text))
+        return True
+
+    def stop(self):
+        for worker in self.workers.values():
+            worker.cancel()
+        self.workers.clear()
+        self.queues.clear()
+        self.pending.clear()
+
+    # pending is this worker's own set, stop() may clear self.pending while a reply is in flight
+    async def _worker(self, guild_id, queue: asyncio.Queue, pending: set):
+        last_reply = -chatter_queue.COOLDOWN
+        while True:
+            queued, msg = await queue.get()
+            try:
+                if (wait := last_reply + chatter_queue.COOLDOWN - time.monotonic()) > 0:
+                    await asyncio.sleep(wait)
+                if time.monotonic() - queued > chatter_queue.MAX_AGE:
+                    continue
+                if (text := await self.generate(msg)):
+                    with discord_calls.time(call = 'send'):
+                        await msg.channel.send(text)
+                    last_reply = time.monotonic()
+            except Exception as e:
+                print(f'Failed to reply to message id: {msg.id} in guild id: {guild_id}: {e}')
+            finally:
+                pending.difference_update((msg.channel.id, msg.content.strip().lower()))
+                queue.task_done()
@@ -0,0 +1,118 @@
+# Batched message removal and reminders for punishments
+# Copyright (C) 2024 adversarial
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+#   Violating messages are queued per channel and flushed FLUSH_DELAY seconds after the first one arrives,
+#   so a burst costs one bulk delete instead of one delete per message.
+#   Reminders are coalesced per (guild id, user id): the first violation in a REMINDER_INTERVAL window gets
+#   one reply holding every distinct reminder of the batch, later violations in the window are only removed.
+#   - .enqueue(msg, reminders)
+#   - .stop()
+
+import discord
+from discord.ext import commands
+
+import asyncio
+import datetime
+import time
+
+from lib.metrics import discord_calls
+
+class enforcement_pipeline:
+    FLUSH_DELAY = 1.0
+    REMINDER_INTERVAL = 30.0
+    PERMISSION_NOTICE_INTERVAL = 300.0
+    # discord only bulk deletes 2 to 100 messages younger than 14 days
+    BULK_DELETE_LIMIT = 100
+    BULK_DELETE_MAX_AGE = datetime.timedelta(days = 14)
+
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+        # { channel id: ({ message id: message }, { (guild id, user id): (latest message, [ reminders ]) }) }
+        self.pending = { }
+        self.flushers = { }
+        # { (guild id, user id): monotonic time of last reminder }
+        self.last_reminded = { }
+        # { channel id: monotonic time of last missing permission notice }
+        self.last_permission_notice = { }
+
+    def enqueue(self, msg: discord.Message, reminders: list):
+        messages, replies = self.pending.setdefault(msg.channel.id, ({ }, { }))
+        messages[msg.id] = msg
+
+        key = (msg.guild.id, msg.author.id)
+        now = time.monotonic()
+        if key in replies:
+            texts = replies[key][1]
+            replies[key] = (msg, texts + [ r for r in reminders if r not in texts ])
+        elif now - self.last_reminded.get(key, -self.REMINDER_INTERVAL) >= self.REMINDER_INTERVAL:
+            self.last_reminded[key] = now
+            replies[key] = (msg, list(dict.fromkeys(reminders)))
+
+        if msg.channel.id not in self.flushers:
+            self.flushers[msg.channel.id] = asyncio.create_task(self._flush_later(msg.channel))
+
+    def stop(self):
+        for task in self.flushers.values():
+            task.cancel()
+        self.flushers.clear()
+        self.pending.clear()
+
+    async def _flush_later(self, channel):
+        await asyncio.sleep(self.FLUSH_DELAY)
+        # messages arriving while this batch is sent start the next one
+        self.flushers.pop(channel.id, None)
+        messages, replies = self.pending.pop(channel.id, ({ }, { }))
+        try:
+            await self._flush(channel, list(messages.values()), list(replies.values()))
+        except Exception as e:
+            print(f'Failed to enforce {len(messages)} messages in channel id: {channel.id}: {e}')
+
+        now = time.monotonic()
+        for key, reminded in list(self.last_reminded.items()):
+            if now - reminded >= self.REMINDER_INTERVAL:
+                del self.last_reminded[key]
+
+    async def _flush(self, channel, messages: list, replies: list):
+        # replies go out first, they would fail once their message is gone
+        for msg, texts in replies:
+            try:
+                with discord_calls.time(call = 'reply'):
+                    await msg.reply('\n'.join(texts), mention_author = False)
+            except discord.errors.NotFound:
+                pass
+
+        cutoff = discord.utils.utcnow() - self.BULK_DELETE_MAX_AGE
+        recent = [ m for m in messages if m.created_at > cutoff ]
+        single = [ m for m in messages if m.created_at <= cutoff ]
+        try:
+            for i in range(0, len(recent), self.BULK_DELETE_LIMIT):
+                if len(chunk := recent[i:i + self.BULK_DELETE_LIMIT]) > 1:
+                    with discord_calls.time(call = 'bulk_delete'):
+                        await channel.delete_messages(chunk)
+                else:
+                    single += chunk
+            for m in single:
+                try:
+                    with discord_calls.time(call = 'delete'):
+                        await m.delete()
+                except discord.errors.NotFound:
+                    pass
+        except discord.errors.Forbidden as e:
+            await self._permission_notice(channel)
+
+    async def _permission_notice(self, channel):
+        now = time.monotonic()
+        if now - self.last_permission_notice.get(channel.id, -self.PERMISSION_NOTICE_INTERVAL) < self.PERMISSION_NOTICE_INTERVAL:
+            return
+        self.last_permission_notice[channel.id] = now
+        await channel.send(f'Please grant {self.bot.user.display_name} "manage messages" permissions for this feature to function correctly.', delete_after = 30.0)
@@ -0,0 +1,87 @@
+# Deadline scheduler for timed entries such as punishments
+# Copyright (C) 2024 adversarial
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+#   Upcoming deadlines are kept in a min-heap of (endtime, key), the task sleeps until the earliest one
+#   and then calls on_expired(keys) with exactly the keys that are due.
+#   Rescheduling or cancelling a key leaves its old heap entry behind, it is skipped when popped
+#   because it no longer matches self.deadlines.
+#   - .schedule(key, endtime)
+#   - .cancel(key)
+#   - .start() / .stop()
+
+import asyncio
+import datetime
+import heapq
+import typing
+
+class expiry_scheduler:
+    # wake up at least this often so wall clock changes are noticed
+    MAX_SLEEP = 3600.0
+
+    def __init__(self, on_expired: typing.Callable[[list], typing.Awaitable]):
+        self.on_expired = on_expired
+        self.heap = [ ]
+        self.deadlines = { }
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def schedule(self, key, endtime: datetime.datetime):
+        self.deadlines[key] = endtime
+        heapq.heappush(self.heap, (endtime, key))
+        # only an earlier deadline changes how long the task should sleep
+        if self.heap[0][1] == key:
+            self._wakeup.set()
+
+    def cancel(self, key):
+        self.deadlines.pop(key, None)
+
+    def clear(self):
+        self.deadlines.clear()
+        self.heap.clear()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _pop_expired(self, now: datetime.datetime) -> list:
+        expired = [ ]
+        while self.heap and self.heap[0][0] <= now:
+            endtime, key = heapq.heappop(self.heap)
+            if self.deadlines.get(key) == endtime:
+                del self.deadlines[key]
+                expired.append(key)
+        return expired
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            now = datetime.datetime.now()
+            if (expired := self._pop_expired(now)):
+                try:
+                    await self.on_expired(expired)
+                except Exception as e:
+                    print(f'Failed to expire {len(expired)} entries: {e}')
+                continue
+            timeout = min((self.heap[0][0] - now).total_seconds(), self.MAX_SLEEP) if self.heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -11,38 +11,65 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
 
+import functools
 import random
-import queue
 import re
 import string
 
 IGNORE_NSFW_MODE = True
 
 FORBIDDEN_WORD_FILTER = [ 'https://', 'http://', '.com', '.net', '.org' ]
+FORBIDDEN_WORD_PATTERN = re.compile('|'.join(map(re.escape, FORBIDDEN_WORD_FILTER)), flags = re.IGNORECASE)
 ###############################################################################
 # text transformers
 ###############################################################################
 
-# replaces words with variable length while attempting to match case
-def replace_casefixed(old, b, text):
-    def case_fixer(match: re.Match):
-        result = ''
-        lowercount = 0
-        uppercount = 0
-        for i, c in enumerate(match.group(), start = match.start()):
-            ri = i - match.start()
-            if(ri > len(b)):
-                break
-            if c.islower():
-                lowercount += 1
-                result += b[ri].lower()
-            if c.isupper(): 
-                uppercount += 1
-                result += b[ri].upper()
-        if i - match.start() < len(b):
-            result += b[i - match.start() + 1:].lower() if lowercount > uppercount else b[i - match.start() + 1:].upper()
-        return result
-    return re.sub(old, case_fixer, text, flags = re.IGNORECASE)
+# returns new with the case of old copied letter by letter, the rest follows the case most of old is in
+# non-letters in old (e.g. a leading space) keep the character of new as is
+# matches only differ in case, so the few distinct ones are cached
+@functools.lru_cache(maxsize = 4096)
+def fix_case(old, new):
+    upper = sum(c.isupper() for c in old) > sum(c.islower() for c in old)
+    result = ''
+    for i, c in enumerate(new):
+        if i >= len(old):
+            result += c.upper() if upper else c.lower()
+        elif old[i].isupper():
+            result += c.upper()
+        elif old[i].islower():
+            result += c.lower()
+        else:
+            result += c
+    return result
+
+# every rule of a { old: new } table compiled into one case insensitive pattern, so the text is scanned once
+# however many rules there are. Longer keys are tried first so 'ab' wins over 'a' at the same position.
+# ignore is a set of whole words left as they are even though a key matches inside them, e.g. 'class'
+class casefixed_substitution:
+    WORD_PATTERN = re.compile(r'\w+')
+
+    def __init__(self, table: dict, ignore = ()):
+        self.table = { old.lower(): new for old, new in table.items() }
+        self.ignore = frozenset(word.lower() for word in ignore)
+        keys = sorted(self.table, key = len, reverse = True)
+        self.pattern = re.compile(f'({"|".join(map(re.escape, keys))})', flags = re.IGNORECASE) if keys else None
+
+    def _replace(self, match: re.Match):
+        old = match.group()
+        return fix_case(old, self.table[old.lower()])
+
+    def _replace_word(self, match: re.Match):
+        word = match.group()
+        if word.lower() in self.ignore:
+            return word
+        return self.pattern.sub(self._replace, word)
+
+    def sub(self, text):
+        if self.pattern is None:
+            return text
+        if self.ignore:
+            return casefixed_substitution.WORD_PATTERN.sub(self._replace_word, text)
+        return self.pattern.sub(self._replace, text)
 
 # removes punctuation surrounding a word and returns 3 values in order, ie: '*shouts*' -> '*', 'shouts', '*'
 def strip_surrounding_punctuation(word):
@@ -73,14 +100,82 @@ NSFW_WORD_FILTER = { 'fuck' : 'frick',
                      'penis' : 'peepee',
                      'vagina' : 'girl peepee' }
 
+# matched anywhere in a word so compounds like 'motherfucker' and 'dumbass' are caught,
+# except for the everyday words below that only happen to contain one
+NSFW_ALLOWED_WORDS = [ 'hello', 'hellos', 'shell', 'shells', 'shellfish', 'seashell', 'othello', 'hellenic',
+                       'class', 'classes', 'classic', 'classical', 'classified', 'classy', 'classroom',
+                       'pass', 'passes', 'passed', 'passing', 'passage', 'passenger', 'passengers', 'passion',
+                       'passionate', 'passive', 'passport', 'password', 'passwords', 'bypass', 'compass',
+                       'assume', 'assumed', 'assuming', 'assumption', 'assist', 'assistant', 'assistance',
+                       'assign', 'assigned', 'assignment', 'assignments', 'associate', 'associated', 'association',
+                       'assess', 'assessment', 'asset', 'assets', 'assert', 'assemble', 'assembly', 'assure',
+                       'assault', 'assassin', 'assassinate', 'embassy', 'ambassador', 'harass', 'harassment',
+                       'mass', 'masses', 'massive', 'massage', 'bass', 'brass', 'glass', 'glasses', 'grass',
+                       'lass', 'molasses', 'amass', 'crass', 'sassy', 'cassette', 'casserole', 'carcass',
+                       'trespass', 'surpass', 'morass', 'cuirass', 'assortment' ]
+NSFW_SUBSTITUTION = casefixed_substitution(NSFW_WORD_FILTER, ignore = NSFW_ALLOWED_WORDS)
 
-def filter_nsfw(word, nsfw_flag):
+def filter_nsfw(text, nsfw_flag):
     if not nsfw_flag:
-        for old, new in NSFW_WORD_FILTER.items():
-            return replace_casefixed(old, new, word)
+        return NSFW_SUBSTITUTION.sub(text)
     else:
-        return word
+        return text
         
+###############################################################################
+# pipeline stages - generators over tokens, chained by ifier.transform
+###############################################################################
+
+# endless percentile rolls in 1-100 like random.randint(1, 100), drawn from rng a batch at a time
+# a weight fires when it is greater than the roll, so 100 fires 99 times in 100 and 1 never does
+def rolls(rng: random.Random, batch = 64):
+    while True:
+        yield from rng.choices(range(1, 101), k = batch)
+
+def tokenize(text):
+    yield from text.split()
+
+# drop urls
+def filter_urls(tokens):
+    for t in tokens:
+        if not FORBIDDEN_WORD_PATTERN.search(t):
+            yield t
+
+# fuzzy replace within each token, rules starting with a space (owoifier's ' c' and ' w') never match
+# inside a token and have never fired
+def substitute(tokens, substitution: casefixed_substitution):
+    if substitution.pattern is None:
+        yield from tokens
+        return
+    for t in tokens:
+        yield substitution.sub(t)
+
+# whole word replace ignoring surrounding punctuation, weight is the percent chance per match
+def replace_words(tokens, replacements: dict, weight: int, chance):
+    for t in tokens:
+        prepunc, t_punctless, punc = strip_surrounding_punctuation(t)
+        if t_punctless in replacements and weight > next(chance):
+            t = prepunc + replacements[t_punctless] + punc
+        yield t
+
+# actions after punctuation and the last word, additions between the rest
+def add_interjections(tokens, additions: list, actions: list, addition_weight: int, action_weight: int, chance, rng: random.Random):
+    tokens = iter(tokens)
+    if (t := next(tokens, None)) is None:
+        return
+    while t is not None:
+        yield t
+        following = next(tokens, None)
+        if t[-1] in string.punctuation or following is None:
+            if actions and action_weight > next(chance):
+                yield rng.choice(actions)
+        elif additions and addition_weight > next(chance):
+            yield rng.choice(additions)
+        t = following
+
+def filter_nsfw_tokens(tokens):
+    for t in tokens:
+        yield NSFW_SUBSTITUTION.sub(t)
+
 ###############################################################################
 # super
 ###############################################################################
@@ -89,11 +184,32 @@ class ifier:
                  substring_replacements, 
                  replacements, 
                  additions, 
-                 actions):
+                 actions,
+                 seed = None):
         self.substring_replacements = substring_replacements
+        self.substitution = casefixed_substitution(substring_replacements)
         self.replacements = replacements
         self.additions = additions
         self.actions = actions
+        self.rng = random.Random(seed)
+
+    # chains the stages, override to compose a different style
+    # rolls come from a generator made per call, ifiers are shared by the executor's threads and one generator
+    # can't be advanced by two of them at once
+    def transform(self,
+                  tokens,
+                  replace_weight: int,
+                  addition_weight: int,
+                  action_weight: int,
+                  nsfw_flag: bool):
+        chance = rolls(self.rng)
+        tokens = filter_urls(tokens)
+        tokens = substitute(tokens, self.substitution)
+        tokens = replace_words(tokens, self.replacements, replace_weight, chance)
+        tokens = add_interjections(tokens, self.additions, self.actions, addition_weight, action_weight, chance, self.rng)
+        if not nsfw_flag:
+            tokens = filter_nsfw_tokens(tokens)
+        return tokens
 
     def ify_text(self,
                  text, 
@@ -105,33 +221,11 @@ class ifier:
         if IGNORE_NSFW_MODE:
             nsfw_flag = True
         
-        # transform tokens
-        transformed_string = queue.Queue()
-        tokens = text.split()
-        # ignore urls and whitespace, fuzzy and whole word replace, additions, add actions after punctuation, nsfw filter
-        for t in tokens:
-            if any(forbidden in t.lower() for forbidden in FORBIDDEN_WORD_FILTER):
-                 continue
-            
-            prepunc, t_punctless, punc = strip_surrounding_punctuation(t)
-
-            if self.substring_replacements:
-                for old, new in self.substring_replacements.items():
-                     t_punctless = replace_casefixed(old, new, t_punctless)
-            
-            if t_punctless in self.replacements:
-                t_punctless = self.replacements[t_punctless] if replace_weight > random.randint(1, 100) else t_punctless
-
-            sanitized = filter_nsfw(t_punctless, False if isinstance(self, sfwifier) else nsfw_flag)
-            transformed_string.put(prepunc + sanitized + punc)
-
-            if punc or (t is tokens[-1]):
-                if action_weight > random.randint(1, 100) and self.actions:
-                    transformed_string.put(filter_nsfw(random.choice(self.actions), nsfw_flag))
-            elif addition_weight > random.randint(1, 100) and self.additions:
-                transformed_string.put(filter_nsfw(random.choice(self.additions), nsfw_flag))
-
-        return ' '.join(transformed_string.queue)
+        return ' '.join(self.transform(tokenize(text),
+                                       replace_weight = replace_weight,
+                                       addition_weight = addition_weight,
+                                       action_weight = action_weight,
+                                       nsfw_flag = False if isinstance(self, sfwifier) else nsfw_flag))
 
 ###############################################################################
 # owoifier - makes cute w-wittwe owos
@@ -154,11 +248,12 @@ class owoifier(ifier):
     ACTIONS = [ '*snuggles*', '*bites you*', '*glomps you*', '*pounces on you*', '*blushes*',
                 '*runs away*', '*hugs you*', '*nuzzles you*', '*screams*', 'EEEEEK', '*sweats*',
                 '*licks lips*', '*glomp*', '*walks away*', '*cries*', '*twerks*', '*sees bulge*', '*notices bulge*']
-    def __init__(self):
+    def __init__(self, seed = None):
         super().__init__(substring_replacements = self.SUBSTRING_REPLACEMENTS,
                          replacements = self.REPLACEMENTS, 
                          additions = self.ADDITIONS, 
-                         actions = self.ACTIONS)
+                         actions = self.ACTIONS,
+                         seed = seed)
     def ify_text(self, text, nsfw_flag = True):
         return super().ify_text(text,
                                 replace_weight = self.REPLACE_WEIGHT, 
@@ -185,11 +280,12 @@ class vallifier(ifier):
     ADDITIONS = ['literally', 'like', 'anyways', 'like even', 'so', 'umm' ]
     ACTIONS = [ '*gags you with a spoon*', 'and that\'s the tea sis', 'and so', 'and well...',
                 'and then', 'and like', 'and totally', 'the audacity', ]
-    def __init__(self):
+    def __init__(self, seed = None):
         super().__init__(substring_replacements = self.SUBSTRING_REPLACEMENTS,
                          replacements = self.REPLACEMENTS, 
                          additions = self.ADDITIONS, 
-                         actions = self.ACTIONS)
+                         actions = self.ACTIONS,
+                         seed = seed)
     def ify_text(self, text, nsfw_flag = True):
         return super().ify_text(text, 
                                 replace_weight = self.REPLACE_WEIGHT, 
@@ -210,11 +306,12 @@ class sfwifier(ifier):
     ADDITIONS = [ ]
     ACTIONS = [ ]
 
-    def __init__(self):
+    def __init__(self, seed = None):
         super().__init__(substring_replacements = self.SUBSTRING_REPLACEMENTS,
                          replacements = self.REPLACEMENTS, 
                          additions = self.ADDITIONS, 
-                         actions = self.ACTIONS)
+                         actions = self.ACTIONS,
+                         seed = seed)
 
     def ify_text(self, text, nsfw_flag = False):
         return super().ify_text(text,
@@ -225,3 +322,25 @@ class sfwifier(ifier):
         
 ifier_list = [ owoifier(), vallifier(), sfwifier() ]
 
+###############################################################################
+# off loop helpers
+###############################################################################
+IFIER_CLASSES = { 'owoify': owoifier, 'sfwify': sfwifier, 'vallify': vallifier }
+
+# a 2000 character message takes about a millisecond, shorter ones cost less than the trip to a worker process
+OFFLOAD_LENGTH = 500
+
+# executor entry point, ifiers are looked up by name and built once per worker process, the threads of
+# the thread pool (cpu_processes = 0) share them
+_process_ifiers = { }
+def ify_text_by_name(name, text, nsfw_flag):
+    if (ify := _process_ifiers.get(name)) is None:
+        ify = _process_ifiers[name] = IFIER_CLASSES[name]()
+    return ify.ify_text(text, nsfw_flag = nsfw_flag)
+
+# ifiers is { name: ifier } for short texts, run_cpu is bot.run_cpu
+async def ify_text_offloaded(run_cpu, ifiers: dict, name, text, nsfw_flag):
+    if len(text) < OFFLOAD_LENGTH:
+        return ifiers[name].ify_text(text, nsfw_flag = nsfw_flag)
+    return await run_cpu(ify_text_by_name, name, text, nsfw_flag)
+
@@ -11,14 +11,20 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
 
+import asyncio
+import random
 import string
 import re
-import numpy
-import aiosqlite
+import time
 
 from collections import deque
 
 from plugins.lib.markov_brain import markov_brain
+from lib.metrics import registry
+
+markov_ingest_seconds = registry.histogram('markov_ingest_seconds', 'Time to learn one message.')
+markov_generate_seconds = registry.histogram('markov_generate_seconds', 'Time to generate a reply, by kind.')
+markov_pool_requests = registry.counter('markov_pool_requests_total', 'Pooled random messages asked for, by result.')
 
 # don't post urls or commands
 FORBIDDEN_WORD_FILTER = [ 'https://', 'http://', '.com', '.net', '.org' ]
@@ -47,53 +53,90 @@ def normalize_string(word):
 class markov:
     TERMINAL_PHRASE = '<stop>'
     SEPERATOR = ' '
+    DEFAULT_CHAIN_LENGTH = 2
+    MIN_CHAIN_LENGTH = 1
+    MAX_CHAIN_LENGTH = 4
+    POOL_SIZE = 5                   # ready made random messages kept per brain
+    POOL_STALE_MESSAGES = 500       # messages learned before the pool is regenerated
+    REFILL_IDLE_SECONDS = 30.0      # the pool is only refilled once the brain went this long without messages or requests
     
     def __init__(self,
                  brain: markov_brain,
-                 chain_length = 2,              # number of words in seed
+                 chain_length = DEFAULT_CHAIN_LENGTH,   # number of words in seed
                  max_output_words = 100,
-                 max_database_entries = None):
+                 max_database_entries = None,
+                 chattiness = 0):                       # percent of messages replied to
         
-        self.chattiness = 1
+        self.chattiness = chattiness
         self.brain = brain
         self.chain_length = chain_length
         self.MAX_OUTPUT_WORDS = max_output_words
         self.max_database_entries = max_database_entries
-        self.rng = numpy.random.default_rng()
+        self.rng = random.Random()
+        self.response_pool = deque()
+        self.messages_since_pool = 0
+        self._pool_generation = 0
+        self._refill_task = None
+        self.last_active = time.monotonic()
 
-    # generate lists of chain_length of sets of characters
-    # [ 'the', 'quick', 'brown', 'fox', TERMINAL_PHRASE ] -> 
+    # generate lists of up to chain_length of sets of characters, the longest context before each word
+    # the brain derives the lower orders that generation backs off to from these
+    # [ 'the', 'quick', 'brown', TERMINAL_PHRASE ] with chain_length 2 -> 
+    #       [ 'the', 'quick' ]
     #       [ 'the', 'quick', 'brown' ]
-    #       [ 'quick', 'brown', 'fox' ]
-    #       [ 'brown', 'fox', TERMINAL_PHRASE ]
+    #       [ 'quick', 'brown', TERMINAL_PHRASE ]
     def split_message(self, message):
-        if len(words := message.split()) < self.chain_length:
-            return
-        
-        words = list(map(normalize_string, words))
-        if len(words) < self.chain_length:
+        if (words := self._message_words(message)) is None:
             return
         words.append(self.TERMINAL_PHRASE)
 
-        for i in range(len(words) - self.chain_length):
-            yield words[i:i + self.chain_length + 1] # + 1 is the key
+        for i in range(1, len(words)):
+            yield words[max(i - self.chain_length, 0):i + 1] # + 1 is the key
+
+    # the same windows read backwards, TERMINAL_PHRASE marks the start of the message
+    # [ TERMINAL_PHRASE, 'the', 'quick', 'brown' ] with chain_length 2 -> 
+    #       [ TERMINAL_PHRASE, 'the', 'quick' ]
+    #       [ 'the', 'quick', 'brown' ]
+    #       [ 'quick', 'brown' ]
+    def split_message_reverse(self, message):
+        if (words := self._message_words(message)) is None:
+            return
+        words.insert(0, self.TERMINAL_PHRASE)
+
+        for i in range(len(words) - 1):
+            yield words[i:i + self.chain_length + 1] # first is the key
+
+    # messages shorter than chain_length are still learned at the orders they fill
+    def _message_words(self, message):
+        if not (words := message.split()):
+            return None
+        return list(map(normalize_string, words))
 
     # generate a dictionary entry from chain
     #   [ 'the', 'quick', 'brown', 'fox' ] -> [ 'the quick', 'brown' ], ...
     # then check if the key exists, if so add weights to values
     #   e.g. [ 'the quick', 'bird' ] ->
     #   [ 'the quick', [ ['brown', 3], ['bird', 1] ]
+    # and the same backwards for the reverse index
+    #   [ 'quick brown', 'the' ], ...
+    @markov_ingest_seconds.timed()
     async def process_message(self, message):
         for word in message.split():
              if is_bad_word(word):
                 return
             
-        async with aiosqlite.connect(self.brain.database_filename) as database:
-            for words in self.split_message(message):
-                key = self.SEPERATOR.join(words[:-1])
-                value = words[-1]
-                await self.brain._internal_add_next_state(database, key, value)
+        entries = [ (words[:-1], words[-1], 1) for words in self.split_message(message) ]
+        previous_entries = [ (words[1:], words[0], 1) for words in self.split_message_reverse(message) ]
+        if not entries:
+            return
+        async with self.brain.connect() as database:
+            await self.brain._internal_add_next_states(database, entries)
+            await self.brain._internal_add_previous_states(database, previous_entries)
             await database.commit()
+        self.last_active = time.monotonic()
+        self.messages_since_pool += 1
+        if self.messages_since_pool >= self.POOL_STALE_MESSAGES:
+            self.invalidate_pool()
 
     # Raises KeyError if seed is invalid or cannot find prompt
     # Try beginning and end of string as seed
@@ -101,82 +144,82 @@ class markov:
     # Due to circular_dict pushing out terminal strings, sometimes a KeyError may be thrown while forming
     async def generate_message(self, seed, max_words = None):
         message = seed
+        context = seed.split()
         for _ in range(max_words or self.MAX_OUTPUT_WORDS):
-            # Turn counts into probability and sample random next word
+            # Sample a random next word weighted by count from the longest known end of the last chain_length words
             # seed [ 'the quick' ], chain[seed] [ ('brown', 3), ('bird', 1) ] -> 
-            #   values [ 'brown', 'bird' ] counts [ 3, 1 ] -> p [ 0.75, 0.25 ]
-            if not (next_states := await self.brain.get_next_states(seed)):
+            #   values [ 'brown', 'bird' ] weights [ 3, 1 ] -> 'brown' 75% of the time
+            if not (next_states := await self.brain.get_next_states_backoff(context[-self.chain_length:])):
                 break
-            values, counts = map(list, zip(*next_states))
-            p = [c / sum(counts) for c in counts]
-            next_word = self.rng.choice(values, p = p)
+            values, counts = zip(*next_states)
+            next_word = self.rng.choices(values, weights = counts)[0]
             if next_word == self.TERMINAL_PHRASE:
                 break
             message += ' ' + next_word
             
             # Drop first word of key, add sampled value
-            # remove first word and append next word to form new key
             # [ 'the quick' ] [ 'brown' ] -> [ 'quick brown' ]
-            next_key = seed.split()[1:self.chain_length]
-            next_key.append(next_word)
-            seed = self.SEPERATOR.join(next_key)
+            context = (context + [ next_word ])[-self.chain_length:]
         return message
     
-    # Tries to form a prefix to a markov text chain by forming previous states - DOES NOT INCLUDE SEED to allow appending
-    # Is not the same as an actual markov chain because the previous state is randomly chosen, no weights are applied
+    # Forms a prefix to a markov text chain by walking the reverse index - DOES NOT INCLUDE SEED to allow appending
+    # Stops at the start of a message, at max_words, or when a context repeats
     async def generate_reverse_message(self, seed, max_words = 10):
-        # drop last word of key
-        # [ 'brown fox' ] [ 'brown' ] -> [ 'quick brown' ]
-        forward_seed = seed.split()[-1]
-        prompt = self.SEPERATOR.join(seed.split()[:self.chain_length - 1])
+        # sample a weighted previous word of the longest known start of the first words and prepend it
+        # [ 'lazy dog' ] [ ('the', 3), ('a', 1) ] -> [ 'the lazy dog' ]
+        context = seed.split()
         message = deque()
+        visited = set()
         for _ in range(max_words or self.MAX_OUTPUT_WORDS):
-            # Drop last word of key and try to find matching keys
-            # [ 'lazy dog' ] -> [ 'lazy' ] -> [ 'the lazy' ]
-            try:
-                prev_seed = await self.brain.get_previous_state(prompt, forward_seed, self.SEPERATOR)
-            except KeyError:
+            if (key := self.SEPERATOR.join(context[:self.chain_length])) in visited:
+                break
+            visited.add(key)
+            if not (previous_states := await self.brain.get_previous_states_backoff(context[:self.chain_length])):
                 break
-            if prev_seed == prompt: # due to no terminal at beginning this may loop infinitely, todo?
+            values, counts = zip(*previous_states)
+            previous_word = self.rng.choices(values, weights = counts)[0]
+            if previous_word == self.TERMINAL_PHRASE:
                 break
-            forward_seed = prev_seed.split()[-1]
-            prev_state = prev_seed.split()[:self.chain_length - 1]
-            message.appendleft(' '.join(prev_state))
-            prompt = self.SEPERATOR.join(prev_state)
+            message.appendleft(previous_word)
+            context = [ previous_word ] + context[:self.chain_length - 1]
         return ' '.join(message)
 
-    
+    # Ranked seed candidates for a phrase, lower is better:
+    #   exact chain_length words at the end, then the beginning, then anywhere in the phrase
+    #   seeds extending shorter runs of words, longest run first and the end of the phrase before the rest
+    #   shorter contexts that exist as seeds themselves, which generation can back off from
+    # [ 'the', 'quick', 'brown' ] with chain_length 2 ->
+    #   exact [ ('quick brown', 0), ('the quick', 1), ('brown', 5), ('quick', 6), ('the', 6) ]
+    #   prefixes [ ('brown', 3), ('quick', 4), ('the', 4) ]
+    def seed_candidates(self, words):
+        exact, prefixes = { }, { }
+        for length in range(min(len(words), self.chain_length), 0, -1):
+            for i in range(len(words) - length, -1, -1):
+                phrase = self.SEPERATOR.join(words[i:i + length])
+                if length == self.chain_length:
+                    rank = 0 if i == len(words) - length else 1 if i == 0 else 2
+                    exact.setdefault(phrase, rank)
+                else:
+                    rank = 3 + 2 * (self.chain_length - 1 - length) + (0 if i == len(words) - length else 1)
+                    prefixes.setdefault(phrase, rank)
+                    exact.setdefault(phrase, rank + 2 * (self.chain_length - 1))
+        return list(exact.items()), list(prefixes.items())
+
     # Raises KeyError if seed is invalid
-    # Turns a string into a string of self.chain_length words that is a valid seed
+    # Turns a string into a seed of up to self.chain_length words that exists in the brain, with a single query
     async def string_to_seed(self, seed):
-        seed = list(map(normalize_string, seed.split()))
+        words = [ w for w in map(normalize_string, seed.split()) if w ]
+        if not words:
+            raise KeyError(f"Invalid seed \'{seed}\' not found in chain.")
 
-        if len(seed) == self.chain_length:
-            seed = self.SEPERATOR.join(seed)
-            #if seed not in self.brain:
-            if not await self.brain.contains(seed):
-                raise KeyError(f"Invalid seed \'{seed}\' not found in chain.")
-            
-        elif len(seed) < self.chain_length:
-            seed = await self.brain.get_fuzzy_seed(self.SEPERATOR.join(seed), self.SEPERATOR)
-
-        elif len(seed) > self.chain_length:
-            # try beginning and end of string as seed
-            end_seed = self.SEPERATOR.join(seed[-self.chain_length:])
-            beg_seed = self.SEPERATOR.join(seed[:self.chain_length])
-            #if end_seed in self.brain:
-            if not await self.brain.contains(end_seed):
-                seed = end_seed
-            #elif beg_seed in self.brain:
-            if not await self.brain.contains(beg_seed):
-                seed = beg_seed
-            else:
-                raise KeyError(f"Invalid seed \'{' '.join(seed)}\' not found in chain.")
-        
-        return seed
+        exact, prefixes = self.seed_candidates(words)
+        if (result := await self.brain.resolve_seed(exact, prefixes, self.chain_length)) is None:
+            raise KeyError(f"Invalid seed \'{seed}\' not found in chain.")
+        return result
     
     # Raises KeyError if seed is invalid
     # Generates a few messages and returns the longest
+    @markov_generate_seconds.timed(kind = 'speak')
     async def speak(self, seed = None, tries = 10):
         random_seed = False
     
@@ -197,11 +240,59 @@ class markov:
                 longest_message = message
         return longest_message
 
+    # Returns a ready made random message, or None if the pool is empty, and tops the pool back up once the brain is idle
+    def take_pooled(self):
+        message = self.response_pool.popleft() if self.response_pool else None
+        markov_pool_requests.inc(result = 'hit' if message else 'miss')
+        self.last_active = time.monotonic()
+        self.schedule_refill()
+        return message
+
+    # the refill waits delay seconds, then until the brain has been idle for REFILL_IDLE_SECONDS,
+    # so generating the pool never competes with a busy channel
+    def schedule_refill(self, delay = 0.0):
+        if len(self.response_pool) < self.POOL_SIZE and (self._refill_task is None or self._refill_task.done()):
+            self._refill_task = asyncio.create_task(self._refill_pool(delay))
+
+    # call when the brain changed enough that pooled messages no longer represent it, e.g. reset or import
+    def invalidate_pool(self):
+        self._pool_generation += 1
+        self.response_pool.clear()
+        self.messages_since_pool = 0
+        self.schedule_refill()
+
+    def cancel_refill(self):
+        if self._refill_task is not None:
+            self._refill_task.cancel()
+            self._refill_task = None
+
+    async def _wait_until_idle(self):
+        while (remaining := self.last_active + self.REFILL_IDLE_SECONDS - time.monotonic()) > 0:
+            await asyncio.sleep(remaining)
+
+    async def _refill_pool(self, delay = 0.0):
+        await asyncio.sleep(delay)
+        generation = self._pool_generation
+        while len(self.response_pool) < self.POOL_SIZE:
+            await self._wait_until_idle()
+            try:
+                message = await self.speak()
+            except Exception:
+                return
+            # invalidated while generating, the message may be from the old brain
+            if generation != self._pool_generation:
+                generation = self._pool_generation
+                continue
+            if not message:
+                return
+            self.response_pool.append(message)
+
+    @markov_generate_seconds.timed(kind = 'babble')
     async def babble(self, seed, tries = 10):
         seed = await self.string_to_seed(seed.strip())
         longest_message = ''
         for _ in range(tries):
-            before_seed_amt = int(min(self.rng.random(size = 3)) * self.MAX_OUTPUT_WORDS)
+            before_seed_amt = int(min(self.rng.random() for _ in range(3)) * self.MAX_OUTPUT_WORDS)
             after_seed_amt = self.MAX_OUTPUT_WORDS - before_seed_amt
             message = await self.generate_reverse_message(seed, max_words = before_seed_amt)
             message += ' ' + await self.generate_message(seed, max_words = after_seed_amt)
@@ -215,10 +306,14 @@ class markov_trainer:
     def __init__(self, mkv: markov):
         self.markov = mkv
 
-    async def train_on_file(self, filename, max_characters = None):
+    async def train_on_file(self, filename, max_characters = None, run_blocking = asyncio.to_thread):
         if max_characters is None:
             max_characters = -1 # full file
-        with open(filename, 'r') as file:
-            for line in file.readlines(max_characters):
-                await self.mkv.process_message(line)
+        for line in await run_blocking(_read_lines, filename, max_characters):
+            await self.markov.process_message(line)
+
+# runs on a worker thread for train_on_file
+def _read_lines(filename, max_characters):
+    with open(filename, 'r') as file:
+        return file.readlines(max_characters)
 
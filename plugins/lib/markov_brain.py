@@ -14,16 +14,51 @@
 ###################################################################################
 # SQL implementation
 ###################################################################################
+# Contexts are stored as tries of words, a node is (parent_id, word) and parent_id 0 is the root.
+# Each transition is stored once, against the longest context the message had at that point,
+# and the transitions of a shorter context are the sum over its subtree. So every order up to the
+# brain's shares the same nodes and rows, and backing off is a step towards the root.
+#   next states are keyed by the context read backwards, the next lower order is the parent
+#       'the quick' -> 'brown' is stored at quick/the, 'quick' -> 'brown' is the sum under quick
+#   previous states are keyed by the words after it read forwards
+#       'quick brown' <- 'the' is stored at quick/brown, 'quick' <- 'the' is the sum under quick
 import aiosqlite
+import asyncio
 import typing
 import contextlib
 import json
-import hashlib
-import random
+import time
+import math
+
+from lib.metrics import sqlite_queries, statement_type
+
+# file halves of import_json/export_json, run on a worker thread
+def _read_json(filename):
+    with open(filename, 'r') as file:
+        return json.load(file)
+
+def _write_json(filename, data):
+    with open(filename, 'w+') as file:
+        json.dump(data, file)
+
+# weight of a transition after exponential decay, registered as the SQL function decay()
+# updated 0 means the time of the last reinforcement is unknown, those keep their count
+def decayed_count(count, updated, now, half_life):
+    if not updated:
+        return count
+    return count * 0.5 ** (max(now - updated, 0) / half_life)
+
+async def _table_exists(database, name) -> bool:
+    async with database.execute('SELECT EXISTS(SELECT 1 FROM sqlite_master WHERE type = \'table\' AND name = ?);', (name,)) as cursor:
+        return bool((await cursor.fetchone())[0])
+
+async def _table_columns(database, name) -> list:
+    async with database.execute(f'PRAGMA table_info("{name}");') as cursor:
+        return [ row[1] for row in await cursor.fetchall() ]
 
 class markov_table:
     TABLE_BASE_NAME = 'markov'
-    def __init__(self, 
+    def __init__(self,
                  id,
                  name,
                  database: aiosqlite.Connection,
@@ -34,210 +69,465 @@ class markov_table:
 
     async def _create_table(self):
         raise NotImplementedError
-    
+
     async def _drop_table_statement(self):
         async with aiosqlite.connect(self.database_filename) as database:
             async with database.execute(f'DROP TABLE "{self.name}";'):
-                await self.database.commit()
+                await database.commit()
 
     async def _reset_table(self):
         async with aiosqlite.connect(self.database_filename) as database:
             async with database.execute(f'DELETE FROM "{self.name}";'):
-                await self.database.commit()
-        
+                await database.commit()
+
+    async def count(self, database):
+        async with database.execute(f'SELECT COUNT(*) FROM "{self.name}";') as cursor:
+            return (await cursor.fetchone())[0]
+
+# a trie of contexts, reverse stores the words of a context last to first
 class seed_table(markov_table):
-    def __init__(self, 
+    def __init__(self,
                  id,
                  database: aiosqlite.Connection,
-                 database_filename: str):
-        super().__init__(id, 'seed', database, database_filename)
-
+                 database_filename: str,
+                 name = 'seed',
+                 reverse = True):
+        super().__init__(id, name, database, database_filename)
+        self.reverse = reverse
+
+    # node path of a context, from the root
+    def path(self, words) -> list:
+        return list(reversed(words)) if self.reverse else list(words)
+
+    # walk(depth, node) down the JSON path in :parameter for as long as the nodes exist
+    def walk(self, parameter = 'path'):
+        return (
+            'walk(depth, node) AS (SELECT 0, 0 UNION ALL '
+            f'SELECT walk.depth + 1, "{self.name}".rowid FROM walk JOIN "{self.name}" ON "{self.name}".parent_id = walk.node '
+            f'AND "{self.name}".word = json_extract(:{parameter}, \'$[\' || walk.depth || \']\'))'
+        )
 
-    async def contains(self, seed, database):
-        QUERY_CONTAINS_SEED = (
-            f'SELECT EXISTS(SELECT rowid FROM "{self.name}" WHERE seed = ?);'
-        ) # (seed,)
+    # rowid of the node at the JSON path in :parameter, no row if the context was never seen
+    def node_query(self, parameter = 'path'):
+        return f'WITH RECURSIVE {self.walk(parameter)} SELECT node FROM walk WHERE depth = json_array_length(:{parameter})'
+
+    # climb(node, text) from the node start selects up to the root, text is the whole context where node is 0
+    # the seperator is the one ? parameter
+    def climb(self, start):
+        text = f'climb.text || ? || "{self.name}".word' if self.reverse else f'"{self.name}".word || ? || climb.text'
+        return (
+            f'climb(node, text) AS (SELECT parent_id, word FROM "{self.name}" WHERE rowid = ({start}) UNION ALL '
+            f'SELECT "{self.name}".parent_id, {text} FROM climb JOIN "{self.name}" ON "{self.name}".rowid = climb.node)'
+        )
 
-        async with database.execute(QUERY_CONTAINS_SEED, (seed,)) as cursor:
-            return bool((await cursor.fetchone())[0])
+    # brains from before the trie layout stored whole seed strings
+    async def is_legacy(self, database) -> bool:
+        return 'seed' in await _table_columns(database, self.name)
 
     async def _create_table(self):
 
         QUERY_CREATE_SEED_TABLE = (
             f'CREATE TABLE IF NOT EXISTS "{self.name}" ('
-            'rowid INTEGER PRIMARY KEY AUTOINCREMENT, ' 
-            'seed TEXT UNIQUE'
+            'rowid INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'parent_id INTEGER NOT NULL, '      # 0 for the first word of the path
+            'word TEXT, '
+            'depth INTEGER, '                   # words in the context
+            'UNIQUE (parent_id, word)'
             ');'
         )
 
+        # contexts by their word furthest from the root, for the seed resolver
+        QUERY_CREATE_INDEXES = (
+            f'CREATE INDEX IF NOT EXISTS "{self.name}_word" ON "{self.name}" (word, depth);'
+        )
+
         async with aiosqlite.connect(self.database_filename) as database:
             async with database.execute(QUERY_CREATE_SEED_TABLE):
-                await self.database.commit()
+                pass
+            async with database.execute(QUERY_CREATE_INDEXES):
+                pass
+            await database.commit()
 
 class next_state_table(markov_table):
+    column = 'next_state'
+
     def __init__(self, id, database, database_filename, seed_table: markov_table):
         self.seed_table = seed_table
         super().__init__(id, 'next_states', database, database_filename)
-    
-    # value should be a tuple ('key', 'value')
-    # def __contains__(self, value):
-    async def contains(self, value, database):
-        QUERY_CONTAINS_NEXT_STATE = (
-            f'SELECT EXISTS(SELECT rowid FROM "{self.name}" '
-             'WHERE next_state = ? '
-            f'AND seed_id = (SELECT DISTINCT rowid FROM "{self.seed_table.name}" WHERE seed = ?));'
-        ) # (seed,)
-
-        seed, next_state = value
-        async with database.execute(QUERY_CONTAINS_NEXT_STATE, (next_state, seed)) as cursor:
-            return bool((await cursor.fetchone())[0])
-        
+
     async def _create_table(self):
 
         QUERY_CREATE_NEXT_STATE_TABLE = (
             f'CREATE TABLE IF NOT EXISTS "{self.name}" ('
              'rowid INTEGER PRIMARY KEY AUTOINCREMENT, '
-             'hash TEXT UNIQUE, '
+             'seed_id INTEGER, '
              'next_state TEXT, '
              'count INTEGER, '
-             'seed_id INTEGER, '
+             'updated INTEGER DEFAULT 0, ' # epoch seconds of last reinforcement
+             'UNIQUE (seed_id, next_state), '
             f'FOREIGN KEY (seed_id) REFERENCES "{self.seed_table.name}" (rowid)'
             ');'
         ) # .format(next_state_table, seed_table)
 
+        # count/updated decide what gets pruned first
+        QUERY_CREATE_INDEXES = (
+            f'CREATE INDEX IF NOT EXISTS "{self.name}_prune" ON "{self.name}" (count, updated); '
+            f'CREATE INDEX IF NOT EXISTS "{self.name}_updated" ON "{self.name}" (updated);'
+        )
+
         async with aiosqlite.connect(self.database_filename) as database:
             async with database.execute(QUERY_CREATE_NEXT_STATE_TABLE):
-                await database.commit()
+                pass
+            async with database.executescript(QUERY_CREATE_INDEXES):
+                pass
+            await database.commit()
+
+    # returns (rowid, seed_id) of the weakest transitions, lowest count then least recently reinforced
+    async def get_prune_candidates(self, database, limit):
+        QUERY_GET_PRUNE_CANDIDATES = (
+            f'SELECT rowid, seed_id FROM "{self.name}" ORDER BY count ASC, updated ASC LIMIT ?;'
+        ) # (limit,)
+
+        async with database.execute(QUERY_GET_PRUNE_CANDIDATES, (limit,)) as cursor:
+            return await cursor.fetchall()
+
+# reverse index of next_state_table: for a key, the words that were seen right before it
+#   'the quick brown' -> key 'quick brown' previous state 'the'
+class previous_state_table(markov_table):
+    column = 'previous_state'
+
+    def __init__(self, id, database, database_filename, seed_table: markov_table):
+        self.seed_table = seed_table
+        super().__init__(id, 'previous_states', database, database_filename)
+
+    async def _create_table(self):
+
+        QUERY_CREATE_PREVIOUS_STATE_TABLE = (
+            f'CREATE TABLE IF NOT EXISTS "{self.name}" ('
+             'rowid INTEGER PRIMARY KEY AUTOINCREMENT, '
+             'seed_id INTEGER, '
+             'previous_state TEXT, '
+             'count INTEGER, '
+             'updated INTEGER DEFAULT 0, ' # epoch seconds of last reinforcement
+             'UNIQUE (seed_id, previous_state), '
+            f'FOREIGN KEY (seed_id) REFERENCES "{self.seed_table.name}" (rowid)'
+            ');'
+        )
+
+        QUERY_CREATE_INDEXES = (
+            f'CREATE INDEX IF NOT EXISTS "{self.name}_prune" ON "{self.name}" (count, updated); '
+            f'CREATE INDEX IF NOT EXISTS "{self.name}_updated" ON "{self.name}" (updated);'
+        )
+
+        async with aiosqlite.connect(self.database_filename) as database:
+            async with database.execute(QUERY_CREATE_PREVIOUS_STATE_TABLE):
+                pass
+            async with database.executescript(QUERY_CREATE_INDEXES):
+                pass
+            await database.commit()
+
+    # returns (rowid, seed_id) of the weakest transitions, lowest count then least recently reinforced
+    async def get_prune_candidates(self, database, limit):
+        QUERY_GET_PRUNE_CANDIDATES = (
+            f'SELECT rowid, seed_id FROM "{self.name}" ORDER BY count ASC, updated ASC LIMIT ?;'
+        ) # (limit,)
+
+        async with database.execute(QUERY_GET_PRUNE_CANDIDATES, (limit,)) as cursor:
+            return await cursor.fetchall()
 
 class markov_brain:
+    # max transitions removed per prune() call so a large backlog is reclaimed over several passes
+    PRUNE_BATCH_SIZE = 5000
+    # decayed transitions weighing less than this are dropped
+    DEFAULT_DECAY_THRESHOLD = 0.1
+    # transitions moved per statement when upgrading a brain from before the trie layout
+    MIGRATE_BATCH_SIZE = 5000
+
     def __init__(self,
                  id,
                  database: aiosqlite.Connection,
                  database_filename = None,
                  max_entries = None,
+                 half_life = None,              # seconds, enables time decayed weights
+                 decay_threshold = DEFAULT_DECAY_THRESHOLD,
+                 seperator = ' ',               # between the words of imported and exported seeds
+                 terminal = '<stop>',           # the end of a message
                  copy_seed_table_name = None,
-                 copy_next_state_table_name = None):
+                 copy_next_state_table_name = None,
+                 copy_previous_seed_table_name = None,
+                 copy_previous_state_table_name = None):
         self._id = id
         self.database = database
         self.database_filename = database_filename
         self.max_entries = max_entries
+        self.half_life = half_life
+        self.decay_threshold = decay_threshold
+        self.seperator = seperator
+        self.terminal = terminal
         self._lock = contextlib.nullcontext()
 
         self.copy_seed_table_name = copy_seed_table_name
         self.copy_next_state_table_name = copy_next_state_table_name
+        self.copy_previous_seed_table_name = copy_previous_seed_table_name
+        self.copy_previous_state_table_name = copy_previous_state_table_name
 
         self.seed_table = seed_table(id, database, database_filename)
+        self.previous_seed_table = seed_table(id, database, database_filename, name = 'previous_seed', reverse = False)
         self.next_state_table = next_state_table(id, database, database_filename, self.seed_table)
+        self.previous_state_table = previous_state_table(id, database, database_filename, self.previous_seed_table)
+        # (contexts, transitions) of each direction
+        self.tables = ((self.seed_table, self.next_state_table), (self.previous_seed_table, self.previous_state_table))
 
     async def init(self):
-        await self.seed_table._create_table()
-        await self.next_state_table._create_table()
+        if self.half_life:
+            await self._register_functions(self.database)
+        legacy = await self._set_aside_legacy_tables()
+        for table in (self.seed_table, self.previous_seed_table, self.next_state_table, self.previous_state_table):
+            await table._create_table()
+        if legacy:
+            await self._migrate_legacy_tables()
         if self.copy_seed_table_name and self.copy_next_state_table_name:
-            await self._copy(self.copy_seed_table_name, self.copy_next_state_table_name)       
-    
+            await self._copy(((self.copy_seed_table_name, self.copy_next_state_table_name),
+                              (self.copy_previous_seed_table_name, self.copy_previous_state_table_name)))
+
     #def __contains__(self, seed):
     #    return seed in self.seed_table
     async def contains(self, seed):
-        return await self.seed_table.contains(seed, self.database)
+
+        QUERY_CONTAINS_SEED = (
+            f'SELECT ({self.seed_table.node_query()}) IS NOT NULL;'
+        ) # { path }
+
+        path = json.dumps(self.seed_table.path(seed.split(self.seperator)))
+        return bool((await self._execute_read(self.database, QUERY_CONTAINS_SEED, { 'path': path }))[0][0])
+
+    async def _register_functions(self, connection: aiosqlite.Connection):
+        await connection.create_function('decay', 4, decayed_count, deterministic = True)
+
+    # opens a write connection with the brain's SQL functions available
+    @contextlib.asynccontextmanager
+    async def connect(self):
+        async with aiosqlite.connect(self.database_filename) as database:
+            if self.half_life:
+                await self._register_functions(database)
+            yield database
 
     # multiple threads can use a read connection
+    @sqlite_queries.timed(statement = 'select')
     async def _execute_read(self, connection: aiosqlite.Connection, statement, args: typing.Optional[tuple] = None):
         async with connection.execute(statement, parameters = args) as cursor:
             return await cursor.fetchall()
-    
+
     # only one thread can use a write connection though
     # open a connection in the top level function and pass to here
     # call commit at end of procedure that uses this
     async def _execute_write(self, connection: aiosqlite.Connection, statement, args: typing.Optional[tuple] = None):
-        async with connection.execute(statement, parameters = args):
-            pass
-    
-    async def _copy(self, source_seed_table_name, source_next_states_table_name):
-        QUERY_COPY_SEEDS = (
-            f'INSERT INTO "{self.seed_table.name}" (seed) '
-            f'SELECT seed FROM "{source_seed_table_name}";'
-        ) 
-
-        QUERY_COPY_NEXT_STATES = (
-            f'INSERT INTO "{self.next_state_table.name}" (hash, next_state, count, seed_id) '
-            f'SELECT hash, next_state, count, seed_id FROM "{source_next_states_table_name}";'
-        )
+        with sqlite_queries.time(statement = statement_type(statement)):
+            async with connection.execute(statement, parameters = args):
+                pass
 
+    # replaces this brain's tables with copies of another's, sources are the (contexts, transitions) table
+    # names of each direction in the order of self.tables. Runs in one transaction so a copy is never half done.
+    async def _copy(self, sources):
         async with aiosqlite.connect(self.database_filename) as database:
-            async with database.executescript(f'DELETE FROM {self.seed_table.name}; DELETE FROM {self.next_state_table.name};'):
-                pass
+            for (seeds, states), (source_seeds, source_states) in zip(self.tables, sources):
+                if not (source_seeds and source_states):
+                    continue
+
+                QUERY_COPY_SEEDS = (
+                    f'INSERT INTO "{seeds.name}" (rowid, parent_id, word, depth) '
+                    f'SELECT rowid, parent_id, word, depth FROM "{source_seeds}";'
+                )
+
+                QUERY_COPY_STATES = (
+                    f'INSERT INTO "{states.name}" (seed_id, {states.column}, count, updated) '
+                    f'SELECT seed_id, {states.column}, count, updated FROM "{source_states}";'
+                )
+
+                for statement in (f'DELETE FROM "{states.name}";', f'DELETE FROM "{seeds.name}";', QUERY_COPY_SEEDS, QUERY_COPY_STATES):
+                    await self._execute_write(database, statement)
             await database.commit()
-            async with database.executescript(QUERY_COPY_SEEDS + QUERY_COPY_NEXT_STATES):
-                pass
+
+    # Brains from before the trie layout keep every context as a whole string. Their tables are renamed
+    # out of the way so the new ones can be created, then _migrate_legacy_tables moves the transitions over.
+    # Returns true if there are legacy tables to migrate, also when an earlier migration was interrupted.
+    async def _set_aside_legacy_tables(self) -> bool:
+        async with aiosqlite.connect(self.database_filename) as database:
+            if await _table_exists(database, self.seed_table.name) and await self.seed_table.is_legacy(database):
+                for table in (self.seed_table, self.next_state_table, self.previous_state_table):
+                    if await _table_exists(database, table.name):
+                        async with database.execute(f'ALTER TABLE "{table.name}" RENAME TO "{table.name}_legacy";'):
+                            pass
+                # the old indexes moved with their tables but have the names the new tables use
+                for table in (self.next_state_table, self.previous_state_table):
+                    for index in ('seed_id', 'prune', 'updated'):
+                        async with database.execute(f'DROP INDEX IF EXISTS "{table.name}_{index}";'):
+                            pass
+                await database.commit()
+            return await _table_exists(database, f'{self.seed_table.name}_legacy')
+
+    # Each legacy transition becomes a stored window of its seed and the reverse index is built from them.
+    # Rows learned before the updated column existed count as reinforced now so they don't decay at once.
+    # Runs in one transaction, an interrupted migration starts over on the next load.
+    async def _migrate_legacy_tables(self):
+        legacy_seeds = f'{self.seed_table.name}_legacy'
+        legacy_next_states = f'{self.next_state_table.name}_legacy'
+
+        QUERY_GET_LEGACY_NEXT_STATES = (
+            f'SELECT "{legacy_next_states}".rowid, seed, next_state, count, {{}} FROM "{legacy_next_states}" '
+            f'JOIN "{legacy_seeds}" ON seed_id = "{legacy_seeds}".rowid '
+            f'WHERE "{legacy_next_states}".rowid > ? ORDER BY "{legacy_next_states}".rowid LIMIT ?;'
+        ) # (last rowid, batch size)
+
+        now = int(time.time())
+        async with self.connect() as database:
+            if await _table_exists(database, legacy_next_states):
+                updated_column = 'updated' if 'updated' in await _table_columns(database, legacy_next_states) else '0'
+                last_rowid = 0
+                while (rows := await self._execute_read(database, QUERY_GET_LEGACY_NEXT_STATES.format(updated_column), (last_rowid, markov_brain.MIGRATE_BATCH_SIZE))):
+                    entries = [ (seed.split(self.seperator), value, count, updated or now) for _, seed, value, count, updated in rows if seed ]
+                    await self._insert_states(database, self.seed_table, self.next_state_table, entries)
+                    await self._insert_states(database, self.previous_seed_table, self.previous_state_table, self._reverse_entries(entries))
+                    last_rowid = rows[-1][0]
+            for name in (f'{self.previous_state_table.name}_legacy', legacy_next_states, legacy_seeds):
+                async with database.execute(f'DROP TABLE IF EXISTS "{name}";'):
+                    pass
             await database.commit()
-            
+
     async def _dbg(self):
-        print(await self._execute_read(self.database, f'SELECT rowid, seed FROM "{self.seed_table.name}";'))
-        print(await self._execute_read(self.database, f'SELECT next_state, count, seed_id FROM "{self.next_state_table.name}";'))
+        for seeds, table in self.tables:
+            print(await self._execute_read(self.database, f'SELECT rowid, parent_id, word FROM "{seeds.name}";'))
+            print(await self._execute_read(self.database, f'SELECT seed_id, {table.column}, count FROM "{table.name}";'))
 
     def id(self):
         return self._id
-    
-    def kv_hash(self, key, value):
-        return hashlib.sha3_256(bytes(f"{key}:{value}", encoding='utf8'), usedforsecurity = False).hexdigest()
+
+    # previous state entries for next state entries (words, value, count, updated), for imports and
+    # legacy brains whose messages are not known. The start of those messages is unknown too, so
+    # backward generation over them ends at the length limit or a cycle.
+    #   [ 'the', 'quick' ] -> 'brown' becomes [ 'quick', 'brown' ] <- 'the'
+    def _reverse_entries(self, entries):
+        return [ (words[1:] + ([ value ] if value != self.terminal else [ ]), words[0], count, updated)
+                 for words, value, count, updated in entries if words and (len(words) > 1 or value != self.terminal) ]
+
+    # rows is a list of (context words, state, count, updated), adds the missing nodes of each
+    # context then the transitions, with one statement per table
+    async def _insert_states(self, connection: aiosqlite.Connection, seeds: seed_table, states: markov_table, rows):
+        QUERY_ADD_SEED = (
+            f'INSERT OR IGNORE INTO "{seeds.name}" (parent_id, word, depth) '
+            f'VALUES (({seeds.node_query("parent")}), :word, :depth);'
+        ) # { parent, word, depth }
+
+        QUERY_INSERT_OR_INCREMENT_STATE = (
+            f'INSERT INTO "{states.name}" (seed_id, {states.column}, count, updated) '
+            f'VALUES (({seeds.node_query()}), :state, :count, :updated) '
+            f'ON CONFLICT(seed_id, {states.column}) '
+            'DO UPDATE SET count = count + excluded.count, updated = max(updated, excluded.updated);'
+        ) # { path, state, count, updated }
+
+        # fold the decay accumulated since the last reinforcement into the stored count
+        QUERY_INSERT_OR_INCREMENT_DECAYED_STATE = (
+            f'INSERT INTO "{states.name}" (seed_id, {states.column}, count, updated) '
+            f'VALUES (({seeds.node_query()}), :state, :count, :updated) '
+            f'ON CONFLICT(seed_id, {states.column}) '
+            f'DO UPDATE SET count = decay(count, updated, excluded.updated, {float(self.half_life or 1)}) + excluded.count, updated = max(updated, excluded.updated);'
+        ) # { path, state, count, updated }
+
+        # parents come before their children, executemany runs the rows in order
+        nodes, transitions = { }, [ ]
+        for words, state, count, updated in rows:
+            if not words:
+                continue
+            path = seeds.path(words)
+            for depth in range(len(path)):
+                nodes.setdefault((json.dumps(path[:depth]), path[depth]), depth + 1)
+            transitions.append({ 'path': json.dumps(path), 'state': state, 'count': count, 'updated': updated })
+
+        async with connection.executemany(QUERY_ADD_SEED, [ { 'parent': parent, 'word': word, 'depth': depth } for (parent, word), depth in nodes.items() ]):
+            pass
+        async with connection.executemany(QUERY_INSERT_OR_INCREMENT_DECAYED_STATE if self.half_life else QUERY_INSERT_OR_INCREMENT_STATE, transitions):
+            pass
 
     # doesn't commit to allow optimization of entering lists
     async def _internal_add_next_state(self, connection: aiosqlite.Connection, key: str, value: str, count: int = 1):
-        QUERY_ADD_SEED = (
-            f'INSERT OR IGNORE INTO "{self.seed_table.name}" (seed) VALUES (?);'
-        ) # (seed,)
-                
-        QUERY_INSERT_OR_INCREMENT_NEXT_STATE = (
-            f'INSERT INTO "{self.next_state_table.name}" (hash, next_state, count, seed_id) '
-            f'VALUES (?, ?, ?, (SELECT DISTINCT rowid FROM "{self.seed_table.name}" WHERE seed = ?)) '
-            'ON CONFLICT(hash) '
-            'DO UPDATE SET count = count + ?;'
-        ) # (hash, value, count, key, count)
-        
-        await self._execute_write(connection, QUERY_ADD_SEED, args = (key,))
-        await self._execute_write(connection, QUERY_INSERT_OR_INCREMENT_NEXT_STATE, args = (self.kv_hash(key, value), value, count, key, count))
+        await self._internal_add_next_states(connection, [ (key.split(self.seperator), value, count) ])
+
+    # entries is a list of (context words, value, count)
+    @sqlite_queries.timed(statement = 'insert')
+    async def _internal_add_next_states(self, connection: aiosqlite.Connection, entries: list):
+        now = int(time.time())
+        await self._insert_states(connection, self.seed_table, self.next_state_table, [ (words, value, count, now) for words, value, count in entries ])
+
+    # entries is a list of (following words, previous value, count)
+    @sqlite_queries.timed(statement = 'insert')
+    async def _internal_add_previous_states(self, connection: aiosqlite.Connection, entries: list):
+        now = int(time.time())
+        await self._insert_states(connection, self.previous_seed_table, self.previous_state_table, [ (words, value, count, now) for words, value, count in entries ])
 
     async def add_next_state(self, key: str, value: str, count: int = 1):
-        with aiosqlite.connect(self.database_filename) as database:
+        async with self.connect() as database:
             await self._internal_add_next_state(database, key, value, count)
             await database.commit()
-    
-    async def get_next_states(self, key):
 
-        QUERY_GET_NEXT_STATES = (
-            f'SELECT next_state, count FROM "{self.next_state_table.name}" '
-            f'WHERE seed_id = (SELECT DISTINCT rowid FROM "{self.seed_table.name}" WHERE seed = ?)'
-        ) # (seed,)
+    # (state, weight) of the longest context in words that was ever seen, in a single query
+    # however many orders there are, its weights are summed over the longer contexts under it
+    async def _get_states_backoff(self, seeds: seed_table, states: markov_table, words):
 
-        return await self._execute_read(self.database, QUERY_GET_NEXT_STATES, (key,))
-  
+        QUERY_GET_STATES_BACKOFF = (
+            f'WITH RECURSIVE {seeds.walk()}, '
+            'longest(node) AS (SELECT node FROM walk WHERE depth > 0 ORDER BY depth DESC LIMIT 1), '
+            f'subtree(node) AS (SELECT node FROM longest UNION ALL '
+            f'SELECT "{seeds.name}".rowid FROM subtree JOIN "{seeds.name}" ON "{seeds.name}".parent_id = subtree.node) '
+            f'SELECT {states.column}, SUM({{}}) FROM "{states.name}" WHERE seed_id IN (SELECT node FROM subtree) GROUP BY {states.column};'
+        ) # { path }, { path, now, half life }
+
+        args = { 'path': json.dumps(seeds.path(words)) }
+        if self.half_life:
+            args.update(now = int(time.time()), half_life = self.half_life)
+            return await self._execute_read(self.database, QUERY_GET_STATES_BACKOFF.format('decay(count, updated, :now, :half_life)'), args)
+        return await self._execute_read(self.database, QUERY_GET_STATES_BACKOFF.format('count'), args)
+
+    # words that followed the longest known end of context, with counts
+    async def get_next_states_backoff(self, context):
+        return await self._get_states_backoff(self.seed_table, self.next_state_table, context)
+
+    # words seen before the longest known start of words, with counts
+    async def get_previous_states_backoff(self, words):
+        return await self._get_states_backoff(self.previous_seed_table, self.previous_state_table, words)
 
     # import old version that used in-memory dictionary
-    async def import_json(self, filename):
-        with open(filename, 'r') as file:
-            await self.import_chain(json.load(file))
-            
-    # import old version that used in-memory dictionary
+    # run_blocking runs the file read off the event loop, pass bot.run_blocking to use the bot's pool
+    async def import_json(self, filename, run_blocking = asyncio.to_thread):
+        await self.import_chain(await run_blocking(_read_json, filename))
+
+    # import old version that used in-memory dictionary, the reverse index is built from the same transitions
+    @sqlite_queries.timed(statement = 'insert')
     async def import_chain(self, chain):
-        async with aiosqlite.connect(self.database_filename) as connection:
-            for key in chain:
-                # todo: batch add
-                for value, count in chain[key]:
-                    await self._internal_add_next_state(connection, key, value, count)
+        now = int(time.time())
+        entries = [ (key.split(self.seperator), value, count, now) for key in chain for value, count in chain[key] ]
+        async with self.connect() as connection:
+            await self._insert_states(connection, self.seed_table, self.next_state_table, entries)
+            await self._insert_states(connection, self.previous_seed_table, self.previous_state_table, self._reverse_entries(entries))
             await connection.commit()
 
-    # export old version that used in-memory dictionary
-    async def export_json(self, filename):
+    # export old version that used in-memory dictionary, the stored contexts with their own transitions
+    async def export_json(self, filename, run_blocking = asyncio.to_thread):
 
-        QUERY_GET_ALL_KEYS = f'SELECT seed FROM "{self.seed_table.name}";'
+        QUERY_GET_ALL_NEXT_STATES = (
+            f'WITH RECURSIVE texts(node, text) AS (SELECT rowid, word FROM "{self.seed_table.name}" WHERE parent_id = 0 UNION ALL '
+            f'SELECT "{self.seed_table.name}".rowid, "{self.seed_table.name}".word || ? || texts.text FROM texts '
+            f'JOIN "{self.seed_table.name}" ON "{self.seed_table.name}".parent_id = texts.node) '
+            f'SELECT text, next_state, {{}} FROM texts JOIN "{self.next_state_table.name}" ON seed_id = texts.node;'
+        ) # (seperator,), (seperator, now, half life)
 
+        if self.half_life:
+            rows = await self._execute_read(self.database, QUERY_GET_ALL_NEXT_STATES.format('decay(count, updated, ?, ?)'), (self.seperator, int(time.time()), self.half_life))
+        else:
+            rows = await self._execute_read(self.database, QUERY_GET_ALL_NEXT_STATES.format('count'), (self.seperator,))
         chain = { }
-        keys = await self._execute_read(self.database, QUERY_GET_ALL_KEYS)
-        for key in keys:
-            values = await self.get_next_states(key[0])
-            chain[key[0]] = values
-        with open(filename, 'w+') as file:
-            json.dump(chain, file)
+        for key, value, count in rows:
+            chain.setdefault(key, [ ]).append((value, count))
+        await run_blocking(_write_json, filename, chain)
 
     async def load(self):
         await self.database.rollback()
@@ -247,58 +537,159 @@ class markov_brain:
 
     async def remove(self):
         async with aiosqlite.connect(self.database_filename) as database:
-            async with database.executescript(f'DROP TABLE "{self.next_state_table.name}"; DROP TABLE "{self.seed_table.name}";'):
+            async with database.executescript(''.join(f'DROP TABLE IF EXISTS "{table.name}"; ' for pair in self.tables for table in reversed(pair))):
                 await database.commit()
 
     async def reset(self):
-        await self.seed_table._reset_table()
-        await self.next_state_table._reset_table()
+        for pair in self.tables:
+            for table in pair:
+                await table._reset_table()
+
+    async def size(self):
+        return await self.next_state_table.count(self.database)
+
+    # Evicts the weakest transitions until each transition table is within max_entries, then drops contexts left without any.
+    # At most batch_size transitions per table are removed per call, returns the number of rows reclaimed.
+    @sqlite_queries.timed(statement = 'delete')
+    async def prune(self, max_entries = None, batch_size = None):
+        max_entries = max_entries or self.max_entries
+        if not max_entries:
+            return 0
+
+        QUERY_REMOVE_STATES = (
+            'DELETE FROM "{}" WHERE rowid IN ({});'
+        ) # rowids
+
+        reclaimed = 0
+        async with aiosqlite.connect(self.database_filename) as database:
+            for seeds, table in self.tables:
+                excess = await table.count(database) - max_entries
+                if excess <= 0:
+                    continue
+                candidates = await table.get_prune_candidates(database, min(excess, batch_size or self.PRUNE_BATCH_SIZE))
+                rowids = [ c[0] for c in candidates ]
+
+                async with database.execute(QUERY_REMOVE_STATES.format(table.name, ', '.join('?' * len(rowids))), rowids) as cursor:
+                    reclaimed += cursor.rowcount
+                reclaimed += await self._remove_orphaned_seeds(database, seeds, table, list({ c[1] for c in candidates if c[1] is not None }))
+            await database.commit()
+        return reclaimed
+
+    # Removes contexts with no transitions of their own and no longer contexts under them, optionally only
+    # starting from seed_ids. Removing a node can orphan its parent, so it repeats towards the root.
+    async def _remove_orphaned_seeds(self, database, seeds: seed_table, states: markov_table, seed_ids = None):
+
+        ORPHANED = (
+            f'NOT EXISTS(SELECT 1 FROM "{states.name}" WHERE seed_id = "{seeds.name}".rowid) '
+            f'AND NOT EXISTS(SELECT 1 FROM "{seeds.name}" AS child WHERE child.parent_id = "{seeds.name}".rowid)'
+        )
+
+        QUERY_GET_ORPHANED_PARENTS = (
+            f'SELECT DISTINCT parent_id FROM "{seeds.name}" WHERE rowid IN ({{}}) AND {ORPHANED};'
+        ) # seed ids
+
+        QUERY_REMOVE_ORPHANED_SEEDS = (
+            f'DELETE FROM "{seeds.name}" WHERE {{}}{ORPHANED};'
+        ) # seed ids
+
+        reclaimed = 0
+        while seed_ids is None or seed_ids:
+            if seed_ids is None:
+                query, args = QUERY_REMOVE_ORPHANED_SEEDS.format(''), ()
+            else:
+                placeholders = ', '.join('?' * len(seed_ids))
+                parents = [ row[0] for row in await self._execute_read(database, QUERY_GET_ORPHANED_PARENTS.format(placeholders), tuple(seed_ids)) if row[0] ]
+                query, args = QUERY_REMOVE_ORPHANED_SEEDS.format(f'rowid IN ({placeholders}) AND '), tuple(seed_ids)
+            async with database.execute(query, args) as cursor:
+                removed = cursor.rowcount
+            if not removed:
+                break
+            reclaimed += removed
+            if seed_ids is not None:
+                seed_ids = parents
+        return reclaimed
+
+    # Batch pass for decay mode: drops transitions whose decayed weight fell under decay_threshold,
+    # then contexts left without transitions. Returns the number of rows reclaimed.
+    @sqlite_queries.timed(statement = 'delete')
+    async def drop_decayed(self):
+        if not self.half_life:
+            return 0
+
+        QUERY_REMOVE_DECAYED_STATES = (
+            'DELETE FROM "{}" WHERE updated > 0 AND updated < ? AND decay(count, updated, ?, ?) < ?;'
+        ) # (cutoff, now, half life, threshold)
+
+        # stored counts are at least 1, so nothing reinforced more recently than this can be under the threshold
+        # and rows with an unknown time (updated 0) never decay
+        now = int(time.time())
+        cutoff = now - self.half_life * math.log2(1 / self.decay_threshold)
+        reclaimed = 0
+        async with self.connect() as database:
+            for seeds, table in self.tables:
+                async with database.execute(QUERY_REMOVE_DECAYED_STATES.format(table.name), (cutoff, now, self.half_life, self.decay_threshold)) as cursor:
+                    removed = cursor.rowcount
+                if removed:
+                    reclaimed += removed + await self._remove_orphaned_seeds(database, seeds, table)
+            await database.commit()
+        return reclaimed
 
     async def get_random_seed(self):
 
-        QUERY_GET_RANDOM_SEED = (
-            f'SELECT seed FROM "{self.seed_table.name}" ORDER BY random() LIMIT 1;'
+        QUERY_GET_RANDOM_NODE = (
+            f'SELECT rowid FROM "{self.seed_table.name}" ORDER BY random() LIMIT 1'
         )
 
-        result = await self._execute_read(self.database, QUERY_GET_RANDOM_SEED)
-        if result is not None:
+        QUERY_GET_RANDOM_SEED = (
+            f'WITH RECURSIVE {self.seed_table.climb(QUERY_GET_RANDOM_NODE)} '
+            'SELECT text FROM climb WHERE node = 0;'
+        ) # (seperator,)
+
+        result = await self._execute_read(self.database, QUERY_GET_RANDOM_SEED, (self.seperator,))
+        if result:
             return result[0][0]
-    
-    async def get_fuzzy_seed(self, seed, seperator, is_prefix_only = False):
 
-        QUERY_GET_FUZZY_SEED = (
-            f'SELECT seed FROM "{self.seed_table.name}" WHERE seed LIKE ? ORDER BY random() LIMIT 1;'
+    # Returns the best ranked seed that exists, lowest rank first and random within a rank, or None
+    # exact:    [ (seed, rank) ] found by walking the trie from the root
+    # prefixes: [ (phrase, rank) ] matched by seeds of seed_words words that start with phrase, found by the
+    #           (word, depth) index on the phrase's first word and checked towards the root
+    async def resolve_seed(self, exact, prefixes, seed_words):
+        if not exact and not prefixes:
+            return None
+        seeds = self.seed_table.name
+
+        QUERY_EXACT_CANDIDATES = (
+            'exact_walk(rank, path, depth, node) AS (SELECT rank, path, 0, 0 FROM exact UNION ALL '
+            f'SELECT exact_walk.rank, exact_walk.path, exact_walk.depth + 1, "{seeds}".rowid FROM exact_walk '
+            f'JOIN "{seeds}" ON "{seeds}".parent_id = exact_walk.node AND "{seeds}".word = json_extract(exact_walk.path, \'$[\' || exact_walk.depth || \']\'))'
         )
 
-        if random.randint(0, 1) > 0:
-            search_str1 = seed + seperator + '_%'
-            search_str2 = '%_' + seperator + seed
-        else:
-            search_str1 = '%_' + seperator + seed
-            search_str2 = seed + seperator + '_%'
-    
-        result = await self._execute_read(self.database, QUERY_GET_FUZZY_SEED, (search_str1,))
-        if not result:
-            result = await self._execute_read(self.database, QUERY_GET_FUZZY_SEED, (search_str2,))
-            if not result:
-                raise KeyError
-        return result[0][0]
-
-    # because all seeds are unique and don't store a count this isn't an actual markov chain function
-    async def get_previous_state(self, seed, forward_seed, seperator):
-
-        QUERY_GUESS_PREVIOUS_SEED = (
-           f'SELECT rowid, seed FROM "{self.seed_table.name}" '
-            'WHERE seed LIKE ? '
-            'AND EXISTS(SELECT next_state '
-                       f'FROM "{self.next_state_table.name}" '
-                        'WHERE next_state = ? '
-                        'AND seed_id = rowid) '
-            'ORDER BY random() '
-            'LIMIT 1;'
+        QUERY_PREFIX_CANDIDATES = (
+            'prefix_climb(rank, path, depth, seed, node) AS ('
+            f'SELECT rank, path, 1, "{seeds}".rowid, "{seeds}".parent_id FROM prefix '
+            f'JOIN "{seeds}" ON "{seeds}".word = json_extract(path, \'$[0]\') AND "{seeds}".depth = ? UNION ALL '
+            f'SELECT prefix_climb.rank, prefix_climb.path, prefix_climb.depth + 1, prefix_climb.seed, "{seeds}".parent_id FROM prefix_climb '
+            f'JOIN "{seeds}" ON "{seeds}".rowid = prefix_climb.node AND "{seeds}".word = json_extract(prefix_climb.path, \'$[\' || prefix_climb.depth || \']\'))'
+        ) # (seed_words,)
+
+        ctes, selects, args = [ ], [ ], [ ]
+        if exact:
+            ctes += [ f'exact(path, rank) AS (VALUES {", ".join(["(?, ?)"] * len(exact))})', QUERY_EXACT_CANDIDATES ]
+            selects.append('SELECT node, rank FROM exact_walk WHERE depth = json_array_length(path)')
+            args += [ value for seed, rank in exact for value in (json.dumps(self.seed_table.path(seed.split(self.seperator))), rank) ]
+        if prefixes:
+            # seeds are stored first word furthest from the root, so a phrase is matched from its first word up
+            ctes += [ f'prefix(path, rank) AS (VALUES {", ".join(["(?, ?)"] * len(prefixes))})', QUERY_PREFIX_CANDIDATES ]
+            selects.append('SELECT seed, rank FROM prefix_climb WHERE depth = json_array_length(path)')
+            args += [ value for phrase, rank in prefixes for value in (json.dumps(phrase.split(self.seperator)), rank) ]
+            args.append(seed_words)
+        ctes.append(self.seed_table.climb(f'SELECT node FROM ({" UNION ALL ".join(selects)}) ORDER BY rank, random() LIMIT 1'))
+        args.append(self.seperator)
+
+        QUERY_RESOLVE_SEED = (
+            f'WITH RECURSIVE {", ".join(ctes)} '
+            'SELECT text FROM climb WHERE node = 0;'
         )
 
-        results = await self._execute_read(self.database, QUERY_GUESS_PREVIOUS_SEED, ('%_' + seperator + seed, forward_seed))
-        if not results:
-            raise KeyError
-        return results[0][1]
+        result = await self._execute_read(self.database, QUERY_RESOLVE_SEED, tuple(args))
+        return result[0][0] if result else None
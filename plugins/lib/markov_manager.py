@@ -12,19 +12,31 @@
 # GNU General Public License for more details.
 
 import aiosqlite
+import os
+import time
 from logging import log
 
 from plugins.lib.markov import markov
-from plugins.lib.markov_brain import markov_brain
+from plugins.lib.markov_brain import markov_brain, markov_table
 
 class markov_manager:
     DEFAULT_MARKOV_DB_FILE = 'markov.db'
+    SETTINGS_TABLE_NAME = 'markov_settings'
+    REFILL_STAGGER_SECONDS = 2.0        # gap between the first pool refills of brains added together, e.g. at startup
 
     def __init__(self,
-                 database_filename = DEFAULT_MARKOV_DB_FILE):
+                 database_filename = DEFAULT_MARKOV_DB_FILE,
+                 max_entries = None,
+                 half_life = None,
+                 other_database_filenames = ()):
         self.database_filename = database_filename
+        self.max_entries = max_entries      # default per-brain budget of next state rows, None for unbounded
+        self.half_life = half_life          # seconds, None keeps counts forever
+        # brain files of other processes, a brain added here that is only in one of them is moved over
+        self.other_database_filenames = [ f for f in other_database_filenames if os.path.abspath(f) != os.path.abspath(database_filename) ]
         self.database = None
         self.markovs = []
+        self._next_refill = 0.0             # monotonic time the next added brain may start its first refill
 
     def __contains__(self, id):
         return any([m.brain.id() for m in self.markovs if m.brain.id() == id]) or False
@@ -32,30 +44,199 @@ class markov_manager:
     async def connect(self):
         self.database = await aiosqlite.connect(self.database_filename)
         await self.database.set_trace_callback(log)
+        await self._create_settings_table()
+
+    # per-brain settings that outlive restarts
+    async def _create_settings_table(self):
+
+        QUERY_CREATE_SETTINGS_TABLE = (
+           f'CREATE TABLE IF NOT EXISTS "{markov_manager.SETTINGS_TABLE_NAME}" ('
+            'id INTEGER PRIMARY KEY, '
+            'chain_length INTEGER, '
+            'chattiness INTEGER DEFAULT 0'
+            ');'
+        )
+
+        async with self.database.execute(QUERY_CREATE_SETTINGS_TABLE):
+            pass
+        # tables created before chattiness was stored
+        async with self.database.execute(f'PRAGMA table_info("{markov_manager.SETTINGS_TABLE_NAME}");') as cursor:
+            if 'chattiness' not in [ row[1] for row in await cursor.fetchall() ]:
+                async with self.database.execute(f'ALTER TABLE "{markov_manager.SETTINGS_TABLE_NAME}" ADD COLUMN chattiness INTEGER DEFAULT 0;'):
+                    pass
+        await self.database.commit()
+
+    async def _get_chain_length(self, id) -> int:
+
+        QUERY_GET_CHAIN_LENGTH = (
+            f'SELECT chain_length FROM "{markov_manager.SETTINGS_TABLE_NAME}" WHERE id = ?;'
+        ) # (id,)
+
+        async with self.database.execute(QUERY_GET_CHAIN_LENGTH, (id,)) as cursor:
+            result = await cursor.fetchone()
+        return result[0] if result and result[0] else markov.DEFAULT_CHAIN_LENGTH
+
+    async def _get_chattiness(self, id) -> int:
+
+        QUERY_GET_CHATTINESS = (
+            f'SELECT chattiness FROM "{markov_manager.SETTINGS_TABLE_NAME}" WHERE id = ?;'
+        ) # (id,)
+
+        async with self.database.execute(QUERY_GET_CHATTINESS, (id,)) as cursor:
+            result = await cursor.fetchone()
+        return result[0] if result and result[0] else 0
+
+    # Raises ValueError if chattiness is not a percent
+    async def set_chattiness(self, id, chattiness: int):
+
+        QUERY_SET_CHATTINESS = (
+            f'INSERT INTO "{markov_manager.SETTINGS_TABLE_NAME}" (id, chattiness) VALUES (?, ?) '
+             'ON CONFLICT(id) DO UPDATE SET chattiness = excluded.chattiness;'
+        ) # (id, chattiness)
+
+        if chattiness not in range(0, 101):
+            raise ValueError('Chattiness must be between 0 and 100.')
+        async with self.database.execute(QUERY_SET_CHATTINESS, (id, chattiness)):
+            await self.database.commit()
+        if (m := self.get_markov(id)):
+            m.chattiness = chattiness
+
+    # Raises ValueError if chain_length is out of range
+    # Existing entries are kept, higher orders are learned from new messages and lower orders are backed off to
+    async def set_chain_length(self, id, chain_length: int):
+
+        QUERY_SET_CHAIN_LENGTH = (
+            f'INSERT INTO "{markov_manager.SETTINGS_TABLE_NAME}" (id, chain_length) VALUES (?, ?) '
+             'ON CONFLICT(id) DO UPDATE SET chain_length = excluded.chain_length;'
+        ) # (id, chain length)
+
+        if chain_length not in range(markov.MIN_CHAIN_LENGTH, markov.MAX_CHAIN_LENGTH + 1):
+            raise ValueError(f'Chain length must be between {markov.MIN_CHAIN_LENGTH} and {markov.MAX_CHAIN_LENGTH}.')
+        async with self.database.execute(QUERY_SET_CHAIN_LENGTH, (id, chain_length)):
+            await self.database.commit()
+        if (m := self.get_markov(id)):
+            m.chain_length = chain_length
+            m.invalidate_pool()
 
     async def close(self):
+        for m in self.markovs:
+            m.cancel_refill()
         await self.database.commit()
         await self.database.close()
 
     def get_markov(self, id) -> markov:
         return next(filter(lambda m: m.brain.id() == id, self.markovs), None)
 
+    # Brain tables of id in the database attached as schema
+    async def _brain_tables(self, database, schema, id) -> list:
+        prefix = f'{id}{markov_table.TABLE_BASE_NAME}'
+        async with database.execute(f'SELECT name FROM "{schema}".sqlite_master WHERE type = \'table\';') as cursor:
+            return [ name for name, in await cursor.fetchall() if name.startswith(prefix) ]
+
+    async def _columns(self, database, schema, table) -> list:
+        async with database.execute(f'PRAGMA "{schema}".table_info("{table}");') as cursor:
+            return [ row[1] for row in await cursor.fetchall() ]
+
+    # Guilds change process when processes or shard_count under [sharding] change, and their brains
+    # are left in the database of the process that served them before. Moves the brain of id and its
+    # settings here from the first of other_database_filenames that has it, in one transaction over
+    # both files. Returns true if a brain was moved.
+    async def _move_in(self, id) -> bool:
+        async with aiosqlite.connect(self.database_filename) as database:
+            if await self._brain_tables(database, 'main', id):
+                return False
+            for filename in self.other_database_filenames:
+                if not os.path.exists(filename):
+                    continue
+                async with database.execute('ATTACH DATABASE ? AS source;', (filename,)):
+                    pass
+                try:
+                    if not (tables := await self._brain_tables(database, 'source', id)):
+                        continue
+                    await self._copy_brain(database, id, tables)
+                    print(f'Moved the chatbot brain of guild id: {id} from {filename} to {self.database_filename}.')
+                    return True
+                finally:
+                    async with database.execute('DETACH DATABASE source;'):
+                        pass
+        return False
+
+    async def _copy_brain(self, database, id, tables):
+        QUERY_GET_SCHEMA = (
+            'SELECT sql FROM source.sqlite_master WHERE tbl_name = ? AND sql IS NOT NULL ORDER BY type = \'index\';'
+        ) # (table,)
+
+        async with database.execute('BEGIN;'):
+            pass
+        try:
+            for table in tables:
+                async with database.execute(QUERY_GET_SCHEMA, (table,)) as cursor:
+                    statements = [ sql for sql, in await cursor.fetchall() ]
+                for statement in statements:
+                    async with database.execute(statement):
+                        pass
+                # seed paths refer to rowids, so they are copied as they are
+                columns = ', '.join(f'"{c}"' for c in [ 'rowid' ] + [ c for c in await self._columns(database, 'source', table) if c != 'rowid' ])
+                async with database.execute(f'INSERT INTO main."{table}" ({columns}) SELECT {columns} FROM source."{table}";'):
+                    pass
+                async with database.execute(f'DROP TABLE source."{table}";'):
+                    pass
+            if (source_columns := await self._columns(database, 'source', markov_manager.SETTINGS_TABLE_NAME)):
+                columns = ', '.join(c for c in await self._columns(database, 'main', markov_manager.SETTINGS_TABLE_NAME) if c in source_columns)
+                async with database.execute(f'INSERT OR REPLACE INTO main."{markov_manager.SETTINGS_TABLE_NAME}" ({columns}) '
+                                            f'SELECT {columns} FROM source."{markov_manager.SETTINGS_TABLE_NAME}" WHERE id = ?;', (id,)):
+                    pass
+                async with database.execute(f'DELETE FROM source."{markov_manager.SETTINGS_TABLE_NAME}" WHERE id = ?;', (id,)):
+                    pass
+            await database.commit()
+        except BaseException:
+            await database.rollback()
+            raise
+
     async def add_markov(self, id, root_id = None, max_entries = None) -> markov:
         root = self.get_markov(root_id)
-        seed_table = root.brain.seed_table_name if root else None
-        next_state_table = root.brain.next_state_table_name if root else None
+        seed_table = root.brain.seed_table.name if root else None
+        next_state_table = root.brain.next_state_table.name if root else None
+        previous_seed_table = root.brain.previous_seed_table.name if root else None
+        previous_state_table = root.brain.previous_state_table.name if root else None
+
+        max_entries = max_entries or self.max_entries
 
         if id not in self:
+            if self.other_database_filenames:
+                await self._move_in(id)
             m = markov(markov_brain(id = id, 
                                         database = self.database,
                                         database_filename = self.database_filename, 
+                                        max_entries = max_entries,
+                                        half_life = self.half_life,
+                                        seperator = markov.SEPERATOR,
+                                        terminal = markov.TERMINAL_PHRASE,
                                         copy_seed_table_name = seed_table,
-                                        copy_next_state_table_name = next_state_table))
+                                        copy_next_state_table_name = next_state_table,
+                                        copy_previous_seed_table_name = previous_seed_table,
+                                        copy_previous_state_table_name = previous_state_table),
+                       chain_length = await self._get_chain_length(id),
+                       chattiness = await self._get_chattiness(id),
+                       max_database_entries = max_entries)
             await m.brain.init()
             self.markovs.append(m)
+            now = time.monotonic()
+            m.schedule_refill(delay = max(self._next_refill - now, 0.0))
+            self._next_refill = max(self._next_refill, now) + markov_manager.REFILL_STAGGER_SECONDS
         return self.get_markov(id)
     
     async def remove_brain(self, id):
         m = self.get_markov(id)
+        m.cancel_refill()
         await m.brain.remove()
-        self.markovs.remove(m)
\ No newline at end of file
+        self.markovs.remove(m)
+
+    # one incremental pruning pass over every brain with a budget or decay
+    # returns { id: rows reclaimed } for brains that shrank
+    async def prune(self) -> dict:
+        reclaimed = { }
+        for m in self.markovs:
+            if (count := await m.brain.drop_decayed() + await m.brain.prune()):
+                reclaimed[m.brain.id()] = count
+        return reclaimed
@@ -0,0 +1,329 @@
+# Shared backend for punishments - comment rules enforced on a user in a guild for a duration
+# Copyright (C) 2024 adversarial
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#   SQLite database with columns guild id: int  \
+#                                 user id: int    -> PK
+#                                 rule: str      /
+#                                 endtime: datetime (Python implemented SQLite feature)
+#                                 argument: str
+#  Rules (punishment_rule subclasses) register with the bot's punishment_engine by name.
+#  The engine keeps every active entry in memory, removes them with an expiry_scheduler when they end,
+#  and evaluates all of an author's rules in one message subscription, filed under the (guild, user) of each entry.
+#  Violations are handed to an enforcement_pipeline which batches deletes and coalesces reminders.
+#   - get_punishment_engine(bot)
+#   - .register(rule) / .unregister(rule)
+#   - .add_entry()
+
+import discord
+from discord.ext import commands
+
+import aiosqlite, asyncio, datetime
+
+from plugins.lib.enforcement import enforcement_pipeline
+from plugins.lib.expiry import expiry_scheduler
+from lib.metrics import registry
+
+punishment_check_seconds = registry.histogram('punishment_check_seconds', 'Time to check a message against its author\'s punishments.')
+punishment_violations = registry.counter('punishment_violations_total', 'Messages removed, by rule.')
+
+durations = [
+    discord.SelectOption(label = 'Remove', value = '0'),
+    discord.SelectOption(label = '1 minute', value = '1'),
+    discord.SelectOption(label = '5 minutes', value = '5'),
+    discord.SelectOption(label = '10 minutes', value = '10'),
+    discord.SelectOption(label = '15 minutes', value = '15'),
+    discord.SelectOption(label = '30 minutes', value = '30'),
+    discord.SelectOption(label = '1 hour', value = '60'),
+    discord.SelectOption(label = '2 hours', value = '120'),
+    discord.SelectOption(label = '3 hours', value = '180'),
+    discord.SelectOption(label = '6 hours', value = '360'),
+    discord.SelectOption(label = '12 hours', value = '720'),
+    discord.SelectOption(label = '1 day', value = '1440'),
+    discord.SelectOption(label = '2 days', value = '2880'),
+    discord.SelectOption(label = '3 days', value = '4320'),
+    discord.SelectOption(label = '1 week', value = '10080'),
+    discord.SelectOption(label = '2 weeks', value = '20160'),
+    discord.SelectOption(label = '1 month', value = '43200')
+]
+
+# A type of punishment, NAME is stored with each entry and argument is whatever the rule was configured with
+class punishment_rule:
+    NAME = None
+
+    # returns true if the message is allowed
+    def check(self, argument: str, text: str) -> bool:
+        raise NotImplementedError
+
+    # text sent to the author when their message is removed
+    def reminder(self, user: str, argument: str) -> str:
+        raise NotImplementedError
+
+class punishment_engine:
+    DATABASE_FILE = 'punishments.db'
+    TABLE_NAME    = 'punishments'
+
+    # tables used before rules shared one, { table: argument column }
+    LEGACY_TABLES = { 'politeness': 'phrase', 'verbosity': 'option' }
+
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+        self.rules = { }
+        # active entries { (guild id, user id): { rule: (end datetime, argument) } }, the table is only read at init
+        self.entries = { }
+        self.expiry = expiry_scheduler(self._remove_expired)
+        self.enforcement = enforcement_pipeline(bot)
+        self.messages = None
+        self._init_lock = asyncio.Lock()
+        self._initialized = False
+
+    async def register(self, rule: punishment_rule):
+        async with self._init_lock:
+            if not self._initialized:
+                await self._migrate_hashed_table()
+                await self._create_table()
+                await self._migrate_legacy_tables()
+                self.messages = self.bot.messages.subscribe(self.process_message, name = 'punishments', edits = True)
+                await self._load_entries()
+                self.expiry.start()
+                self._initialized = True
+        self.rules[rule.NAME] = rule
+
+    async def unregister(self, rule: punishment_rule):
+        self.rules.pop(rule.NAME, None)
+        if not self.rules and self._initialized:
+            self.expiry.stop()
+            self.enforcement.stop()
+            self.bot.messages.unsubscribe(self.messages)
+            self._initialized = False
+
+    async def _create_table(self):
+
+        QUERY_CREATE_TABLE = (
+           f'CREATE TABLE IF NOT EXISTS "{punishment_engine.TABLE_NAME}" ('
+            'guild_id INTEGER NOT NULL, '
+            'user_id INTEGER NOT NULL, '
+            'rule TEXT NOT NULL, '
+            'endtime TIMESTAMP, ' # python-implemented SQLite feature
+            'argument TEXT, '
+            'PRIMARY KEY (guild_id, user_id, rule)'
+            ') WITHOUT ROWID;'
+        )
+
+        QUERY_CREATE_INDEX = (
+            f'CREATE INDEX IF NOT EXISTS "{punishment_engine.TABLE_NAME}_endtime" ON "{punishment_engine.TABLE_NAME}" (endtime);'
+        )
+
+        async with aiosqlite.connect(punishment_engine.DATABASE_FILE) as database:
+            async with database.execute(QUERY_CREATE_TABLE):
+                pass
+            async with database.execute(QUERY_CREATE_INDEX):
+                await database.commit()
+
+    # rebuilds a table keyed by sha3_256(f'{user id}:{guild id}:{rule}') into the composite integer key
+    async def _migrate_hashed_table(self):
+
+        QUERY_GET_COLUMNS = (
+            f'PRAGMA table_info("{punishment_engine.TABLE_NAME}");'
+        )
+
+        QUERY_RENAME_TABLE = (
+            f'ALTER TABLE "{punishment_engine.TABLE_NAME}" RENAME TO "{punishment_engine.TABLE_NAME}_hashed";'
+        )
+
+        QUERY_COPY_ENTRIES = (
+            f'INSERT OR REPLACE INTO "{punishment_engine.TABLE_NAME}" (guild_id, user_id, rule, endtime, argument) '
+            f'SELECT guild_id, user_id, rule, endtime, argument FROM "{punishment_engine.TABLE_NAME}_hashed" ORDER BY rowid;'
+        )
+
+        QUERY_DROP_TABLE = (
+            f'DROP TABLE "{punishment_engine.TABLE_NAME}_hashed";'
+        )
+
+        async with aiosqlite.connect(punishment_engine.DATABASE_FILE) as database:
+            async with database.execute(QUERY_GET_COLUMNS) as cursor:
+                if 'hash' not in [ row[1] for row in await cursor.fetchall() ]:
+                    return
+            # the old endtime index keeps its name through the rename
+            async with database.execute(f'DROP INDEX IF EXISTS "{punishment_engine.TABLE_NAME}_endtime";'):
+                pass
+            async with database.execute(QUERY_RENAME_TABLE):
+                pass
+            await database.commit()
+        await self._create_table()
+        async with aiosqlite.connect(punishment_engine.DATABASE_FILE) as database:
+            async with database.execute(QUERY_COPY_ENTRIES):
+                pass
+            async with database.execute(QUERY_DROP_TABLE):
+                pass
+            await database.commit()
+
+    # moves entries from the per-feature tables into the shared one, the table name is the rule name
+    async def _migrate_legacy_tables(self):
+
+        QUERY_TABLE_EXISTS = (
+            "SELECT EXISTS(SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?);"
+        ) # (table,)
+
+        QUERY_ADD_ENTRY = (
+            f'INSERT OR REPLACE INTO "{punishment_engine.TABLE_NAME}" (guild_id, user_id, rule, endtime, argument) VALUES (?, ?, ?, ?, ?);'
+        ) # (guild id, user id, rule, end datetime(), argument)
+
+        async with aiosqlite.connect(punishment_engine.DATABASE_FILE) as database:
+            for table, column in punishment_engine.LEGACY_TABLES.items():
+                async with database.execute(QUERY_TABLE_EXISTS, (table,)) as cursor:
+                    if not (await cursor.fetchone())[0]:
+                        continue
+                async with database.execute(f'SELECT user_id, guild_id, endtime, {column} FROM "{table}";') as cursor:
+                    rows = await cursor.fetchall()
+                async with database.executemany(QUERY_ADD_ENTRY, [ (guild_id, user_id, table, endtime, argument)
+                                                                  for user_id, guild_id, endtime, argument in rows ]):
+                    pass
+                async with database.execute(f'DROP TABLE "{table}";'):
+                    pass
+            await database.commit()
+
+    async def _load_entries(self):
+
+        QUERY_REMOVE_EXPIRED = (
+            f'DELETE FROM "{punishment_engine.TABLE_NAME}" WHERE ? > endtime;'
+        ) # (now,)
+
+        QUERY_GET_ACTIVE = (
+            f'SELECT guild_id, user_id, rule, endtime, argument FROM "{punishment_engine.TABLE_NAME}" WHERE endtime > ?;'
+        ) # (now,)
+
+        now = datetime.datetime.now()
+        async with aiosqlite.connect(punishment_engine.DATABASE_FILE) as database:
+            async with database.execute(QUERY_REMOVE_EXPIRED, (now,)):
+                pass
+            await database.commit()
+            async with database.execute(QUERY_GET_ACTIVE, (now,)) as cursor:
+                rows = await cursor.fetchall()
+        self.entries.clear()
+        self.expiry.clear()
+        self.messages.clear()
+        for guild_id, user_id, rule, endtime, argument in rows:
+            if not isinstance(endtime, datetime.datetime):
+                endtime = datetime.datetime.fromisoformat(endtime)
+            self._remember(guild_id, user_id, rule, endtime, argument)
+
+    def _remember(self, guild_id, user_id, rule, endtime, argument):
+        self.entries.setdefault((guild_id, user_id), { })[rule] = (endtime, argument)
+        self.expiry.schedule((guild_id, user_id, rule), endtime)
+        self.messages.add_user(guild_id, user_id)
+
+    def _forget(self, guild_id, user_id, rule):
+        if (rules := self.entries.get((guild_id, user_id))) is not None:
+            rules.pop(rule, None)
+            if not rules:
+                del self.entries[(guild_id, user_id)]
+                self.messages.remove_user(guild_id, user_id)
+
+    # called by self.expiry with the (guild id, user id, rule) keys that just ended
+    async def _remove_expired(self, keys):
+
+        QUERY_REMOVE_ENTRY = (
+            f'DELETE FROM "{punishment_engine.TABLE_NAME}" WHERE guild_id = ? AND user_id = ? AND rule = ?;'
+        ) # (guild id, user id, rule)
+
+        for guild_id, user_id, rule in keys:
+            self._forget(guild_id, user_id, rule)
+        async with aiosqlite.connect(punishment_engine.DATABASE_FILE) as database:
+            async with database.executemany(QUERY_REMOVE_ENTRY, keys):
+                pass
+            await database.commit()
+
+    # a duration of 0 removes the entry
+    async def add_entry(self, rule: str, user_id: int, guild_id: int, duration: int, argument: str):
+
+        QUERY_ADD_ENTRY = (
+            f'INSERT INTO "{punishment_engine.TABLE_NAME}" (guild_id, user_id, rule, endtime, argument) VALUES (?, ?, ?, ?, ?) '
+             'ON CONFLICT(guild_id, user_id, rule) DO UPDATE SET endtime = excluded.endtime, argument = excluded.argument;'
+        ) # (guild id, user id, rule, end datetime(), argument)
+
+        QUERY_REMOVE_ENTRY = (
+            f'DELETE FROM "{punishment_engine.TABLE_NAME}" WHERE guild_id = ? AND user_id = ? AND rule = ?;'
+        ) # (guild id, user id, rule)
+
+        endtime = datetime.datetime.now() + datetime.timedelta(minutes = float(duration))
+        async with aiosqlite.connect(punishment_engine.DATABASE_FILE) as database:
+            if duration == 0:
+                async with database.execute(QUERY_REMOVE_ENTRY, (guild_id, user_id, rule)):
+                    pass
+            else:
+                async with database.execute(QUERY_ADD_ENTRY, (guild_id, user_id, rule, endtime, argument)):
+                    pass
+            await database.commit()
+        if duration == 0:
+            self._forget(guild_id, user_id, rule)
+            self.expiry.cancel((guild_id, user_id, rule))
+        else:
+            self._remember(guild_id, user_id, rule, endtime, argument)
+
+    # removes every entry, or every entry of one rule
+    async def remove_all(self, rule: str = None):
+
+        QUERY_REMOVE_ALL = (
+            f'DELETE FROM "{punishment_engine.TABLE_NAME}";'
+        )
+
+        QUERY_REMOVE_RULE = (
+            f'DELETE FROM "{punishment_engine.TABLE_NAME}" WHERE rule = ?;'
+        ) # (rule,)
+
+        async with aiosqlite.connect(punishment_engine.DATABASE_FILE) as database:
+            if rule is None:
+                async with database.execute(QUERY_REMOVE_ALL):
+                    pass
+            else:
+                async with database.execute(QUERY_REMOVE_RULE, (rule,)):
+                    pass
+            await database.commit()
+        for guild_id, user_id in list(self.entries):
+            for r in list(self.entries[(guild_id, user_id)]):
+                if rule is None or r == rule:
+                    self._forget(guild_id, user_id, r)
+                    self.expiry.cancel((guild_id, user_id, r))
+
+    # returns { rule: argument } of unexpired entries
+    def get_entries(self, user_id: int, guild_id: int) -> dict:
+        if (rules := self.entries.get((guild_id, user_id))) is None:
+            return { }
+        now = datetime.datetime.now()
+        return { rule: argument for rule, (endtime, argument) in rules.items() if endtime > now }
+
+    # evaluates every active rule of the author and queues the message once however many are broken
+    # only called for authors with an entry, new and edited messages alike
+    async def process_message(self, msg: discord.Message):
+        with punishment_check_seconds.time():
+            if not (entries := self.get_entries(msg.author.id, msg.guild.id)):
+                return
+            broken = [ (name, rule.reminder(msg.author.display_name, argument))
+                       for name, argument in entries.items()
+                       if (rule := self.rules.get(name)) is not None and not rule.check(argument, msg.content) ]
+        if not broken:
+            return
+        for name, _ in broken:
+            punishment_violations.inc(rule = name)
+        reminders = [ reminder for _, reminder in broken ]
+        self.enforcement.enqueue(msg, reminders)
+
+# one engine per bot, shared by every cog that registers a rule
+def get_punishment_engine(bot: commands.Bot) -> punishment_engine:
+    if (engine := getattr(bot, 'punishment_engine', None)) is None:
+        engine = punishment_engine(bot)
+        bot.punishment_engine = engine
+    return engine
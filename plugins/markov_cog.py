@@ -13,19 +13,36 @@
 
 import discord
 from discord import app_commands
-from discord.ext import commands
+from discord.ext import commands, tasks
 
-from configparser import ConfigParser
-import json
 import typing
 import os, pathlib
+import random
 
-from plugins.lib.markov import markov_trainer
+from plugins.lib.markov import markov, markov_trainer
 from plugins.lib.markov_manager import markov_manager
+from plugins.lib.chatter import chatter_queue
 from lib.FancyDiscordPrompt import make_ActionOptionPrompt, make_OptionPrompt, make_OptionPromptThenModal
+from lib.startup import timeline
+from lib.config_store import config_store
+from lib.cluster import cluster_filename, cluster_files
 
 MARKOV_CONFIG_FILENAME = 'markov.ini'
 
+# id lists, held as sets in mconfig
+MARKOV_CONFIG_LISTS = {
+    'guild_whitelist': ('whitelists', 'guild_ids'),
+    'user_whitelist': ('whitelists', 'user_ids'),
+    'guild_blacklist': ('blacklists', 'guild_ids'),
+    'user_blacklist': ('blacklists', 'user_ids'),
+}
+
+def _parse_markov_config(mkvcfg, mconfig):
+    mconfig['whitelist_servers_only'] = mkvcfg.getboolean('settings', 'whitelist_servers_only')
+    mconfig['whitelist_users_only'] = mkvcfg.getboolean('settings', 'whitelist_users_only')
+    mconfig['max_database_entries'] = mkvcfg.getint('settings', 'max_database_entries', fallback = 0) or None
+    mconfig['decay_half_life_days'] = mkvcfg.getfloat('settings', 'decay_half_life_days', fallback = 0) or None
+
 class discord_markov_trainer(markov_trainer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -54,18 +71,23 @@ class MarkovCog(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
 
-        self.mconfig = { }
-        self.mkvcfg = ConfigParser()
-        self.mkvcfg.read(MARKOV_CONFIG_FILENAME)
+        # reloaded in place when markov.ini changes, the pruning limits apply from the next restart
+        self.mstore = config_store(MARKOV_CONFIG_FILENAME, _parse_markov_config, MARKOV_CONFIG_LISTS, run_blocking = bot.run_blocking)
+        self.mstore.load()
+        self.mstore.on_reload.append(self._update_subscriptions)
+        self.mconfig = self.mstore.values
         self.mconfig['filename'] = MARKOV_CONFIG_FILENAME
-        self.mconfig['whitelist_servers_only'] = self.mkvcfg.getboolean('settings', 'whitelist_servers_only')
-        self.mconfig['whitelist_users_only'] = self.mkvcfg.getboolean('settings', 'whitelist_users_only')
-        self.mconfig['guild_whitelist'] = json.loads(self.mkvcfg['whitelists']['guild_ids'])
-        self.mconfig['user_whitelist'] = json.loads(self.mkvcfg['whitelists']['user_ids'])
-        self.mconfig['guild_blacklist'] = json.loads(self.mkvcfg['blacklists']['guild_ids'])
-        self.mconfig['user_blacklist'] = json.loads(self.mkvcfg['blacklists']['user_ids'])
-
-        self.manager = markov_manager()
+        self.bot.share_store('markov', self.mstore)
+
+        # a cluster worker only sees its own guilds, so it keeps their brains in its own database. Brains of guilds
+        # that came here after [sharding] changed are moved over from the database of the process that had them
+        self.manager = markov_manager(database_filename = cluster_filename(markov_manager.DEFAULT_MARKOV_DB_FILE, bot.cluster_id),
+                                      max_entries = self.mconfig['max_database_entries'],
+                                      half_life = self.mconfig['decay_half_life_days'] and self.mconfig['decay_half_life_days'] * 86400,
+                                      other_database_filenames = cluster_files(markov_manager.DEFAULT_MARKOV_DB_FILE))
+        self.chatter = chatter_queue(self._generate_reply)
+        # filed under every guild with a brain that passes server_check
+        self.messages = self.bot.messages.subscribe(self.process_message)
 
     async def interaction_check(self, interaction: discord.Interaction) -> bool:
         if await self.bot.is_owner(interaction.user) or interaction.user.id == interaction.guild.owner_id:
@@ -82,39 +104,81 @@ class MarkovCog(commands.Cog):
         return ((self.mconfig['whitelist_servers_only'] and guild_id in self.mconfig['guild_whitelist']) 
                 or guild_id not in self.mconfig['guild_blacklist'])
 
+    # called whenever a brain is added or the guild lists change
+    def _update_subscription(self, guild_id):
+        if self.server_check(guild_id) and guild_id in self.manager:
+            self.messages.add_guild(guild_id)
+        else:
+            self.messages.remove_guild(guild_id)
+
+    def _update_subscriptions(self):
+        for m in self.manager.markovs:
+            self._update_subscription(m.brain.id())
+
     async def cog_load(self):
+        self.mstore.start()
         await self.manager.connect()
+        self.prune_brains.start()
 
     async def cog_unload(self):
+        self.mstore.stop()
+        await self.mstore.flush()
+        self.bot.unshare_store('markov')
+        self.bot.messages.unsubscribe(self.messages)
+        self.chatter.stop()
+        self.prune_brains.cancel()
         await self.manager.close()
 
+    # keeps brains within max_database_entries, a few thousand rows at a time, and drops decayed entries
+    @tasks.loop(minutes = 5.0)
+    async def prune_brains(self):
+        for id, count in (await self.manager.prune()).items():
+            print(f'Pruned {count} chatbot entries from guild id: {id}.')
+
     @commands.Cog.listener()
     async def on_ready(self):
-        for g in self.bot.guilds:
-            if self.server_check(g.id):
-                await self.manager.add_markov(g.id)
+        with timeline.phase_once('chatbot brains'):
+            for g in self.bot.guilds:
+                if self.server_check(g.id):
+                    await self.manager.add_markov(g.id)
+                    self._update_subscription(g.id)
 
     @commands.Cog.listener()
     async def on_guild_join(self, guild):
         if self.server_check(guild.id):
             await self.manager.add_markov(guild.id)
+            self._update_subscription(guild.id)
 
-    # handles on_message discord loop
-    @commands.Cog.listener()
-    @commands.guild_only()
-    async def on_message(self, msg: discord.Message):
-        if msg.guild is None or msg.author.bot:
+    # messages from users in subscribed guilds
+    async def process_message(self, msg: discord.Message):
+        if (m := self.manager.get_markov(msg.guild.id)) is None:
             return
-        if self.server_check(msg.guild.id) and msg.guild.id in self.manager and not msg.author.bot:
-            await self.manager.get_markov(msg.guild.id).process_message(msg.content)
+        await m.process_message(msg.content)
+        # reply to chattiness percent of messages
+        if m.chattiness and random.random() * 100 < m.chattiness:
+            self.chatter.submit(msg)
+
+    # seeded from the message, or random when no word of it is known
+    async def _generate_reply(self, msg: discord.Message):
+        if (m := self.manager.get_markov(msg.guild.id)) is None:
+            return None
+        try:
+            return await m.speak(msg.content)
+        except KeyError:
+            return m.take_pooled() or await m.speak()
 
     chatbot_group = app_commands.Group(name="chatbot", description="chatbot features")
 
     @chatbot_group.command(name = 'speak', description = 'Speak based on a phrase or a random word.')
     async def speak(self, interaction: discord.Interaction, seed: typing.Optional[str]):
+        m = self.manager.get_markov(interaction.guild.id)
+        # random messages are answered from the pool when one is ready
+        if seed is None and m is not None and (msg := m.take_pooled()):
+            await interaction.response.send_message(msg)
+            return
         await interaction.response.defer()
         try: 
-            msg = await self.manager.get_markov(interaction.guild.id).speak(seed)
+            msg = await m.speak(seed)
             await interaction.followup.send(msg)
         except KeyError:
             await interaction.delete_original_response()
@@ -140,6 +204,7 @@ class MarkovCog(commands.Cog):
                                     app_commands.Choice(name = "train on channel", value = "train on channel"),
                                     app_commands.Choice(name = "train on user", value = "train on user"),
                                     app_commands.Choice(name = "chattiness_level", value = "chattiness_level"),
+                                    app_commands.Choice(name = "chain order", value = "chain order"),
                                     app_commands.Choice(name = "ban guild", value = "ban guild"),
                                     app_commands.Choice(name = "ban user", value = "ban user"),
                                     app_commands.Choice(name = "unban guild", value = "unban guild"),
@@ -156,6 +221,7 @@ class MarkovCog(commands.Cog):
             "train on channel"  : self._handle_train_on_channel,
             "train on user"     : self._handle_train_on_user,
             "chattiness_level"  : self._handle_chattiness_level,
+            "chain order"       : self._handle_chain_order,
             "ban guild"         : self._handle_ban_guild,
             "unban guild"       : self._handle_unban_guild,
             "ban user"          : self._handle_ban_user,
@@ -182,18 +248,13 @@ class MarkovCog(commands.Cog):
             return
         guild_id = int(guild.value)
 
-        if guild_id in self.mconfig['guild_blacklist']:
-            self.mconfig['guild_blacklist'].remove(guild_id)
-            self.mkvcfg['blacklists']['guild_ids'] = json.dumps(self.mconfig['guild_blacklist'])
-            with open(MARKOV_CONFIG_FILENAME, 'w') as cfgfile:
-                self.mkvcfg.write(cfgfile)
+        if self.mstore.contains('guild_blacklist', guild_id):
+            self.mstore.remove('guild_blacklist', guild_id)
             await interaction.followup.send(f'Removed guild {guild.label} from chatbot blacklist.', ephemeral = True)
         if self.mconfig['whitelist_servers_only'] is True:
-            self.mconfig['guild_whitelist'].append(guild_id)
-            self.mkvcfg['whitelists']['guild_ids'] = json.dumps(self.mconfig['guild_whitelist'])
-            with open(MARKOV_CONFIG_FILENAME, 'w') as cfgfile:
-                self.mkvcfg.write(cfgfile)
+            self.mstore.add('guild_whitelist', guild_id)
             await interaction.followup.send(f'Added guild {guild.label} to chatbot whitelist.', ephemeral = True)
+        self._update_subscription(guild_id)
 
     async def _handle_disable_server(self, interaction: discord.Interaction):
         if await self.bot.is_owner(interaction.user):
@@ -213,14 +274,11 @@ class MarkovCog(commands.Cog):
             return
         guild_id = int(guild.value)
 
-        if guild_id in self.mconfig['guild_whitelist']:
-            self.mconfig['guild_whitelist'].remove(guild_id)
-            self.mkvcfg['whitelists']['guild_ids'] = json.dumps(self.mconfig['guild_whitelist'])
+        if self.mstore.contains('guild_whitelist', guild_id):
+            self.mstore.remove('guild_whitelist', guild_id)
             await interaction.followup.send(f'Removed guild {guild.label} from chatbot whitelist.', ephemeral = True)
-        self.mconfig['guild_blacklist'].append(guild_id)
-        self.mkvcfg['blacklists']['guild_ids'] = json.dumps(self.mconfig['guild_blacklist'])
-        with open(MARKOV_CONFIG_FILENAME, 'w') as cfgfile:
-            self.mkvcfg.write(cfgfile)
+        self.mstore.add('guild_blacklist', guild_id)
+        self._update_subscription(guild_id)
         await interaction.followup.send(f'Added guild {guild.label} to chatbot blacklist.', ephemeral = True)
         
     async def _handle_train_on_server(self, interaction: discord.Interaction):
@@ -294,18 +352,41 @@ class MarkovCog(commands.Cog):
                             title = "Set the chattiness level", 
                             description= 'Select a guild and percent (0-100) of messages to be responded to.', 
                             option_placeholder = 'Select a guild',
-                            options = [ discord.SelectOption(label = g.name, value = str(g.id)) for g in self.bot.guilds ])
+                            options = guild_options)
         if not all((guild, level)):
             return
         try:
             int_level = int(level)
-            if int_level not in range(0, 100):
-                raise ValueError
-            self.manager.get_markov(int(guild.value)).chattiness = int_level
+            await self.manager.set_chattiness(int(guild.value), int_level)
             await interaction.followup.send(f'Chatbot chattiness successfully set to {int_level} in {guild.label}', ephemeral = True)
         except ValueError:
             await interaction.followup.send(f'{level} is not a valid number between 0 and 100.', ephemeral = True)
         
+    async def _handle_chain_order(self, interaction: discord.Interaction):
+        if await self.bot.is_owner(interaction.user):
+            guild_options = [discord.SelectOption(label = g.name, value = str(g.id)) for g in self.bot.guilds]
+        elif interaction.user.id == interaction.guild.owner_id:
+            guild_options = [ discord.SelectOption(label = interaction.guild.name, value = interaction.guild_id) ]
+        else:
+            await interaction.response.send_message(f'You must be the owner of the server to use this function.', ephemeral = True)
+            return 
+        guild, order = await make_OptionPromptThenModal(interaction, 
+                            modal_title= "Chatbot chain order",
+                            modal_input_label= f'Enter a number of words ({markov.MIN_CHAIN_LENGTH}-{markov.MAX_CHAIN_LENGTH}):',
+                            modal_default = str(markov.DEFAULT_CHAIN_LENGTH),
+                            title = "Set the chain order", 
+                            description= 'Select a guild and how many previous words are used to choose the next one. Higher orders are learned from new messages.', 
+                            option_placeholder = 'Select a guild',
+                            options = guild_options)
+        if not all((guild, order)):
+            return
+        try:
+            int_order = int(order)
+            await self.manager.set_chain_length(int(guild.value), int_order)
+            await interaction.followup.send(f'Chatbot chain order successfully set to {int_order} in {guild.label}', ephemeral = True)
+        except ValueError:
+            await interaction.followup.send(f'{order} is not a valid number between {markov.MIN_CHAIN_LENGTH} and {markov.MAX_CHAIN_LENGTH}.', ephemeral = True)
+
     async def _handle_ban_guild(self, interaction: discord.Interaction):
         if not await self.bot.is_owner(interaction.user):
             await interaction.response.send_message(f'You must be the owner to use this function.', ephemeral = True)
@@ -352,7 +433,9 @@ class MarkovCog(commands.Cog):
         if not all((guild, file)):
             return
         try:
-            await self.manager.get_markov(int(guild.value)).brain.import_json(file.value)
+            m = self.manager.get_markov(int(guild.value))
+            await m.brain.import_json(file.value, run_blocking = self.bot.run_blocking)
+            m.invalidate_pool()
             await interaction.followup.send(f'Successfully imported brain file.', ephemeral = True)
         except Exception as e:
             await interaction.followup.send(f'Unable to import file: {e.msg}', ephemeral = True)
@@ -376,7 +459,7 @@ class MarkovCog(commands.Cog):
             brains_folder = pathlib.Path(os.getcwd()).joinpath('chatbot-brains')
             os.makedirs(brains_folder, exist_ok = True)
             output_file = brains_folder.joinpath(pathlib.Path(filename))
-            await self.manager.get_markov(int(guild.value)).brain.export_json(output_file)
+            await self.manager.get_markov(int(guild.value)).brain.export_json(output_file, run_blocking = self.bot.run_blocking)
             await interaction.followup.send(f'Successfully exported brain file.', ephemeral = True)
         except Exception as e:
             await interaction.response.send_message(f'Unable to export file: {e.msg}', ephemeral = True)
@@ -397,7 +480,9 @@ class MarkovCog(commands.Cog):
                                         options = guild_options)
         if not guild:
             return
-        await self.manager.get_markov(int(guild.value)).brain.reset()
+        m = self.manager.get_markov(int(guild.value))
+        await m.brain.reset()
+        m.invalidate_pool()
         await interaction.followup.send(f'Reset successful.', ephemeral = True)
 
     async def _handle_debug(self, interaction: discord.Interaction):
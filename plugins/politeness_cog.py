@@ -25,10 +25,9 @@ class PolitenessCog(commands.Cog):
 
     async def cog_load(self):
         await self.polite_checker.init()
-        self.polite_checker.check_politeexpiry.start()
 
     async def cog_unload(self):
-        self.polite_checker.check_politeexpiry.cancel()
+        await self.polite_checker.close()
 
     @app_commands.command(description="Forces a user to be more polite.")
     async def politeness_enforcer(self, interaction: discord.Interaction):
@@ -52,17 +51,5 @@ class PolitenessCog(commands.Cog):
             else:
                 await interaction.followup.send(f"{sender.display_name} has has politely reminded {target.display_name}  to say '{custom_phrase or phrase.label}' for {duration.label}.")
 
-    @commands.Cog.listener()
-    @commands.guild_only()
-    async def on_message(self, msg: discord.Message):
-        if msg.guild and not msg.author.bot:
-            await self.polite_checker.process_message(msg.author.display_name, msg.author.id, msg.guild.id, msg.content, msg)
-
-    @commands.Cog.listener()
-    @commands.guild_only()
-    async def on_message_edit(self, before: discord.Message, after: discord.Message):
-        if before.content != after.content:
-            await self.on_message(after)
-
 async def setup(bot: commands.Bot):
     await bot.add_cog(PolitenessCog(bot = bot))
\ No newline at end of file
@@ -26,10 +26,9 @@ class VerbosityCog(commands.Cog):
 
     async def cog_load(self):
         await self.verbosity_checker.init()
-        self.verbosity_checker.check_verbosityexpiry.start()
 
     async def cog_unload(self):
-        self.verbosity_checker.check_verbosityexpiry.cancel()
+        await self.verbosity_checker.close()
 
     @app_commands.command(description="Make a user post longer or shorter comments.")
     async def verbosity_enforcer(self, interaction: discord.Interaction):
@@ -49,16 +48,5 @@ class VerbosityCog(commands.Cog):
             else:
                 await interaction.followup.send(f'{sender.display_name} has {option.label} restricted {target.display_name} for {duration.label} unless they their comments are {option.value}.')
 
-    @commands.Cog.listener()
-    @commands.guild_only()
-    async def on_message(self, msg: discord.Message):
-        if msg.guild and not msg.author.bot:
-            await self.verbosity_checker.process_message(msg.author.display_name, msg.author.id, msg.guild.id, msg.content, msg)
-
-    @commands.Cog.listener()
-    @commands.guild_only()
-    async def on_message_edit(self, before: discord.Message, after: discord.Message):
-        await self.on_message(after)
-
 async def setup(bot):
     await bot.add_cog(VerbosityCog(bot = bot))
@@ -0,0 +1,63 @@
+# Shared fixtures. pytest-asyncio is not a dependency, async code runs to completion in asyncio.run()
+# inside each fixture and the fixtures hand back plain results.
+#   with_manager(test)              await test(manager) on a connected markov_manager over a fresh database
+#   with_markov(test, messages)     await test(m) for brain 1 after it learned messages
+#                                   both pass other keyword arguments on to markov_manager, e.g. max_entries
+#   load_store(filename, lists)     a loaded config_store
+#   bot_module                      bot.py imported with the repository's config.ini instead of pytest's arguments
+
+import asyncio
+import os
+
+import pytest
+
+from lib.config_store import config_store
+from plugins.lib.markov_manager import markov_manager
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture
+def repo_root():
+    return ROOT
+
+@pytest.fixture
+def with_manager(tmp_path):
+    def run(test, filename = None, others = (), **options):
+        async def main():
+            manager = markov_manager(database_filename = str(filename or tmp_path / 'markov.db'),
+                                     other_database_filenames = [ str(f) for f in others ], **options)
+            await manager.connect()
+            try:
+                return await test(manager)
+            finally:
+                await manager.close()
+        return asyncio.run(main())
+    return run
+
+# brains start with chain_length 2, their pool refill is cancelled so only the test generates
+@pytest.fixture
+def with_markov(with_manager):
+    def run(test, messages = (), id = 1, filename = None, others = (), **options):
+        async def main(manager):
+            m = await manager.add_markov(id)
+            m.cancel_refill()
+            for message in messages:
+                await m.process_message(message)
+            return await test(m)
+        return with_manager(main, filename = filename, others = others, **options)
+    return run
+
+@pytest.fixture
+def load_store():
+    def load(filename, lists):
+        store = config_store(str(filename), lambda parser, values: None, lists)
+        store.load()
+        return store
+    return load
+
+@pytest.fixture(scope = 'session')
+def bot_module():
+    import config
+    config.load([ os.path.join(ROOT, 'config.ini') ])
+    import bot
+    return bot
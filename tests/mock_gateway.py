@@ -0,0 +1,146 @@
+# A local stand-in for the Discord API and gateway, enough for a bot to log in, identify its shards and
+# receive the guilds of each. Run as a script it starts one cluster worker of bot.py against it and prints
+# what happened as JSON, see test_gateway.py:
+#   python tests/mock_gateway.py <config file> <cluster id>
+
+import asyncio
+import contextlib
+import json
+import multiprocessing.connection
+import os
+import secrets
+import sys
+import threading
+
+from aiohttp import web
+
+BOT_USER = { 'id': '1000', 'username': 'mockbot', 'discriminator': '0', 'global_name': None, 'avatar': None, 'bot': True }
+
+class mock_gateway:
+    def __init__(self, guild_ids):
+        self.guild_ids = guild_ids
+        self.identified = [ ]       # [ [ shard id, shard count ] ] in the order shards identified
+        self.runner = None
+        self.url = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/api/v10/users/@me', self._user)
+        app.router.add_get('/api/v10/oauth2/applications/@me', self._application)
+        app.router.add_get('/gateway', self._gateway)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        host, port = site._server.sockets[0].getsockname()[:2]
+        self.url = f'http://{host}:{port}'
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    # discord.py only decodes a body sent as exactly application/json, without a charset
+    def _json(self, data):
+        return web.Response(body = json.dumps(data).encode(), content_type = 'application/json')
+
+    async def _user(self, request):
+        return self._json(BOT_USER)
+
+    async def _application(self, request):
+        return self._json({ 'id': '2000', 'name': 'mockbot', 'description': '', 'icon': None, 'bot_public': True,
+                                   'bot_require_code_grant': False, 'owner': BOT_USER, 'verify_key': '', 'flags': 0 })
+
+    def _guild(self, guild_id):
+        return { 'id': str(guild_id), 'name': f'guild {guild_id}', 'owner_id': BOT_USER['id'], 'member_count': 1,
+                 'channels': [ ], 'roles': [ ], 'members': [ ], 'emojis': [ ], 'stickers': [ ], 'threads': [ ],
+                 'features': [ ], 'unavailable': False, 'large': False }
+
+    # hello, then a READY and a GUILD_CREATE for each guild of the shard that identified
+    async def _gateway(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_json({ 'op': 10, 'd': { 'heartbeat_interval': 45000 } })
+        sequence = 0
+        async for message in ws:
+            payload = json.loads(message.data)
+            if payload['op'] == 1:
+                await ws.send_json({ 'op': 11 })
+            elif payload['op'] == 2:
+                shard_id, shard_count = payload['d']['shard']
+                self.identified.append([ shard_id, shard_count ])
+                guilds = [ g for g in self.guild_ids if (g >> 22) % shard_count == shard_id ]
+                sequence += 1
+                await ws.send_json({ 'op': 0, 's': sequence, 't': 'READY', 'd': {
+                    'v': 10, 'user': BOT_USER, 'session_id': f'session{shard_id}', 'shard': [ shard_id, shard_count ],
+                    'resume_gateway_url': self.url.replace('http', 'ws') + '/gateway',
+                    'application': { 'id': '2000', 'flags': 0 },
+                    'guilds': [ { 'id': str(g), 'unavailable': True } for g in guilds ] } })
+                for g in guilds:
+                    sequence += 1
+                    await ws.send_json({ 'op': 0, 's': sequence, 't': 'GUILD_CREATE', 'd': self._guild(g) })
+        return ws
+
+# stands in for cluster_supervisor, takes the worker's hello and sends it one relayed config change
+def supervise(listener, relay, received):
+    connection = listener.accept()
+    received.append(connection.recv())
+    connection.send(relay)
+    with contextlib.suppress(EOFError, OSError):
+        connection.recv()
+
+async def run_worker(config_filename, cluster_id, guild_ids):
+    import discord
+    import yarl
+
+    gateway = mock_gateway(guild_ids)
+    await gateway.start()
+    authkey = secrets.token_bytes(32)
+    listener = multiprocessing.connection.Listener(('127.0.0.1', 0), authkey = authkey)
+    host, port = listener.address
+    hello = [ ]
+    threading.Thread(target = supervise, args = (listener, ('config', ('config', 'guild_banlist', 'add', [ 42 ])), hello), daemon = True).start()
+
+    import config
+    from lib.cluster import CLUSTER_ENV
+    os.environ[CLUSTER_ENV] = f'{host}:{port}:{authkey.hex()}'
+    config.load([ config_filename, '--cluster', str(cluster_id) ])
+    discord.http.Route.BASE = f'{gateway.url}/api/v10'
+    discord.gateway.DiscordWebSocket.DEFAULT_GATEWAY = yarl.URL(f'{gateway.url.replace("http", "ws")}/gateway')
+
+    from bot import bot
+
+    # the real hook waits 5 s between shards to respect the identify rate limit
+    async def before_identify_hook(shard_id, *, initial = False):
+        pass
+    bot.before_identify_hook = before_identify_hook
+    # every guild arrives right after READY, no need to wait the default 2 s for more
+    bot._connection.guild_ready_timeout = 0.1
+
+    ready = asyncio.Event()
+    async def on_ready():
+        ready.set()
+    bot.add_listener(on_ready)
+
+    running = asyncio.create_task(bot.start('token'))
+    try:
+        await asyncio.wait_for(ready.wait(), 30)
+        for _ in range(100):
+            if bot.config_store.contains('guild_banlist', 42):
+                break
+            await asyncio.sleep(0.05)
+        result = { 'identified': gateway.identified,
+                   'shard_ids': bot.shard_ids,
+                   'shard_count': bot.shard_count,
+                   'guilds': sorted([ g.id, g.shard_id ] for g in bot.guilds),
+                   'hello': list(hello[0]) if hello else None,
+                   'relayed_ban': bot.config_store.contains('guild_banlist', 42) }
+    finally:
+        await bot.close()
+        await asyncio.wait_for(running, 10)
+        await gateway.stop()
+        listener.close()
+    return result
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    guild_ids = [ int(g) for g in sys.argv[3].split(',') ]
+    print(json.dumps(asyncio.run(run_worker(sys.argv[1], int(sys.argv[2]), guild_ids))))
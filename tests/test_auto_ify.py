@@ -0,0 +1,89 @@
+# Tests for per-channel auto-ify rules
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from lib.message_pipeline import message_pipeline
+from plugins.lib import ify
+from plugins.lib.auto_ify import auto_ify_manager
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    filename = str(tmp_path / 'ify.db')
+    monkeypatch.setattr(auto_ify_manager, 'DATABASE_FILE', filename)
+    return filename
+
+def fake_bot():
+    return SimpleNamespace(messages = message_pipeline(), run_cpu = None)
+
+IFIERS = { 'owoify': ify.owoifier(seed = 1), 'sfwify': ify.sfwifier(seed = 1) }
+
+def message(content, guild_id = 1, channel_id = 100, replies = None):
+    async def reply(text, mention_author = True):
+        replies.append(text)
+    return SimpleNamespace(id = 1, content = content, guild = SimpleNamespace(id = guild_id),
+                           author = SimpleNamespace(id = 10, bot = False),
+                           channel = SimpleNamespace(id = channel_id, is_nsfw = lambda: False), reply = reply)
+
+def subscribed(manager, guild_id, channel_id):
+    return manager.messages in manager.bot.messages.subscribers(message('', guild_id, channel_id))
+
+def test_rules_are_stored_and_loaded_again(database):
+    async def main():
+        manager = auto_ify_manager(fake_bot(), IFIERS)
+        await manager.init()
+        await manager.set_rule(1, auto_ify_manager.GUILD_WIDE, 'owoify')
+        await manager.set_rule(1, 100, 'sfwify')
+        await manager.set_rule(2, 200, 'owoify')
+        await manager.set_rule(2, 200, None)
+        with pytest.raises(ValueError):
+            await manager.set_rule(3, 300, 'shoutify')
+        await manager.close()
+
+        loaded = auto_ify_manager(fake_bot(), IFIERS)
+        await loaded.init()
+        scopes = subscribed(loaded, 1, 101), subscribed(loaded, 2, 200)
+        await loaded.close()
+        return loaded, scopes
+    loaded, scopes = asyncio.run(main())
+    assert loaded.rules == { (1, auto_ify_manager.GUILD_WIDE): 'owoify', (1, 100): 'sfwify' }
+    # a channel rule wins over the guild wide one
+    assert loaded.get_ifier(1, 100) == 'sfwify'
+    assert loaded.get_ifier(1, 101) == 'owoify'
+    assert loaded.get_ifier(2, 200) is None
+    # only messages in a guild or channel with a rule are delivered
+    assert scopes == (True, False)
+
+def test_rules_naming_a_missing_ifier_are_ignored(database):
+    async def main():
+        manager = auto_ify_manager(fake_bot(), IFIERS)
+        await manager.init()
+        await manager.set_rule(1, 100, 'owoify')
+        await manager.close()
+        loaded = auto_ify_manager(fake_bot(), { 'sfwify': IFIERS['sfwify'] })
+        await loaded.init()
+        scope = subscribed(loaded, 1, 100)
+        await loaded.close()
+        return loaded, scope
+    loaded, scope = asyncio.run(main())
+    assert loaded.rules == { }
+    assert not scope
+
+# the original message stays, the transformed text is sent as a reply
+def test_matching_messages_get_a_transformed_reply(database):
+    replies = [ ]
+
+    async def main():
+        manager = auto_ify_manager(fake_bot(), IFIERS)
+        await manager.init()
+        await manager.set_rule(1, 100, 'sfwify')
+        for text, channel_id in (('what the hell', 100), ('nothing to change', 100), ('what the hell', 101)):
+            msg = message(text, channel_id = channel_id, replies = replies)
+            for subscription in manager.bot.messages.subscribers(msg):
+                await subscription.handler(msg)
+        await manager.queue.join()
+        await manager.close()
+    asyncio.run(main())
+    assert replies == [ 'what the heck' ]
@@ -0,0 +1,83 @@
+# Tests for ModuleBot
+
+import asyncio
+
+import pytest
+
+def test_independent_plugins_load_in_one_wave(bot_module):
+    assert bot_module.plugin_load_waves([ 'a', 'b', 'c' ], { }) == [ [ 'a', 'b', 'c' ] ]
+
+def test_plugins_wait_for_their_dependencies(bot_module):
+    dependencies = { 'markov_cog': [ 'devtools_cog' ], 'ify_cog': [ 'markov_cog', 'devtools_cog' ] }
+    waves = bot_module.plugin_load_waves([ 'ify_cog', 'markov_cog', 'devtools_cog', 'verbosity_cog' ], dependencies)
+    assert waves == [ [ 'devtools_cog', 'verbosity_cog' ], [ 'markov_cog' ], [ 'ify_cog' ] ]
+
+# a dependency that isn't being loaded, or a plugin naming itself, doesn't hold a plugin back
+def test_unloaded_dependencies_are_ignored(bot_module):
+    assert bot_module.plugin_load_waves([ 'a', 'b' ], { 'a': [ 'missing', 'a' ], 'b': [ 'a' ] }) == [ [ 'a' ], [ 'b' ] ]
+
+def test_a_dependency_cycle_loads_last_together(bot_module):
+    waves = bot_module.plugin_load_waves([ 'a', 'b', 'c', 'd' ], { 'a': [ 'b' ], 'b': [ 'a' ], 'd': [ 'a' ] })
+    assert waves == [ [ 'c' ], [ 'a', 'b', 'd' ] ]
+
+class fake_cluster:
+    def __init__(self):
+        self.sent = [ ]
+
+    def broadcast(self, command, *args):
+        self.sent.append((command, *args))
+
+@pytest.fixture
+def cluster_bot(bot_module, monkeypatch):
+    monkeypatch.setattr(bot_module.bot, 'cluster', fake_cluster())
+    return bot_module.bot
+
+# everywhere() sends the command to the other workers and runs it here too
+def test_everywhere_runs_here_and_broadcasts(cluster_bot, monkeypatch):
+    ran = [ ]
+
+    async def command(*args):
+        ran.append(args)
+    monkeypatch.setitem(cluster_bot.cluster_commands, 'test', command)
+    asyncio.run(cluster_bot.everywhere('test', 1, 'two'))
+    assert ran == [ (1, 'two') ]
+    assert cluster_bot.cluster.sent == [ ('test', 1, 'two') ]
+
+def test_relayed_commands_run_as_tasks(cluster_bot, monkeypatch, capsys):
+    ran = [ ]
+
+    async def command(*args):
+        ran.append(args)
+
+    async def failing():
+        raise RuntimeError('boom')
+    monkeypatch.setitem(cluster_bot.cluster_commands, 'test', command)
+    monkeypatch.setitem(cluster_bot.cluster_commands, 'failing', failing)
+
+    async def main():
+        for message in (('test', [ 5 ]), ('failing', [ ]), ('no_such_command', [ ])):
+            cluster_bot._cluster_message(*message)
+        await asyncio.gather(*cluster_bot._cluster_tasks)
+    asyncio.run(main())
+    assert ran == [ (5,) ]
+    assert not cluster_bot._cluster_tasks
+    out = capsys.readouterr().out
+    assert 'Unknown cluster command no_such_command.' in out and 'Cluster command failing failed: boom' in out
+
+# list changes of a shared store are relayed, and relayed ones are applied to the store with the same key
+def test_shared_store_changes_travel_between_workers(cluster_bot, tmp_path, load_store):
+    filename = tmp_path / 'shared.ini'
+    filename.write_text('[blacklists]\nguild_ids = []\n')
+    store = load_store(filename, { 'guild_blacklist': ('blacklists', 'guild_ids') })
+    cluster_bot.share_store('test', store)
+    try:
+        async def main():
+            store.add('guild_blacklist', 7)
+            await store.flush()
+            await cluster_bot._apply_config('test', 'guild_blacklist', 'add', [ 8 ])
+            await cluster_bot._apply_config('missing', 'guild_blacklist', 'add', [ 9 ])
+        asyncio.run(main())
+    finally:
+        cluster_bot.unshare_store('test')
+    assert cluster_bot.cluster.sent == [ ('config', 'test', 'guild_blacklist', 'add', [ 7 ]) ]
+    assert store.values['guild_blacklist'] == { 7, 8 }
@@ -0,0 +1,50 @@
+# Tests for the queue of unprompted chatbot replies
+
+import asyncio
+from types import SimpleNamespace
+
+from plugins.lib.chatter import chatter_queue
+
+def message(guild_id, channel_id, content, sent):
+    async def send(text):
+        sent.append(text)
+    return SimpleNamespace(id = 1, content = content, guild = SimpleNamespace(id = guild_id),
+                           channel = SimpleNamespace(id = channel_id, send = send))
+
+def test_a_channel_waits_for_its_reply_before_queueing_another():
+    sent = [ ]
+
+    async def main():
+        chatter = chatter_queue(lambda msg: asyncio.sleep(0, result = msg.content.upper()))
+        accepted = [ chatter.submit(message(1, 10, 'hello', sent)), chatter.submit(message(1, 10, 'again', sent)) ]
+        await asyncio.sleep(0.05)
+        chatter.stop()
+        return accepted
+    assert asyncio.run(main()) == [ True, False ]
+    assert sent == [ 'HELLO' ]
+
+# stop() clears pending while the worker is still generating, its cleanup used to raise KeyError
+def test_stop_while_a_reply_is_in_flight():
+    sent = [ ]
+
+    async def main():
+        generating = asyncio.Event()
+
+        async def generate(msg):
+            generating.set()
+            await asyncio.sleep(10)
+            return 'late'
+        chatter = chatter_queue(generate)
+        chatter.submit(message(1, 10, 'hello', sent))
+        worker = chatter.workers[1]
+        await generating.wait()
+        chatter.stop()
+        result, = await asyncio.gather(worker, return_exceptions = True)
+        resubmitted = chatter.submit(message(1, 10, 'hello', sent))
+        chatter.stop()
+        await asyncio.sleep(0)
+        return result, resubmitted
+    result, resubmitted = asyncio.run(main())
+    assert isinstance(result, asyncio.CancelledError)
+    assert resubmitted
+    assert sent == [ ]
@@ -0,0 +1,31 @@
+# Tests for splitting shards between cluster workers
+
+import pytest
+
+from lib.cluster import cluster_filename, cluster_files, cluster_shards, shard_ranges
+
+def test_shard_ranges_cover_every_shard_once():
+    ranges = shard_ranges(10, 3)
+    assert ranges == [ [ 0, 1, 2 ], [ 3, 4, 5 ], [ 6, 7, 8, 9 ] ]
+
+def test_cluster_shards_of_a_worker():
+    assert cluster_shards(10, 3, 2) == [ 6, 7, 8, 9 ]
+
+@pytest.mark.parametrize('cluster_id', [ 3, -1 ])
+def test_cluster_shards_rejects_an_id_outside_the_cluster(cluster_id):
+    with pytest.raises(ValueError, match = 'out of range'):
+        cluster_shards(10, 3, cluster_id)
+
+def test_cluster_shards_rejects_fewer_shards_than_processes():
+    with pytest.raises(ValueError, match = 'shard_count'):
+        cluster_shards(2, 3, 0)
+
+def test_cluster_filename():
+    assert cluster_filename('markov.db', None) == 'markov.db'
+    assert cluster_filename('markov.db', 2) == 'markov.cluster2.db'
+
+def test_cluster_files_lists_the_file_and_its_copies(tmp_path):
+    filename = tmp_path / 'markov.db'
+    for name in [ 'markov.db', 'markov.cluster0.db', 'markov.cluster1.db', 'other.db' ]:
+        (tmp_path / name).touch()
+    assert cluster_files(str(filename)) == [ str(filename), str(tmp_path / 'markov.cluster0.db'), str(tmp_path / 'markov.cluster1.db') ]
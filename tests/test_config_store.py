@@ -0,0 +1,84 @@
+# Tests for config_store saves
+
+import asyncio
+import configparser
+import os
+import shutil
+
+from lib.config_store import _render
+
+LISTS = { 'guild_blacklist': ('blacklists', 'guild_ids'), 'user_whitelist': ('whitelists', 'user_ids') }
+
+def test_saving_keeps_comments_and_untouched_lines(tmp_path, repo_root, load_store):
+    filename = tmp_path / 'markov.ini'
+    shutil.copy(os.path.join(repo_root, 'markov.ini'), filename)
+    before = filename.read_text()
+
+    async def main():
+        store = load_store(filename, LISTS)
+        store.add('guild_blacklist', 42, 7)
+        await store.flush()
+    asyncio.run(main())
+
+    after = filename.read_text()
+    assert after == before.replace('[blacklists]\nguild_ids = []', '[blacklists]\nguild_ids = [7, 42]')
+    assert '# per-guild limit of chatbot transitions, 0 for unlimited' in after
+    assert load_store(filename, LISTS).contains('guild_blacklist', 42)
+
+def test_render_adds_new_options_and_sections():
+    text = '# top\n[a]\n# about x\nx = 1\n\n# trailing comment\n[b]\ny = 2\n'
+    rendered = _render(text, { 'a': { 'x': '1', 'z': '3' }, 'c': { 'w': '4' } })
+    assert rendered == '# top\n[a]\n# about x\nx = 1\nz = 3\n\n# trailing comment\n\n[c]\nw = 4\n\n'
+    parser = configparser.ConfigParser()
+    parser.read_string(rendered)
+    assert { s: dict(parser[s]) for s in parser.sections() } == { 'a': { 'x': '1', 'z': '3' }, 'c': { 'w': '4' } }
+
+def test_render_rewrites_multiline_values():
+    text = '[a]\nx = one\n\ttwo\ny = 2\n'
+    assert _render(text, { 'a': { 'x': 'one\ntwo', 'y': '2' } }) == text
+    assert _render(text, { 'a': { 'x': 'three', 'y': '2' } }) == '[a]\nx = three\ny = 2\n'
+
+def test_id_lists_load_as_sets(tmp_path, load_store):
+    filename = tmp_path / 'config.ini'
+    filename.write_text('[blacklists]\nguild_ids = [3, 1, 3]\n')
+    store = load_store(filename, LISTS)
+    assert store.values['guild_blacklist'] == { 1, 3 }
+    # a list missing from the file is empty
+    assert store.values['user_whitelist'] == set()
+    assert store.contains('guild_blacklist', 3) and not store.contains('guild_blacklist', 2)
+
+# add() and remove() keep the parser in step for saving and tell on_change, which ModuleBot relays
+def test_changes_update_the_parser_and_notify(tmp_path, load_store):
+    filename = tmp_path / 'config.ini'
+    filename.write_text('[blacklists]\nguild_ids = [1]\n')
+    changes = [ ]
+
+    async def main():
+        store = load_store(filename, LISTS)
+        store.on_change.append(lambda *change: changes.append(change))
+        store.add('guild_blacklist', 5, 2)
+        store.remove('guild_blacklist', 1)
+        store.add('user_whitelist', 7)
+        await store.flush()
+        return store
+    store = asyncio.run(main())
+    assert changes == [ ('guild_blacklist', 'add', (5, 2)), ('guild_blacklist', 'remove', (1,)), ('user_whitelist', 'add', (7,)) ]
+    assert store.parser['blacklists']['guild_ids'] == '[2, 5]'
+    assert store.parser['whitelists']['user_ids'] == '[7]'
+    assert load_store(filename, LISTS).values['guild_blacklist'] == { 2, 5 }
+
+# a change relayed from another process is applied without saving or relaying it again
+def test_apply_does_not_save_or_notify(tmp_path, load_store):
+    filename = tmp_path / 'config.ini'
+    filename.write_text('[blacklists]\nguild_ids = [1]\n')
+    store = load_store(filename, LISTS)
+    changes, reloads = [ ], [ ]
+    store.on_change.append(lambda *change: changes.append(change))
+    store.on_reload.append(lambda: reloads.append(True))
+    store.apply('guild_blacklist', 'add', [ 4 ])
+    store.apply('guild_blacklist', 'remove', [ 1 ])
+    assert store.values['guild_blacklist'] == { 4 }
+    assert store.parser['blacklists']['guild_ids'] == '[4]'
+    assert changes == [ ] and reloads == [ True, True ]
+    assert store._pending is None and not store._dirty
+    assert filename.read_text() == '[blacklists]\nguild_ids = [1]\n'
@@ -0,0 +1,75 @@
+# Tests for batched deletes and coalesced reminders
+
+import asyncio
+import datetime
+from types import SimpleNamespace
+
+import discord
+
+from plugins.lib.enforcement import enforcement_pipeline
+
+class fake_channel:
+    def __init__(self, id = 100):
+        self.id = id
+        self.calls = [ ]
+
+    async def delete_messages(self, messages):
+        self.calls.append(('bulk_delete', [ m.id for m in messages ]))
+
+    async def send(self, text, delete_after = None):
+        self.calls.append(('send', text))
+
+def message(channel, id, user_id = 10, age = datetime.timedelta(0)):
+    async def delete():
+        channel.calls.append(('delete', id))
+
+    async def reply(text, mention_author = True):
+        channel.calls.append(('reply', id, text))
+    return SimpleNamespace(id = id, channel = channel, guild = SimpleNamespace(id = 1), author = SimpleNamespace(id = user_id),
+                           created_at = discord.utils.utcnow() - age, delete = delete, reply = reply)
+
+# enqueues each batch of (message, reminders), waiting for a flush after each one
+def enforce(*batches):
+    async def main():
+        pipeline = enforcement_pipeline(SimpleNamespace(user = SimpleNamespace(display_name = 'bot')))
+        pipeline.FLUSH_DELAY = 0.01
+        for batch in batches:
+            for msg, reminders in batch:
+                pipeline.enqueue(msg, reminders)
+            await asyncio.sleep(0.05)
+        pipeline.stop()
+    asyncio.run(main())
+
+def test_a_burst_is_one_bulk_delete_and_one_reply():
+    channel = fake_channel()
+    enforce([ (message(channel, id), [ 'be nice', f'reminder {id % 2}' ]) for id in range(1, 4) ])
+    assert channel.calls == [ ('reply', 3, 'be nice\nreminder 1\nreminder 0'), ('bulk_delete', [ 1, 2, 3 ]) ]
+
+def test_a_single_message_is_deleted_on_its_own():
+    channel = fake_channel()
+    enforce([ (message(channel, 1), [ 'be nice' ]) ])
+    assert channel.calls == [ ('reply', 1, 'be nice'), ('delete', 1) ]
+
+# discord refuses to bulk delete messages older than 14 days
+def test_old_messages_are_deleted_one_by_one():
+    channel = fake_channel()
+    old = datetime.timedelta(days = 15)
+    enforce([ (message(channel, 1, age = old), [ 'be nice' ]), (message(channel, 2), [ ]), (message(channel, 3), [ ]),
+              (message(channel, 4, age = old), [ ]) ])
+    assert channel.calls[1:] == [ ('bulk_delete', [ 2, 3 ]), ('delete', 1), ('delete', 4) ]
+
+def test_bulk_deletes_are_split_at_the_limit():
+    channel = fake_channel()
+    enforce([ (message(channel, id), [ ]) for id in range(enforcement_pipeline.BULK_DELETE_LIMIT + 1) ])
+    assert [ (call, len(ids) if call == 'bulk_delete' else ids) for call, ids in channel.calls[1:] ] == [
+        ('bulk_delete', enforcement_pipeline.BULK_DELETE_LIMIT), ('delete', enforcement_pipeline.BULK_DELETE_LIMIT) ]
+
+# violations later in the same REMINDER_INTERVAL are removed without another reply
+def test_one_reminder_per_window():
+    channel = fake_channel()
+    enforce([ (message(channel, 1), [ 'be nice' ]), (message(channel, 2), [ 'be nice' ]) ],
+            [ (message(channel, 3), [ 'be nice' ]) ],
+            [ (message(channel, 4, user_id = 11), [ 'be nice' ]) ])
+    replies = [ call for call in channel.calls if call[0] == 'reply' ]
+    assert replies == [ ('reply', 2, 'be nice'), ('reply', 4, 'be nice') ]
+    assert [ call for call in channel.calls if call[0] != 'reply' ] == [ ('bulk_delete', [ 1, 2 ]), ('delete', 3), ('delete', 4) ]
@@ -0,0 +1,40 @@
+# Tests for the thread and process pools behind bot.run_blocking() and bot.run_cpu()
+
+import asyncio
+import os
+import threading
+
+from lib.executors import executor_pool, executor_queue_depth
+from plugins.lib import ify
+
+def worker():
+    return os.getpid(), threading.current_thread().name
+
+def run(pool, method, *args, **kwargs):
+    async def main():
+        try:
+            return await getattr(pool, method)(*args, **kwargs)
+        finally:
+            pool.shutdown()
+    return asyncio.run(main())
+
+def test_blocking_work_runs_on_a_thread_of_this_process():
+    pid, thread = run(executor_pool(threads = 1, processes = 0), 'run_blocking', worker)
+    assert pid == os.getpid()
+    assert thread.startswith('blocking')
+
+# what the ify cog sends for long texts, a module level function by name and plain arguments
+def test_cpu_work_round_trips_through_a_worker_process():
+    text = 'hello you dumbass ' * 50
+    (pid, _), sfw = [ run(executor_pool(threads = 1, processes = 1), 'run_cpu', *job)
+                      for job in ((worker,), (ify.ify_text_by_name, 'sfwify', text, False)) ]
+    assert pid != os.getpid()
+    assert sfw == ify.sfwifier().ify_text(text)
+
+def test_cpu_work_uses_the_threads_without_processes():
+    pid, thread = run(executor_pool(threads = 1, processes = 0), 'run_cpu', worker)
+    assert pid == os.getpid() and thread.startswith('blocking')
+
+def test_queue_depth_returns_to_zero():
+    run(executor_pool(threads = 1, processes = 0), 'run_blocking', sorted, [ 3, 1, 2 ])
+    assert executor_queue_depth.values[(('pool', 'thread'),)] == 0
@@ -0,0 +1,70 @@
+# Tests for the deadline heap behind punishment expiry
+
+import asyncio
+import datetime
+
+from plugins.lib.expiry import expiry_scheduler
+
+def after(seconds):
+    return datetime.datetime.now() + datetime.timedelta(seconds = seconds)
+
+# runs the scheduler for a while and returns each batch on_expired got
+def expire(setup, seconds = 0.5):
+    async def main():
+        batches = [ ]
+
+        async def on_expired(keys):
+            batches.append(keys)
+        scheduler = expiry_scheduler(on_expired)
+        scheduler.start()
+        await setup(scheduler)
+        await asyncio.sleep(seconds)
+        scheduler.stop()
+        return batches, len(scheduler)
+    return asyncio.run(main())
+
+def test_entries_expire_in_deadline_order():
+    async def setup(scheduler):
+        for key, seconds in (('c', 0.3), ('a', 0.1), ('b', 0.2)):
+            scheduler.schedule(key, after(seconds))
+    batches, left = expire(setup)
+    assert [ key for batch in batches for key in batch ] == [ 'a', 'b', 'c' ]
+    assert left == 0
+
+def test_due_entries_expire_together():
+    scheduler = expiry_scheduler(None)
+    now = datetime.datetime.now()
+    for key, seconds in (('late', 60), ('b', -1), ('a', -2)):
+        scheduler.schedule(key, now + datetime.timedelta(seconds = seconds))
+    assert scheduler._pop_expired(now) == [ 'a', 'b' ]
+    assert list(scheduler.deadlines) == [ 'late' ]
+
+# the scheduler is already sleeping towards the first deadline when it is cancelled or moved
+def test_cancel_after_scheduling():
+    async def setup(scheduler):
+        scheduler.schedule('a', after(0.1))
+        scheduler.schedule('b', after(0.2))
+        await asyncio.sleep(0.05)
+        scheduler.cancel('a')
+    batches, left = expire(setup)
+    assert batches == [ [ 'b' ] ]
+    assert left == 0
+
+def test_rescheduling_replaces_the_old_deadline():
+    async def setup(scheduler):
+        scheduler.schedule('a', after(0.1))
+        await asyncio.sleep(0.05)
+        scheduler.schedule('a', after(10))
+        scheduler.schedule('b', after(0.15))
+    batches, left = expire(setup)
+    assert batches == [ [ 'b' ] ]
+    assert left == 1
+
+def test_an_earlier_deadline_wakes_the_scheduler():
+    async def setup(scheduler):
+        scheduler.schedule('late', after(10))
+        await asyncio.sleep(0.05)
+        scheduler.schedule('soon', after(0.1))
+    batches, left = expire(setup)
+    assert batches == [ [ 'soon' ] ]
+    assert left == 1
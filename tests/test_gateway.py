@@ -0,0 +1,44 @@
+# A cluster worker of bot.py against the local mock gateway in mock_gateway.py
+
+import configparser
+import json
+import os
+import subprocess
+import sys
+
+SHARD_COUNT = 4
+PROCESSES = 2
+
+def worker_config(tmp_path, root):
+    parser = configparser.ConfigParser()
+    parser.read(os.path.join(root, 'config.ini'))
+    parser['plugins']['plugin_whitelist'] = '[]'
+    parser['executors']['cpu_processes'] = '0'
+    parser['metrics']['port'] = '0'
+    parser['sharding']['shard_count'] = str(SHARD_COUNT)
+    parser['sharding']['processes'] = str(PROCESSES)
+    filename = tmp_path / 'config.ini'
+    with open(filename, 'w') as file:
+        parser.write(file)
+    return str(filename)
+
+def run_worker(tmp_path, root, cluster_id, guild_ids):
+    result = subprocess.run([ sys.executable, os.path.join(root, 'tests', 'mock_gateway.py'), worker_config(tmp_path, root),
+                              str(cluster_id), ','.join(map(str, guild_ids)) ],
+                            cwd = root, capture_output = True, text = True, timeout = 60)
+    assert result.returncode == 0, result.stderr
+    return json.loads(result.stdout.splitlines()[-1])
+
+# a guild is on shard (id >> 22) % shard_count
+def test_worker_identifies_and_serves_only_its_shards(tmp_path, repo_root):
+    guild_ids = [ (shard << 22) | 7 for shard in range(2 * SHARD_COUNT) ]
+    result = run_worker(tmp_path, repo_root, 1, guild_ids)
+    assert result['shard_ids'] == [ 2, 3 ] and result['shard_count'] == SHARD_COUNT
+    assert result['identified'] == [ [ 2, SHARD_COUNT ], [ 3, SHARD_COUNT ] ]
+    assert result['guilds'] == sorted([ g, (g >> 22) % SHARD_COUNT ] for g in guild_ids if (g >> 22) % SHARD_COUNT in (2, 3))
+
+def test_worker_joins_the_cluster_and_applies_relayed_changes(tmp_path, repo_root):
+    result = run_worker(tmp_path, repo_root, 0, [ 7 ])
+    assert result['hello'] == [ 'hello', 0 ]
+    assert result['relayed_ban']
+    assert result['guilds'] == [ [ 7, 0 ] ]
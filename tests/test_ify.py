@@ -0,0 +1,52 @@
+# Tests for the ify text transformers
+
+import itertools
+import random
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from plugins.lib import ify
+
+def test_nsfw_filter_catches_compound_words():
+    assert ify.filter_nsfw('motherfucker dumbass', False) == 'motherfricker dumbbutt'
+
+def test_nsfw_filter_keeps_the_case():
+    assert ify.filter_nsfw('What the FUCK, Hell', False) == 'What the FRICK, Heck'
+
+def test_nsfw_filter_leaves_allowed_words_alone():
+    text = 'Hello class, pass the glass and assume the shell is classic'
+    assert ify.filter_nsfw(text, False) == text
+
+def test_nsfw_filter_is_off_in_nsfw_channels():
+    assert ify.filter_nsfw('dumbass', True) == 'dumbass'
+
+def test_sfwify_filters_every_word():
+    assert ify.sfwifier(seed = 1).ify_text('hello you dumbass, fucking hell') == 'hello you dumbbutt, fricking heck'
+
+# with cpu_processes = 0 run_cpu uses the thread pool, so ifiers are shared between threads
+def test_ify_text_by_name_is_safe_across_threads():
+    text = 'hello there, how are you doing today? ' * 200
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        with ThreadPoolExecutor(8) as pool:
+            results = list(pool.map(lambda _: ify.ify_text_by_name('owoify', text, True), range(64)))
+    finally:
+        sys.setswitchinterval(interval)
+    assert all(results)
+
+def test_rolls_are_percentiles_from_one():
+    seen = set(itertools.islice(ify.rolls(random.Random(1)), 10000))
+    assert seen == set(range(1, 101))
+
+# a weight fires when it is greater than a roll of 1-100, as random.randint(1, 100) was compared before
+def test_weights_fire_on_the_rolls_below_them():
+    fired = { weight: sum(list(ify.replace_words([ 'you' ], { 'you': 'like you' }, weight, iter([ roll ]))) == [ 'like you' ]
+                          for roll in range(1, 101))
+              for weight in (0, 1, 99, 100) }
+    assert fired == { 0: 0, 1: 0, 99: 98, 100: 99 }
+
+# the baseline substituted word by word, so the owo rules starting with a space stay unused
+def test_owo_substitution_is_per_word():
+    substitution = ify.casefixed_substitution(ify.owoifier.SUBSTRING_REPLACEMENTS)
+    assert list(ify.substitute([ 'Hello', 'cute', 'world', 'Wow!' ], substitution)) == [ 'Hewwo', 'cute', 'wowwd', 'Wow!' ]
@@ -0,0 +1,48 @@
+# What importing the bot and its plugins pulls in, on top of discord.py itself
+# Cold start and reload_plugin both pay for these imports. The tests check which modules get imported,
+# the time budget only catches a large regression and can be changed with IMPORT_BUDGET_MS on slow machines.
+
+import json
+import os
+import subprocess
+import sys
+
+BUDGET_MS = float(os.environ.get('IMPORT_BUDGET_MS', 1000))   # about 50 ms when this was written
+HEAVY_MODULES = [ 'numpy' ]
+MODULES = [ 'bot', 'plugins.markov_cog', 'plugins.ify_cog', 'plugins.devtools_cog',
+            'plugins.politeness_cog', 'plugins.verbosity_cog' ]
+
+# discord and aiosqlite are imported first so only this repository's own cost is measured
+MEASURE = f'''
+import json, sys, time
+import discord, aiosqlite
+started = time.perf_counter()
+for module in {MODULES!r}:
+    __import__(module)
+print(json.dumps({{ 'ms': (time.perf_counter() - started) * 1000,
+                   'heavy': [ m for m in {HEAVY_MODULES!r} if m in sys.modules ] }}))
+'''
+
+# importing config with arguments the bot would reject must neither parse them nor read config.ini
+CONFIG_IMPORT = '''
+import json, sys
+sys.argv = [ 'main.py', '--no-such-option' ]
+import config
+print(json.dumps({ 'config': config.config, 'sections': config.configfile.sections(), 'argparse': 'argparse' in sys.modules }))
+'''
+
+def run_python(root, code):
+    result = subprocess.run([ sys.executable, '-c', code ], cwd = root, capture_output = True, text = True)
+    assert result.returncode == 0, result.stderr
+    return json.loads(result.stdout.splitlines()[-1])
+
+def test_plugins_do_not_import_heavy_modules(repo_root):
+    assert run_python(repo_root, MEASURE)['heavy'] == [ ]
+
+def test_importing_config_does_not_parse_the_command_line(repo_root):
+    assert run_python(repo_root, CONFIG_IMPORT) == { 'config': { }, 'sections': [ ], 'argparse': False }
+
+def test_cold_import_stays_within_budget(repo_root):
+    # best of three, a busy machine only ever makes it slower
+    fastest = min(run_python(repo_root, MEASURE)['ms'] for _ in range(3))
+    assert fastest < BUDGET_MS, f'cold import took {fastest:.0f} ms, the budget is {BUDGET_MS:.0f} ms (IMPORT_BUDGET_MS)'
@@ -0,0 +1,103 @@
+# Tests for markov_brain storage
+
+import sqlite3
+import time
+
+from plugins.lib.markov_brain import decayed_count
+
+def test_import_fills_the_reverse_index(with_markov):
+    chain = { 'the quick': [ [ 'brown', 2 ] ], 'quick brown': [ [ 'fox', 1 ], [ '<stop>', 1 ] ] }
+
+    async def test(m):
+        await m.brain.import_chain(chain)
+        return (await m.brain.get_previous_states_backoff([ 'quick', 'brown' ]),
+                await m.brain.get_previous_states_backoff([ 'brown', 'fox' ]),
+                await m.brain.get_previous_states_backoff([ 'brown' ]))
+    quick_brown, brown_fox, brown = with_markov(test)
+    assert quick_brown == [ ('the', 2) ]
+    assert brown_fox == [ ('quick', 1) ]
+    # 'quick brown' -> <stop> adds 'brown' <- 'quick' without a stop marker
+    assert sorted(brown) == [ ('quick', 2) ]
+
+def test_babble_walks_back_over_imported_transitions(with_markov):
+    chain = { 'the quick': [ [ 'brown', 1 ] ], 'quick brown': [ [ 'fox', 1 ] ], 'brown fox': [ [ '<stop>', 1 ] ] }
+
+    async def test(m):
+        await m.brain.import_chain(chain)
+        return await m.generate_reverse_message('brown fox')
+    assert with_markov(test) == 'the quick'
+
+def test_export_round_trips_through_import(with_markov, tmp_path):
+    async def test(m):
+        await m.brain.export_json(str(tmp_path / 'brain.json'))
+        before = sorted(await m.brain.get_next_states_backoff([ 'the', 'quick' ]))
+        await m.brain.reset()
+        await m.brain.import_json(str(tmp_path / 'brain.json'))
+        return before, sorted(await m.brain.get_next_states_backoff([ 'the', 'quick' ]))
+    before, after = with_markov(test, [ 'the quick brown fox', 'the quick red fox' ])
+    assert before == after == [ ('brown', 1), ('red', 1) ]
+
+# a brain cloned with root_id copies both directions, babbling used to lose the backward half
+def test_a_cloned_brain_babbles_both_ways(with_manager):
+    async def test(manager):
+        root = await manager.add_markov(1)
+        root.cancel_refill()
+        await root.process_message('three four five six seven')
+        clone = await manager.add_markov(2, root_id = 1)
+        clone.cancel_refill()
+        return (await clone.brain.get_previous_states_backoff([ 'five', 'six' ]),
+                await clone.babble('five six'))
+    previous, babbled = with_manager(test)
+    assert previous == [ ('four', 1) ]
+    assert babbled == 'three four five six seven'
+
+# a brain over its budget keeps its most reinforced transitions and the contexts they hang off
+def test_prune_evicts_the_weakest_transitions(with_markov):
+    async def test(m):
+        before = await m.brain.size()
+        reclaimed = await m.brain.prune()
+        return (before, reclaimed, await m.brain.size(), await m.brain.prune(),
+                await m.brain.get_next_states_backoff([ 'quick', 'brown' ]),
+                await m.brain.get_next_states_backoff([ 'lazy', 'dog' ]),
+                await m.brain.get_next_states_backoff([ 'one' ]))
+    before, reclaimed, after, again, kept, *dropped = with_markov(test, [ 'the quick brown fox' ] * 3 + [ 'a lazy dog', 'one two three' ],
+                                                                  max_entries = 2)
+    assert before == 10 and after == 2
+    # the evicted transitions and the contexts they orphaned
+    assert reclaimed > before - after
+    assert again == 0
+    assert kept == [ ('fox', 3) ]
+    assert dropped == [ [ ], [ ] ]
+
+def test_brains_without_a_budget_are_not_pruned(with_markov):
+    async def test(m):
+        return await m.brain.prune(), await m.brain.size()
+    assert with_markov(test, [ 'a lazy dog', 'one two three' ]) == (0, 6)
+
+def test_decayed_count_halves_every_half_life():
+    assert decayed_count(8, 1000, 1000, 60) == 8
+    assert decayed_count(8, 1000, 1120, 60) == 2
+    # a clock that went backwards doesn't grow the weight
+    assert decayed_count(8, 1000, 900, 60) == 8
+
+# transitions last reinforced long ago weigh less, and drop_decayed removes those under the threshold
+def test_old_transitions_decay_and_are_dropped(with_markov):
+    HALF_LIFE = 3600
+
+    async def test(m):
+        await m.process_message('the quick brown fox')
+        # 'the quick brown' was last reinforced two half-lives ago, 'a lazy dog' ten
+        now = int(time.time())
+        with sqlite3.connect(m.brain.database_filename) as database:
+            for table in (m.brain.next_state_table.name, m.brain.previous_state_table.name):
+                database.execute(f'UPDATE "{table}" SET updated = ?;', (now - 10 * HALF_LIFE,))
+                database.execute(f'UPDATE "{table}" SET updated = ? WHERE count = 2;', (now - 2 * HALF_LIFE,))
+        weights = await m.brain.get_next_states_backoff([ 'the', 'quick' ])
+        reclaimed = await m.brain.drop_decayed()
+        return (weights, reclaimed, await m.brain.get_next_states_backoff([ 'the', 'quick' ]),
+                await m.brain.get_next_states_backoff([ 'lazy', 'dog' ]))
+    weights, reclaimed, kept, dropped = with_markov(test, [ 'the quick brown fox', 'a lazy dog' ], half_life = HALF_LIFE)
+    assert [ (word, round(weight, 3)) for word, weight in weights ] == [ ('brown', 0.5) ]
+    assert reclaimed > 0
+    assert kept == weights
+    assert dropped == [ ]
@@ -0,0 +1,46 @@
+# Tests for markov_manager
+
+import sqlite3
+
+def brain_tables(filename, id):
+    with sqlite3.connect(filename) as database:
+        return [ name for name, in database.execute('SELECT name FROM sqlite_master WHERE type = \'table\';') if name.startswith(f'{id}markov') ]
+
+# a guild served by another process after [sharding] changed brings its brain along
+def test_brains_move_to_the_process_that_serves_the_guild(with_manager, with_markov, tmp_path):
+    old, new = tmp_path / 'markov.db', tmp_path / 'markov.cluster1.db'
+
+    async def learn(manager):
+        m = await manager.add_markov(1)
+        m.cancel_refill()
+        await m.process_message('the quick brown fox')
+        await manager.set_chattiness(1, 30)
+        await manager.set_chain_length(1, 3)
+        (await manager.add_markov(2)).cancel_refill()
+
+    async def move(m):
+        return m.chattiness, m.chain_length, await m.brain.size(), await m.brain.get_next_states_backoff([ 'quick', 'brown' ])
+
+    with_manager(learn, filename = old)
+    chattiness, chain_length, size, states = with_markov(move, filename = new, others = [ old, new ])
+    assert (chattiness, chain_length) == (30, 3)
+    assert size == 4
+    assert states == [ ('fox', 1) ]
+    assert not brain_tables(old, 1)
+    assert brain_tables(old, 2)
+    with sqlite3.connect(old) as database:
+        assert database.execute('SELECT id FROM markov_settings;').fetchall() == [ ]
+
+def test_a_brain_already_here_is_kept(with_markov, tmp_path):
+    old, new = tmp_path / 'markov.db', tmp_path / 'markov.cluster0.db'
+
+    async def nothing(m):
+        pass
+
+    async def hello(m):
+        return await m.brain.get_next_states_backoff([ 'hello' ])
+
+    with_markov(nothing, [ 'goodbye world' ], filename = old)
+    with_markov(nothing, [ 'hello there' ], filename = new)
+    assert with_markov(hello, filename = new, others = [ old ]) == [ ('there', 1) ]
+    assert brain_tables(old, 1)
@@ -0,0 +1,31 @@
+# Tests for the pool of ready made random messages
+
+import asyncio
+
+from plugins.lib.markov_manager import markov_manager
+
+def test_refill_waits_until_the_brain_is_idle(with_markov):
+    async def test(m):
+        m.REFILL_IDLE_SECONDS = 0.2
+        m.schedule_refill()
+        # messages keep the brain busy, so nothing is generated yet
+        for _ in range(4):
+            await asyncio.sleep(0.1)
+            await m.process_message('the lazy dog')
+        busy = len(m.response_pool)
+        await asyncio.sleep(0.5)
+        return busy, len(m.response_pool)
+    busy, idle = with_markov(test, [ 'the quick brown fox' ])
+    assert busy == 0
+    assert idle == 5
+
+def test_brains_added_together_stagger_their_first_refill(with_manager):
+    async def test(manager):
+        delays = [ ]
+        for id in range(3):
+            (await manager.add_markov(id)).cancel_refill()
+            delays.append(manager._next_refill)
+        return delays
+    first, second, third = with_manager(test)
+    assert second - first >= markov_manager.REFILL_STAGGER_SECONDS - 0.1
+    assert third - second >= markov_manager.REFILL_STAGGER_SECONDS - 0.1
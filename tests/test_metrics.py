@@ -0,0 +1,73 @@
+# Tests for the metrics registry and the Prometheus endpoint
+
+import asyncio
+
+import pytest
+
+from lib.metrics import metrics_registry, metrics_server, registry, statement_type
+
+def test_counters_and_gauges_render_in_the_text_format():
+    metrics = metrics_registry()
+    sends = metrics.counter('sends_total', 'Messages sent.')
+    sends.inc(kind = 'reply')
+    sends.inc(2, kind = 'reply')
+    sends.inc()
+    depth = metrics.gauge('queue_depth', 'Waiting messages.')
+    depth.set(5, guild = 1)
+    depth.dec(guild = 1)
+    assert metrics.render() == ('# HELP sends_total Messages sent.\n'
+                                '# TYPE sends_total counter\n'
+                                'sends_total{kind="reply"} 3\n'
+                                'sends_total 1\n'
+                                '# HELP queue_depth Waiting messages.\n'
+                                '# TYPE queue_depth gauge\n'
+                                'queue_depth{guild="1"} 4\n')
+
+# buckets are cumulative and a value on a bound falls in that bucket
+def test_histograms_render_cumulative_buckets():
+    metrics = metrics_registry()
+    seconds = metrics.histogram('call_seconds', 'Calls.', buckets = (0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        seconds.observe(value, call = 'send')
+    assert metrics.render().splitlines()[2:] == [ 'call_seconds_bucket{call="send",le="0.1"} 2',
+                                                  'call_seconds_bucket{call="send",le="1.0"} 3',
+                                                  'call_seconds_bucket{call="send",le="+Inf"} 4',
+                                                  'call_seconds_sum{call="send"} 2.65',
+                                                  'call_seconds_count{call="send"} 4' ]
+    assert metrics.summary() == 'call_seconds{call="send"}: 4 in 2.65 s, p50 <100 ms p99 <inf ms max 2000.0 ms'
+
+def test_metrics_are_shared_by_name_and_type():
+    metrics = metrics_registry()
+    assert metrics.counter('hits_total') is metrics.counter('hits_total')
+    with pytest.raises(ValueError, match = 'already a counter'):
+        metrics.histogram('hits_total')
+
+def test_statement_type():
+    assert statement_type('  SELECT 1;') == 'select'
+    assert statement_type(' ') == 'unknown'
+
+async def get(port, path):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(f'GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode())
+    response = (await reader.read()).decode()
+    writer.close()
+    head, body = response.split('\r\n\r\n', 1)
+    return head.splitlines(), body
+
+def test_the_endpoint_serves_the_registry():
+    registry.counter('test_endpoint_total', 'Counted by test_metrics.').inc()
+
+    async def main():
+        server = metrics_server('127.0.0.1', 0)
+        await server.start()
+        port = server.server.sockets[0].getsockname()[1]
+        try:
+            return await get(port, '/metrics?x=1'), await get(port, '/')
+        finally:
+            await server.stop()
+    (head, body), (missing, _) = asyncio.run(main())
+    assert head[0] == 'HTTP/1.1 200 OK'
+    assert 'Content-Type: text/plain; version=0.0.4; charset=utf-8' in head
+    assert body == registry.render()
+    assert '# TYPE test_endpoint_total counter\ntest_endpoint_total 1\n' in body
+    assert missing[0] == 'HTTP/1.1 404 Not Found'
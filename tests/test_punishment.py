@@ -0,0 +1,171 @@
+# Tests for the shared punishment engine
+
+import asyncio
+import datetime
+import hashlib
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+
+from lib.message_pipeline import message_pipeline
+from plugins.lib.politeness import politeness_manager
+from plugins.lib.punishment import punishment_engine
+from plugins.lib.verbosity import verbosity_manager
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    filename = str(tmp_path / 'punishments.db')
+    monkeypatch.setattr(punishment_engine, 'DATABASE_FILE', filename)
+    return filename
+
+def fake_bot():
+    return SimpleNamespace(messages = message_pipeline(), user = SimpleNamespace(display_name = 'bot'))
+
+def in_minutes(minutes):
+    return datetime.datetime.now() + datetime.timedelta(minutes = minutes)
+
+def rows(filename):
+    with sqlite3.connect(filename) as database:
+        return sorted(database.execute('SELECT guild_id, user_id, rule, argument FROM punishments;').fetchall())
+
+# the politeness and verbosity tables as the baseline politeness_manager and verbosity_manager created them
+def baseline_database(filename):
+    with sqlite3.connect(filename, detect_types = sqlite3.PARSE_DECLTYPES) as database:
+        for table, column in (('politeness', 'phrase'), ('verbosity', 'option')):
+            database.execute(f'CREATE TABLE "{table}" (rowid INTEGER PRIMARY KEY AUTOINCREMENT,hash TEXT UNIQUE, '
+                             f'user_id INTEGER, guild_id INTEGER, endtime TIMESTAMP, {column} TEXT );')
+        database.executemany('INSERT INTO politeness (hash, user_id, guild_id, endtime, phrase) VALUES (?, ?, ?, ?, ?);',
+                             [ ('a', 10, 1, in_minutes(30), 'I will not plagiarize'), ('b', 11, 1, in_minutes(-5), 'old') ])
+        database.execute('INSERT INTO verbosity (hash, user_id, guild_id, endtime, option) VALUES (?, ?, ?, ?, ?);',
+                         ('c', 10, 1, in_minutes(60), 'tweetify'))
+
+async def register_rules(bot):
+    rules = [ politeness_manager(bot), verbosity_manager(bot) ]
+    for rule in rules:
+        await rule.init()
+    return rules
+
+async def close_rules(rules):
+    for rule in rules:
+        await rule.close()
+
+# a database from before the engine loads into the in-memory index, expired entries are dropped on load
+def test_register_loads_a_baseline_database_into_the_index(database):
+    baseline_database(database)
+
+    async def main():
+        bot = fake_bot()
+        rules = await register_rules(bot)
+        engine = bot.punishment_engine
+        entries = engine.get_entries(10, 1), engine.get_entries(11, 1)
+        subscribed = set(engine.messages.keys)
+        await close_rules(rules)
+        return entries, subscribed, engine
+    (active, expired), subscribed, engine = asyncio.run(main())
+    assert active == { 'politeness': 'I will not plagiarize', 'verbosity': 'tweetify' }
+    assert expired == { }
+    assert subscribed == { ('user', 1, 10) }
+    assert rows(database) == [ (1, 10, 'politeness', 'I will not plagiarize'), (1, 10, 'verbosity', 'tweetify') ]
+    with sqlite3.connect(database) as connection:
+        tables = { name for name, in connection.execute('SELECT name FROM sqlite_master WHERE type = \'table\';') }
+    assert 'punishments' in tables and not tables & { 'politeness', 'verbosity' }
+    # unregistering the last rule lets go of the message subscription
+    assert not engine._initialized and not engine.messages.keys
+
+def test_registering_again_leaves_the_migrated_rows_alone(database):
+    baseline_database(database)
+
+    async def main():
+        results = [ ]
+        for _ in range(2):
+            bot = fake_bot()
+            rules = await register_rules(bot)
+            results.append((bot.punishment_engine.get_entries(10, 1), rows(database)))
+            await close_rules(rules)
+        return results
+    first, second = asyncio.run(main())
+    assert first == second
+
+def message(content, user_id = 10, guild_id = 1, channel_id = 100, id = 1000):
+    return SimpleNamespace(id = id, content = content, guild = SimpleNamespace(id = guild_id),
+                           author = SimpleNamespace(id = user_id, display_name = 'someone'),
+                           channel = SimpleNamespace(id = channel_id))
+
+def test_politeness_checks_for_the_phrase():
+    rule = politeness_manager(fake_bot())
+    assert rule.check('I will not plagiarize', 'fine, i WILL NOT PLAGIARIZE')
+    assert not rule.check('I will not plagiarize', 'fine')
+
+# the baseline passed the phrase where the community belongs
+def test_politeness_reminder_names_the_community_then_the_phrase():
+    rule = politeness_manager(fake_bot())
+    assert rule.reminder('someone', 'I respect your identity') == (
+        "Hello someone, your comment has been automatically removed. You've been noticed by our moderators as "
+        "problematic, so your messages need to show love and acceptance towards the intersectional community. "
+        "You can resubmit your comment with 'I respect your identity' included.")
+    assert 'towards the community.' in rule.reminder('someone', 'sorry')
+
+def test_verbosity_checks_the_length():
+    rule = verbosity_manager(fake_bot())
+    assert rule.check('tweetify', 'x' * 255) and not rule.check('tweetify', 'x' * 256)
+    assert rule.check('verbosify', 'x' * 256) and not rule.check('verbosify', 'x' * 255)
+    assert rule.reminder('someone', 'verbosify').endswith('your comment must be over 255 characters. ')
+
+# a message breaking two rules is queued once with both reminders
+def test_every_broken_rule_is_checked_in_one_pass(database):
+    async def main():
+        bot = fake_bot()
+        rules = await register_rules(bot)
+        for rule, argument in zip(rules, ('I will not plagiarize', 'verbosify')):
+            await rule.add_entry(10, 1, 30, argument)
+        engine = bot.punishment_engine
+        await engine.process_message(message('short', user_id = 11))
+        await engine.process_message(message('I will not plagiarize ' + 'x' * 300))
+        await engine.process_message(message('short'))
+        pending = { channel: (list(messages), [ texts for _, texts in replies.values() ])
+                    for channel, (messages, replies) in engine.enforcement.pending.items() }
+        await close_rules(rules)
+        return pending
+    pending = asyncio.run(main())
+    assert list(pending) == [ 100 ]
+    messages, reminders = pending[100]
+    assert messages == [ 1000 ]
+    assert len(reminders) == 1 and len(reminders[0]) == 2
+    assert reminders[0][0].startswith('Hello someone') and reminders[0][1].startswith('Hi someone')
+
+# the shared table as it was keyed before, by sha3_256(f'{user id}:{guild id}:{rule}')
+def hashed_database(filename):
+    with sqlite3.connect(filename, detect_types = sqlite3.PARSE_DECLTYPES) as database:
+        database.execute('CREATE TABLE "punishments" (rowid INTEGER PRIMARY KEY AUTOINCREMENT,hash TEXT UNIQUE, user_id INTEGER, '
+                         'guild_id INTEGER, rule TEXT, endtime TIMESTAMP, argument TEXT );')
+        database.execute('CREATE INDEX "punishments_endtime" ON "punishments" (endtime);')
+        entries = [ (10, 1, 'politeness', 'I will not plagiarize'), (10, 1, 'verbosity', 'verbosify'), (10, 2, 'verbosity', 'tweetify') ]
+        database.executemany('INSERT INTO punishments (hash, user_id, guild_id, rule, endtime, argument) VALUES (?, ?, ?, ?, ?, ?);',
+                             [ (hashlib.sha3_256(f'{user_id}:{guild_id}:{rule}'.encode()).hexdigest(), user_id, guild_id, rule, in_minutes(30), argument)
+                               for user_id, guild_id, rule, argument in entries ])
+
+def test_hashed_rows_move_to_integer_keys(database):
+    hashed_database(database)
+
+    async def main():
+        results = [ ]
+        for _ in range(2):
+            bot = fake_bot()
+            rules = await register_rules(bot)
+            engine = bot.punishment_engine
+            results.append(({ key: engine.get_entries(key[1], key[0]) for key in engine.entries }, rows(database)))
+            await close_rules(rules)
+        return results
+    first, second = asyncio.run(main())
+    entries, migrated = first
+    assert entries == { (1, 10): { 'politeness': 'I will not plagiarize', 'verbosity': 'verbosify' }, (2, 10): { 'verbosity': 'tweetify' } }
+    assert migrated == [ (1, 10, 'politeness', 'I will not plagiarize'), (1, 10, 'verbosity', 'verbosify'), (2, 10, 'verbosity', 'tweetify') ]
+    assert second == first
+    with sqlite3.connect(database) as connection:
+        columns = [ row[1] for row in connection.execute('PRAGMA table_info("punishments");') ]
+        key = [ row[1] for row in sorted(connection.execute('PRAGMA table_info("punishments");')) if row[5] ]
+        tables = { name for name, in connection.execute('SELECT name FROM sqlite_master WHERE type = \'table\';') }
+    assert columns == [ 'guild_id', 'user_id', 'rule', 'endtime', 'argument' ]
+    assert key == [ 'guild_id', 'user_id', 'rule' ]
+    assert 'punishments_hashed' not in tables
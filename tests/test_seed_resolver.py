@@ -0,0 +1,63 @@
+# Tests for markov.seed_candidates and the single query seed resolver
+
+import pytest
+
+from plugins.lib.markov import markov
+
+# resolves phrase against a fresh brain that learned messages
+@pytest.fixture
+def resolve(with_markov):
+    def run(messages, phrase):
+        return with_markov(lambda m: m.string_to_seed(phrase), messages)
+    return run
+
+def test_candidates_rank_end_then_beginning_then_shorter_runs():
+    exact, prefixes = markov(None).seed_candidates([ 'the', 'quick', 'brown' ])
+    assert exact == [ ('quick brown', 0), ('the quick', 1), ('brown', 5), ('quick', 6), ('the', 6) ]
+    assert prefixes == [ ('brown', 3), ('quick', 4), ('the', 4) ]
+
+def test_candidates_rank_inner_runs_after_the_ends():
+    exact, _ = markov(None).seed_candidates([ 'a', 'b', 'c', 'd' ])
+    ranks = dict(exact)
+    assert ranks['c d'] < ranks['a b'] < ranks['b c']
+
+def test_candidates_of_a_short_phrase_are_prefixes_first():
+    exact, prefixes = markov(None).seed_candidates([ 'hello' ])
+    assert prefixes == [ ('hello', 3) ]
+    assert exact == [ ('hello', 5) ]
+
+def test_candidates_follow_the_chain_length():
+    m = markov(None, chain_length = 3)
+    exact, prefixes = m.seed_candidates([ 'a', 'b', 'c', 'd' ])
+    assert exact[:2] == [ ('b c d', 0), ('a b c', 1) ]
+    assert all(len(phrase.split()) < 3 for phrase, _ in prefixes)
+
+def test_resolve_prefers_the_end_of_the_phrase(resolve):
+    assert resolve([ 'a b c d' ], 'a b c d') == 'c d'
+
+# the end seed used to be rejected when the beginning of the phrase was unknown
+def test_resolve_uses_the_end_when_the_beginning_is_unknown(resolve):
+    assert resolve([ 'a b c d' ], 'zz qq c d') == 'c d'
+
+def test_resolve_falls_back_to_the_beginning(resolve):
+    assert resolve([ 'a b c d' ], 'a b zz qq') == 'a b'
+
+def test_resolve_uses_a_contained_run(resolve):
+    assert resolve([ 'a b c d' ], 'zz b c qq') == 'b c'
+
+def test_resolve_extends_a_single_word_to_a_full_seed(resolve):
+    assert resolve([ 'hello there friend' ], 'hello') == 'hello there'
+
+def test_resolve_backs_off_to_a_shorter_context(resolve):
+    assert resolve([ 'hello there friend' ], 'friend') == 'friend'
+
+def test_resolve_ignores_punctuation(resolve):
+    assert resolve([ 'a b c d' ], 'c, d!') == 'c d'
+
+def test_resolve_raises_for_unknown_phrases(resolve):
+    with pytest.raises(KeyError):
+        resolve([ 'a b c d' ], 'nothing known here')
+
+def test_resolve_raises_for_an_empty_phrase(resolve):
+    with pytest.raises(KeyError):
+        resolve([ 'a b c d' ], '?!')
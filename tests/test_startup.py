@@ -0,0 +1,48 @@
+# Tests for the startup timeline
+
+import time
+
+from lib.startup import startup_timeline
+
+def test_phase_once_only_times_the_first_run():
+    timeline = startup_timeline()
+    for _ in range(3):
+        with timeline.phase_once('chatbot brains'):
+            pass
+    assert [ name for name, _, _ in timeline.phases ] == [ 'chatbot brains' ]
+    assert timeline.phases[0][2] is not None
+
+def test_phases_record_their_start_and_duration():
+    timeline = startup_timeline()
+    with timeline.phase('outer'):
+        with timeline.phase('inner'):
+            time.sleep(0.01)
+    running = timeline.begin('connect to discord')
+    (outer, outer_at, outer_took), (inner, inner_at, inner_took), connecting = timeline.phases
+    assert (outer, inner) == ('outer', 'inner')
+    assert outer_at <= inner_at and inner_took >= 0.01 and outer_took >= inner_took
+    assert connecting[2] is None
+    timeline.end(running)
+    assert timeline.phases[running][2] is not None
+
+# steps timed elsewhere, like each plugin's load, are placed where they started
+def test_recorded_steps_are_reported_in_start_order():
+    timeline = startup_timeline()
+    with timeline.phase('load plugins'):
+        time.sleep(0.02)
+        timeline.record('plugin markov_cog', 0.01)
+    timeline.begin('connect to discord')
+    report = timeline.report()
+    lines = report.splitlines()
+    assert lines[0].startswith('Startup timeline (') and lines[0].endswith(' s to now):')
+    assert [ line.split()[1] for line in lines[1:] ] == [ 'load', 'plugin', 'connect' ]
+    assert ' running at ' in lines[3]
+
+def test_only_the_first_ready_counts():
+    timeline = startup_timeline()
+    timeline.finish()
+    ready = timeline.ready
+    time.sleep(0.01)
+    timeline.finish()
+    assert timeline.ready == ready
+    assert ' s to ready):' in timeline.report()